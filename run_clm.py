@@ -20,6 +20,7 @@ https://huggingface.co/models?filter=text-generation
 """
 # You can also adapt this script on your own causal language modeling task. Pointers for this are left as comments.
 
+import contextlib
 import logging
 import math
 import os
@@ -56,6 +57,26 @@ from transformers.trainer_utils import get_last_checkpoint
 from transformers.utils import check_min_version, send_example_telemetry
 from transformers.utils.versions import require_version
 
+from utils.chunking import (
+    split_batch_into_chunks,
+    group_chunks,
+    retokenize_chunks,
+    special_token_affixes,
+)
+from utils.packing import (
+    pack_features,
+    packing_efficiency,
+    DataCollatorForPackedSequences,
+    check_attn_implementation,
+)
+from utils.indexed_dataset import IndexedTokenDataset, build_indexed_datasets
+from utils.streaming import StreamingLMDataset, StreamingTrainer
+from utils.dataset_cache import (
+    preprocessing_cache_key,
+    load_cached_datasets,
+    save_cached_datasets,
+)
+
 
 # Will error if the minimal version of Transformers is not installed. Remove at your own risks.
 # check_min_version("4.32.0.dev0")
@@ -133,6 +154,16 @@ class ModelArguments:
             "choices": ["auto", "bfloat16", "float16", "float32"],
         },
     )
+    attn_implementation: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Attention implementation of the model (default: the transformers default). "
+                "--pack_sequences needs one taking 4D attention masks, `eager` or `sdpa`."
+            ),
+            "choices": ["eager", "sdpa", "flash_attention_2"],
+        },
+    )
     low_cpu_mem_usage: bool = field(
         default=False,
         metadata={
@@ -172,7 +203,7 @@ class DataTrainingArguments:
         metadata={
             "help": (
                 "For debugging purposes or quicker training, truncate the number of training examples to this "
-                "value if set."
+                "value if set. With `--streaming`, it is split across ranks."
             )
         },
     )
@@ -181,11 +212,19 @@ class DataTrainingArguments:
         metadata={
             "help": (
                 "For debugging purposes or quicker training, truncate the number of evaluation examples to this "
-                "value if set."
+                "value if set. With `--streaming`, it is split across ranks."
             )
         },
     )
     streaming: bool = field(default=False, metadata={"help": "Enable streaming mode"})
+    streaming_prefetch_size: int = field(
+        default=256,
+        metadata={"help": "Number of samples prepared ahead of training in streaming mode (0 to disable prefetching)."},
+    )
+    streaming_clean: bool = field(
+        default=False,
+        metadata={"help": "Whether to clean each text (see scripts/clean_data.py) before tokenizing in streaming mode."},
+    )
     block_size: Optional[int] = field(
         default=None,
         metadata={
@@ -212,13 +251,76 @@ class DataTrainingArguments:
     keep_linebreaks: bool = field(
         default=True, metadata={"help": "Whether to keep line breaks when using TXT files or not."}
     )
+    grouping_mode: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "How chunks are turned into model inputs. `tokens` builds them directly from the tokenized ids, "
+                "`retokenize` decodes each chunk and tokenizes the text again (slower, may not reproduce the ids). "
+                "Defaults to `retokenize`, or `tokens` with `--streaming`, which only supports that."
+            ),
+            "choices": ["tokens", "retokenize"],
+        },
+    )
+    pack_sequences: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether to pack several grouped samples into each `block_size` window (first-fit decreasing). "
+                "Position ids restart and attention is masked at every sample boundary. Requires a model that "
+                "accepts custom 4D attention masks."
+            )
+        },
+    )
+    packing_batch_size: int = field(
+        default=1000, metadata={"help": "Number of grouped samples considered together when packing."}
+    )
+    preprocessing_cache_dir: Optional[str] = field(
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), ".project_cache", "lm_datasets"),
+        metadata={
+            "help": (
+                "Shared directory to cache preprocessed (tokenized and grouped) datasets in, keyed by the dataset "
+                "fingerprint, tokenizer and preprocessing parameters. A cache hit skips preprocessing. "
+                "Pass an empty string to disable."
+            )
+        },
+    )
+    preprocess_only: bool = field(
+        default=False,
+        metadata={"help": "Only preprocess the datasets and write them to `preprocessing_cache_dir`, then exit."},
+    )
+    tokenized_data_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Directory of pre-tokenized, memory-mapped token files (<split>.bin/.idx.npy/.json). Training reads "
+                "them instead of a dataset. With `--preprocess_only`, the token files are written there instead."
+            )
+        },
+    )
 
     def __post_init__(self):
         if self.streaming:
             require_version("datasets>=2.0.0", "The streaming feature requires `datasets>=2.0.0`")
 
+        if self.preprocessing_cache_dir == "":
+            self.preprocessing_cache_dir = None
+        if self.preprocess_only and (self.preprocessing_cache_dir is None or self.streaming):
+            raise ValueError("--preprocess_only requires a `preprocessing_cache_dir` and no streaming.")
+
+        if self.tokenized_data_dir is not None and self.pack_sequences:
+            raise ValueError("--pack_sequences is not supported with --tokenized_data_dir.")
+        if self.streaming and self.tokenized_data_dir is not None:
+            raise ValueError("--streaming is not supported with --tokenized_data_dir.")
+        if self.grouping_mode is None:
+            self.grouping_mode = "tokens" if self.streaming else "retokenize"
+        if self.streaming and self.grouping_mode != "tokens":
+            raise ValueError("--streaming only supports --grouping_mode tokens.")
+
+        reads_token_files = self.tokenized_data_dir is not None and not self.preprocess_only
         if self.dataset_name is None and self.train_file is None and self.validation_file is None:
-            raise ValueError("Need either a dataset name or a training/validation file.")
+            if not reads_token_files:
+                raise ValueError("Need either a dataset name, a training/validation file or a tokenized data dir.")
         else:
             if self.train_file is not None:
                 extension = self.train_file.split(".")[-1]
@@ -386,7 +488,17 @@ def main():
     #
     # In distributed training, the load_dataset function guarantee that only one local process can concurrently
     # download the dataset.
-    if data_args.dataset_name is not None:
+    use_token_files = data_args.tokenized_data_dir is not None and not data_args.preprocess_only
+    if use_token_files:
+        # Pre-tokenized token files replace the dataset and all of its preprocessing
+        raw_datasets = None
+        lm_datasets = {}
+        for split in ["train", "validation"]:
+            path_prefix = os.path.join(data_args.tokenized_data_dir, split)
+            if IndexedTokenDataset.exists(path_prefix):
+                lm_datasets[split] = IndexedTokenDataset(path_prefix)
+        logger.info(f"Loaded token files for splits {list(lm_datasets)} from {data_args.tokenized_data_dir}")
+    elif data_args.dataset_name is not None:
 
         # If dataset is a directory path, load from disk
         if os.path.isdir(data_args.dataset_name):
@@ -468,6 +580,13 @@ def main():
                 **dataset_args,
             )
 
+    if data_args.streaming and not isinstance(raw_datasets["train" if training_args.do_train else "validation"], datasets.IterableDataset):
+        # E.g. datasets loaded from disk or local files. Shard so every rank (and dataloader worker) reads its own shards.
+        num_shards = training_args.world_size * max(training_args.dataloader_num_workers, 1)
+        raw_datasets = datasets.IterableDatasetDict(
+            {split: ds.to_iterable_dataset(num_shards=max(min(num_shards, len(ds)), 1)) for split, ds in raw_datasets.items()}
+        )
+
     # See more about loading any type of standard or custom dataset (from files, python dict, pandas DataFrame, etc) at
     # https://huggingface.co/docs/datasets/loading_datasets.html.
 
@@ -518,40 +637,14 @@ def main():
             "You can do it from another script, save it, and load it from here, using --tokenizer_name."
         )
 
-    if model_args.model_name_or_path:
-        torch_dtype = (
-            model_args.torch_dtype
-            if model_args.torch_dtype in ["auto", None]
-            else getattr(torch, model_args.torch_dtype)
-        )
-        model = AutoModelForCausalLM.from_pretrained(
-            model_args.model_name_or_path,
-            config=config,
-            torch_dtype=torch_dtype
-            # low_cpu_mem_usage=model_args.low_cpu_mem_usage,
-        )
-    else:
-        model = AutoModelForCausalLM.from_config(config)
-        n_params = sum({p.data_ptr(): p.numel() for p in model.parameters()}.values())
-        logger.info(f"Training new model from scratch - Total size={n_params/2**20:.2f}M params")
-    
-    # tokenizer.padding_side='left'
-    # tokenizer.pad_token = tokenizer.eos_token
-    # model.config.pad_token_id = model.config.eos_token_id
-
-    # We resize the embeddings only when necessary to avoid index errors. If you are creating a model from scratch
-    # on a small vocab and want a smaller embedding size, remove this test.
-    embedding_size = model.get_input_embeddings().weight.shape[0]
-    if len(tokenizer) > embedding_size:
-        model.resize_token_embeddings(len(tokenizer))
-
-    # Preprocessing the datasets.
-    # First we tokenize all the texts.
-    if training_args.do_train:
-        column_names = list(raw_datasets["train"].features)
-    else:
-        column_names = list(raw_datasets["validation"].features)
-    text_column_name = "text" if "text" in column_names else column_names[0]
+    if not use_token_files:
+        # Preprocessing the datasets.
+        # First we tokenize all the texts.
+        if training_args.do_train:
+            column_names = list(raw_datasets["train"].features)
+        else:
+            column_names = list(raw_datasets["validation"].features)
+        text_column_name = "text" if "text" in column_names else column_names[0]
     
     
     if data_args.block_size is None:
@@ -572,103 +665,226 @@ def main():
         block_size = min(data_args.block_size, tokenizer.model_max_length)
 
 
-    # since this will be pickled to avoid _LazyModule error in Hasher force logger loading before tokenize_function
-    tok_logger = transformers.utils.logging.get_logger("transformers.tokenization_utils_base")
-
-    def tokenize_function(examples):
-        with CaptureLogger(tok_logger) as cl:
-            output = tokenizer(examples["text"])
-        # clm input could be much much longer than block_size
-        if "Token indices sequence length is longer than the" in cl.out:
-            tok_logger.warning(
-                "^^^^^^^^^^^^^^^^ Please ignore the warning above - this long input will be chunked into smaller bits"
-                " before being passed to the model."
-            )
-        return output
-
-    with training_args.main_process_first(desc="dataset map tokenization"):
-        if not data_args.streaming:
-            tokenized_datasets = raw_datasets.map(
-                tokenize_function,
-                batched=True,
-                num_proc=data_args.preprocessing_num_workers,
-                remove_columns=column_names,
-                load_from_cache_file=not data_args.overwrite_cache,
-                desc="Running tokenizer on dataset",
-            )
-        else:
-            tokenized_datasets = raw_datasets.map(
-                tokenize_function,
-                batched=True,
-                remove_columns=column_names,
-            )
-
     # Main data processing function that will concatenate all texts from our dataset and generate chunks of block_size.
     # Assumes all features are same length
     min_seq_len = 10 # Discard sequences longer than this
     chunk_sep_ids = [25380, 13] # 25380=@@ and 13=newline in tokenizer
-    def group_texts(examples):
-        results = {"input_ids": []}
-        for i, sequence in enumerate(examples["input_ids"]):
-            if len(sequence) < block_size:
-                results["input_ids"].append(sequence)
 
-            else:
-                chunks, _ = split_ids_into_chunks(sequence, chunk_size=block_size, split_id=chunk_sep_ids)
-                results["input_ids"] += chunks
-        
-        decoded_text = [tokenizer.decode(seq) for seq in results["input_ids"] if len(seq) > min_seq_len]
-        results = tokenizer(decoded_text, truncation=True, max_length=block_size) #padding="max_length", max_length=block_size, 
-        results["labels"] = results["input_ids"].copy() #.detach().clone()
-        
-        return results
+    if data_args.streaming:
+        # Texts are read, cleaned, tokenized, chunked and packed on the fly by each rank, see utils/streaming.py
+        clean_fn = None
+        if data_args.streaming_clean:
+            from scripts.clean_data import clean_sample as clean_fn
+        lm_datasets = {
+            split: StreamingLMDataset(
+                dataset,
+                tokenizer,
+                block_size,
+                text_column_name=text_column_name,
+                clean_fn=clean_fn,
+                chunk_sep_ids=chunk_sep_ids,
+                min_seq_len=min_seq_len,
+                pack=data_args.pack_sequences,
+                pack_buffer_size=data_args.packing_batch_size,
+                prefetch_size=data_args.streaming_prefetch_size,
+                rank=training_args.process_index,
+                world_size=training_args.world_size,
+            )
+            for split, dataset in raw_datasets.items()
+        }
+    elif not use_token_files:
+        # Preprocessed datasets are cached under a key covering everything their contents depend on. With the cache,
+        # the main process preprocesses and writes it while the other ranks wait, then they load it (memory mapped).
+        use_preprocessing_cache = data_args.preprocessing_cache_dir is not None
+        lm_datasets = None
+        if use_preprocessing_cache:
+            cache_key = preprocessing_cache_key(
+                raw_datasets,
+                tokenizer,
+                block_size=block_size,
+                chunk_sep_ids=chunk_sep_ids,
+                min_seq_len=min_seq_len,
+                grouping_mode=data_args.grouping_mode,
+                pack_sequences=data_args.pack_sequences,
+                packing_batch_size=data_args.packing_batch_size if data_args.pack_sequences else None,
+            )
+            preprocessing_context = training_args.main_process_first(local=False, desc="preprocessing datasets")
+            step_context = lambda desc: contextlib.nullcontext()
+        else:
+            preprocessing_context = contextlib.nullcontext()
+            step_context = training_args.main_process_first
+
+        # since this will be pickled to avoid _LazyModule error in Hasher force logger loading before tokenize_function
+        tok_logger = transformers.utils.logging.get_logger("transformers.tokenization_utils_base")
+
+        def tokenize_function(examples):
+            with CaptureLogger(tok_logger) as cl:
+                output = tokenizer(examples["text"])
+            # clm input could be much much longer than block_size
+            if "Token indices sequence length is longer than the" in cl.out:
+                tok_logger.warning(
+                    "^^^^^^^^^^^^^^^^ Please ignore the warning above - this long input will be chunked into smaller bits"
+                    " before being passed to the model."
+                )
+            return output
+
+        with preprocessing_context:
+            # With --overwrite_cache only the main process rebuilds the cache entry, the others load it
+            if use_preprocessing_cache and (not data_args.overwrite_cache or training_args.process_index != 0):
+                lm_datasets = load_cached_datasets(data_args.preprocessing_cache_dir, cache_key)
+
+            if lm_datasets is None:
+                with step_context(desc="dataset map tokenization"):
+                    tokenized_datasets = raw_datasets.map(
+                        tokenize_function,
+                        batched=True,
+                        num_proc=data_args.preprocessing_num_workers,
+                        remove_columns=column_names,
+                        load_from_cache_file=not data_args.overwrite_cache,
+                        desc="Running tokenizer on dataset",
+                    )
+
+                prefix_ids, suffix_ids = special_token_affixes(tokenizer)
+                def group_texts(examples):
+                    chunks = split_batch_into_chunks(examples["input_ids"], chunk_size=block_size, split_id=chunk_sep_ids)
+                    if data_args.grouping_mode == "retokenize":
+                        return retokenize_chunks(chunks, tokenizer, block_size, min_seq_len=min_seq_len)
+                    return group_chunks(chunks, block_size, min_seq_len=min_seq_len,
+                                        prefix_ids=prefix_ids, suffix_ids=suffix_ids)
+
+                # Note that with `batched=True`, this map processes 1,000 texts together, so group_texts throws away a remainder
+                # for each of those groups of 1,000 texts. You can adjust that batch_size here but a higher value might be slower
+                # to preprocess.
+                #
+                # To speed up this part, we use multiprocessing. See the documentation of the map method for more information:
+                # https://huggingface.co/docs/datasets/package_reference/main_classes.html#datasets.Dataset.map
+
+                #lm_datasets = tokenized_datasets
+    
+                with step_context(desc="grouping texts together"):
+                    lm_datasets = tokenized_datasets.map(
+                        group_texts,
+                        batched=True,
+                        batch_size=500,
+                        num_proc=data_args.preprocessing_num_workers,
+                        load_from_cache_file=not data_args.overwrite_cache,
+                        desc=f"Grouping texts in chunks of {block_size}",
+                    )
+
+                logger.info(f"Grouped dataset [max_size={block_size}]:")
+                logger.info(lm_datasets)
+
+                if data_args.pack_sequences:
+                    with step_context(desc="packing sequences"):
+                        lm_datasets = lm_datasets.map(
+                            pack_features,
+                            batched=True,
+                            batch_size=data_args.packing_batch_size,
+                            fn_kwargs={"block_size": block_size},
+                            remove_columns=["input_ids", "attention_mask", "labels"],
+                            num_proc=data_args.preprocessing_num_workers,
+                            load_from_cache_file=not data_args.overwrite_cache,
+                            desc=f"Packing sequences into blocks of {block_size}",
+                        )
+
+                if use_preprocessing_cache:
+                    save_cached_datasets(
+                        lm_datasets,
+                        data_args.preprocessing_cache_dir,
+                        cache_key,
+                        num_proc=data_args.preprocessing_num_workers,
+                        overwrite=data_args.overwrite_cache,
+                    )
+                    # Reload so the datasets are backed by the shared cache files
+                    lm_datasets = load_cached_datasets(data_args.preprocessing_cache_dir, cache_key)
+
+        if data_args.pack_sequences:
+            for split in lm_datasets:
+                packed, unpacked = packing_efficiency(lm_datasets[split]["seq_lens"], block_size)
+                logger.info(
+                    f"Packing efficiency ({split}): {packed:.2%} real tokens per block "
+                    f"({unpacked:.2%} without packing)"
+                )
 
-    # Note that with `batched=True`, this map processes 1,000 texts together, so group_texts throws away a remainder
-    # for each of those groups of 1,000 texts. You can adjust that batch_size here but a higher value might be slower
-    # to preprocess.
-    #
-    # To speed up this part, we use multiprocessing. See the documentation of the map method for more information:
-    # https://huggingface.co/docs/datasets/package_reference/main_classes.html#datasets.Dataset.map
+    if data_args.preprocess_only:
+        if data_args.tokenized_data_dir is not None and training_args.process_index == 0:
+            build_indexed_datasets(lm_datasets, data_args.tokenized_data_dir, vocab_size=len(tokenizer))
+        logger.info("Preprocessing finished (--preprocess_only), exiting.")
+        return
 
-    #lm_datasets = tokenized_datasets
+    attn_kwargs = {"attn_implementation": model_args.attn_implementation} if model_args.attn_implementation else {}
+    if model_args.model_name_or_path:
+        torch_dtype = (
+            model_args.torch_dtype
+            if model_args.torch_dtype in ["auto", None]
+            else getattr(torch, model_args.torch_dtype)
+        )
+        model = AutoModelForCausalLM.from_pretrained(
+            model_args.model_name_or_path,
+            config=config,
+            torch_dtype=torch_dtype,
+            **attn_kwargs
+            # low_cpu_mem_usage=model_args.low_cpu_mem_usage,
+        )
+    else:
+        model = AutoModelForCausalLM.from_config(config, **attn_kwargs)
+        n_params = sum({p.data_ptr(): p.numel() for p in model.parameters()}.values())
+        logger.info(f"Training new model from scratch - Total size={n_params/2**20:.2f}M params")
     
-    with training_args.main_process_first(desc="grouping texts together"):
-        if not data_args.streaming:
-            lm_datasets = tokenized_datasets.map(
-                group_texts,
-                batched=True,
-                batch_size=500,
-                num_proc=data_args.preprocessing_num_workers,
-                load_from_cache_file=not data_args.overwrite_cache,
-                desc=f"Grouping texts in chunks of {block_size}",
-            )
-        else:
-            lm_datasets = tokenized_datasets.map(
-                group_texts,
-                batched=True,
-            )
+    # tokenizer.padding_side='left'
+    # tokenizer.pad_token = tokenizer.eos_token
+    # model.config.pad_token_id = model.config.eos_token_id
+
+    # We resize the embeddings only when necessary to avoid index errors. If you are creating a model from scratch
+    # on a small vocab and want a smaller embedding size, remove this test.
+    embedding_size = model.get_input_embeddings().weight.shape[0]
+    if len(tokenizer) > embedding_size:
+        model.resize_token_embeddings(len(tokenizer))
 
-    logger.info(f"Grouped dataset [max_size={block_size}]:")
-    logger.info(lm_datasets)
+    if data_args.pack_sequences:
+        # Fail before training rather than silently attending across packed samples
+        check_attn_implementation(model)
+        # seq_lens is consumed by the collator, not the model
+        training_args.remove_unused_columns = False
+        data_collator = DataCollatorForPackedSequences(
+            pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0,
+            dtype=model.dtype
+        )
+    else:
+        data_collator = default_data_collator
     
     logger.info(torch.cuda.memory_summary())   
 
     if training_args.do_train:
         
-        if "train" not in tokenized_datasets:
+        if "train" not in lm_datasets:
             raise ValueError("--do_train requires a train dataset")
         train_dataset = lm_datasets["train"]
-        if data_args.max_train_samples is not None:
+        if data_args.streaming:
+            if training_args.max_steps <= 0:
+                raise ValueError("--streaming requires --max_steps, since the train dataset has no length")
+            if data_args.max_train_samples is not None:
+                train_dataset = train_dataset.take(data_args.max_train_samples)
+        elif data_args.max_train_samples is not None:
             max_train_samples = min(len(train_dataset), data_args.max_train_samples)
-            train_dataset = train_dataset.select(range(max_train_samples))
+            if use_token_files:
+                train_dataset = torch.utils.data.Subset(train_dataset, range(max_train_samples))
+            else:
+                train_dataset = train_dataset.select(range(max_train_samples))
 
     if training_args.do_eval:
-        if "validation" not in tokenized_datasets:
+        if "validation" not in lm_datasets:
             raise ValueError("--do_eval requires a validation dataset")
         eval_dataset = lm_datasets["validation"]
-        if data_args.max_eval_samples is not None:
+        if data_args.streaming:
+            if data_args.max_eval_samples is not None:
+                eval_dataset = eval_dataset.take(data_args.max_eval_samples)
+        elif data_args.max_eval_samples is not None:
             max_eval_samples = min(len(eval_dataset), data_args.max_eval_samples)
-            eval_dataset = eval_dataset.select(range(max_eval_samples))
+            if use_token_files:
+                eval_dataset = torch.utils.data.Subset(eval_dataset, range(max_eval_samples))
+            else:
+                eval_dataset = eval_dataset.select(range(max_eval_samples))
 
         def preprocess_logits_for_metrics(logits, labels):
             if isinstance(logits, tuple):
@@ -687,15 +903,16 @@ def main():
             preds = preds[:, :-1].reshape(-1)
             return metric.compute(predictions=preds, references=labels)
 
-    # Initialize our Trainer
-    trainer = Trainer(
+    # Initialize our Trainer. Streaming datasets shard themselves across ranks, so they bypass accelerate's sharding.
+    trainer_cls = StreamingTrainer if data_args.streaming else Trainer
+    trainer = trainer_cls(
         model=model,
         args=training_args,
         train_dataset=train_dataset if training_args.do_train else None,
         eval_dataset=eval_dataset if training_args.do_eval else None,
         tokenizer=tokenizer,
         # Data collator will default to DataCollatorWithPadding, so we change it.
-        data_collator=default_data_collator,
+        data_collator=data_collator,
         compute_metrics=compute_metrics if training_args.do_eval and not is_torch_tpu_available() else None,
         preprocess_logits_for_metrics=preprocess_logits_for_metrics
         if training_args.do_eval and not is_torch_tpu_available()
@@ -714,10 +931,11 @@ def main():
 
         metrics = train_result.metrics
 
-        max_train_samples = (
-            data_args.max_train_samples if data_args.max_train_samples is not None else len(train_dataset)
-        )
-        metrics["train_samples"] = min(max_train_samples, len(train_dataset))
+        if not data_args.streaming:
+            max_train_samples = (
+                data_args.max_train_samples if data_args.max_train_samples is not None else len(train_dataset)
+            )
+            metrics["train_samples"] = min(max_train_samples, len(train_dataset))
 
         trainer.log_metrics("train", metrics)
         trainer.save_metrics("train", metrics)
@@ -729,8 +947,9 @@ def main():
 
         metrics = trainer.evaluate()
 
-        max_eval_samples = data_args.max_eval_samples if data_args.max_eval_samples is not None else len(eval_dataset)
-        metrics["eval_samples"] = min(max_eval_samples, len(eval_dataset))
+        if not data_args.streaming:
+            max_eval_samples = data_args.max_eval_samples if data_args.max_eval_samples is not None else len(eval_dataset)
+            metrics["eval_samples"] = min(max_eval_samples, len(eval_dataset))
         try:
             perplexity = math.exp(metrics["eval_loss"])
         except OverflowError:
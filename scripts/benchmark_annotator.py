@@ -0,0 +1,89 @@
+"""
+Benchmark utils.annotator.Dataset saved as a memory-mapped Arrow IPC file against the
+previous pickled dict of columns, on a synthetic corpus of NLP++ passes. Measures
+saving, opening, random indexing, slicing and conversion to a datasets.Dataset, and
+checks that both give the same samples.
+
+E.g. python -m scripts.benchmark_annotator --num_samples 1000000
+"""
+import os
+import time
+import pickle
+import random
+import tempfile
+from argparse import ArgumentParser
+import typing
+from typing import Dict, List
+
+import datasets # Imported up front, so that to_hf_dataset is timed without the import
+
+from utils.annotator import Dataset
+
+
+def make_samples(num_samples: int, seed: int=0) -> List[str]:
+    rng = random.Random(seed)
+    return [
+        f"# FILE: pass{i}.nlp\n@NODES _ROOT\n\n@RULES\n"
+        + "".join(f"_xNIL <- _xWILD [one match=(word{rng.randrange(10**6)})] @@\n" for _ in range(rng.randint(1, 8)))
+        for i in range(num_samples)
+    ]
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return result, time.perf_counter() - start
+
+
+def get_args():
+    arg_parser = ArgumentParser(description = "Benchmark utils.annotator.Dataset save/load and access.")
+    arg_parser.add_argument("--num_samples", type=int, default=1000000, help="Number of synthetic samples.")
+    arg_parser.add_argument("--num_reads", type=int, default=10000, help="Number of random single sample reads.")
+    arg_parser.add_argument("--tmp_dir", type=str, default=None, help="Where to write the saved datasets.")
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    texts = make_samples(args.num_samples)
+    columns = {"text": texts, "source": [f"analyzer{i % 100}" for i in range(args.num_samples)]}
+    indices = random.Random(1).sample(range(args.num_samples), min(args.num_reads, args.num_samples))
+    mid = args.num_samples // 2
+
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        pickle_path = os.path.join(tmp_dir, "dataset.pkl")
+        arrow_path = os.path.join(tmp_dir, "dataset.arrow")
+
+        # Previous format: the pickled dict of columns
+        def save_pickle():
+            with open(pickle_path, "wb") as f:
+                pickle.dump({"_dataset": columns, "text_column_name": "text"}, f)
+        def load_pickle():
+            with open(pickle_path, "rb") as f:
+                return pickle.load(f)["_dataset"]
+        _, pickle_save_time = timed(save_pickle)
+        legacy, pickle_load_time = timed(load_pickle)
+        legacy_rows, pickle_read_time = timed(lambda: [{k: v[i] for k, v in legacy.items()} for i in indices])
+
+        _, arrow_save_time = timed(Dataset(columns).save_dataset, arrow_path)
+        dataset, arrow_load_time = timed(Dataset.load_dataset, arrow_path)
+        rows, arrow_read_time = timed(lambda: [dataset[i] for i in indices])
+        window, slice_time = timed(lambda: dataset[mid:mid + 1000])
+        hf_dataset, hf_time = timed(dataset.to_hf_dataset)
+
+        if rows != legacy_rows:
+            raise AssertionError("Random reads differ from the pickled dataset.")
+        if window != {k: v[mid:mid + 1000] for k, v in columns.items()}:
+            raise AssertionError("Slice differs from the pickled dataset.")
+        if len(hf_dataset) != args.num_samples or hf_dataset[mid]["text"] != texts[mid]:
+            raise AssertionError("datasets.Dataset differs from the saved dataset.")
+        pickle_size = os.path.getsize(pickle_path)
+        arrow_size = os.path.getsize(arrow_path)
+
+    print(f"{args.num_samples} samples, pickle {pickle_size / 2**20:.0f}MB, arrow {arrow_size / 2**20:.0f}MB")
+    print(f"                 {'pickle':>10} {'arrow':>10}")
+    print(f"save:            {pickle_save_time:9.3f}s {arrow_save_time:9.3f}s")
+    print(f"open:            {pickle_load_time:9.3f}s {arrow_load_time:9.3f}s")
+    print(f"{len(indices)} reads:     {pickle_read_time:9.3f}s {arrow_read_time:9.3f}s")
+    print(f"1000 row slice:  {'':>10} {slice_time:9.4f}s")
+    print(f"to_hf_dataset:   {'':>10} {hf_time:9.4f}s")
@@ -0,0 +1,114 @@
+"""
+Benchmark continuous batching (utils.batching.BatchScheduler) against unbatched decoding
+(requests take turns, one token at a time), with a tiny randomly initialized Llama on
+CPU. A synthetic load generator sends requests with Poisson arrivals, random prompt
+lengths and completion lengths. Reports p50/p95 latency, time to first token and
+tokens/s, and checks that greedy completions are the same with and without batching.
+
+E.g. python -m scripts.benchmark_batching --num_requests 64 --rate 20 --max_batch_size 8
+"""
+import time
+import random
+import threading
+import statistics
+from argparse import ArgumentParser
+import typing
+from typing import Dict, List, Tuple
+
+
+from utils.completion import CompletionEngine, build_tiny_model, nlp_pp_samples
+
+
+def make_load(num_requests: int, rate: float, max_new_tokens: int, seed: int=0) -> List[Tuple[float, str, int]]:
+    """
+    (arrival time, prompt, max_new_tokens) of num_requests requests arriving at rate per second.
+    """
+    rng = random.Random(seed)
+    samples = nlp_pp_samples(num_requests, seed=seed + 1)
+    load, t = [], 0.0
+    for sample in samples:
+        t += rng.expovariate(rate)
+        load.append((t, sample[:rng.randint(20, len(sample))], rng.randint(max_new_tokens // 4, max_new_tokens)))
+    return load
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def run_load(engine: CompletionEngine, load: List[Tuple[float, str, int]]) -> Tuple[List[str], Dict[str, float]]:
+    """
+    Send each request of load at its arrival time from its own thread.
+    Returns the completions and latency statistics.
+    """
+    results = [None] * len(load)
+    latencies = [None] * len(load)
+    first_token = [None] * len(load)
+
+    def send(i: int, start: float) -> None:
+        arrival, prompt, max_new_tokens = load[i]
+        time.sleep(max(arrival - (time.perf_counter() - start), 0))
+        submitted = time.perf_counter()
+        token_ids = []
+        for token_id, _ in engine.stream(prompt, max_new_tokens=max_new_tokens):
+            first_token[i] = first_token[i] or time.perf_counter() - submitted
+            token_ids.append(token_id)
+        latencies[i] = time.perf_counter() - submitted
+        results[i] = token_ids
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=send, args=(i, start)) for i in range(len(load))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total_time = time.perf_counter() - start
+
+    n_tokens = sum(len(r) for r in results)
+    return results, {
+        "p50": statistics.median(latencies),
+        "p95": percentile(latencies, 0.95),
+        "ttft_p50": statistics.median(t for t in first_token if t is not None),
+        "ttft_p95": percentile([t for t in first_token if t is not None], 0.95),
+        "tokens_per_s": n_tokens / total_time,
+        "total_time": total_time,
+    }
+
+
+def get_args():
+    arg_parser = ArgumentParser(description = "Benchmark continuous batching with a tiny model on CPU.")
+    arg_parser.add_argument("--num_requests", type=int, default=64, help="Number of requests.")
+    arg_parser.add_argument("--rate", type=float, default=20.0, help="Mean requests per second.")
+    arg_parser.add_argument("--max_new_tokens", type=int, default=64, help="Maximum tokens per completion.")
+    arg_parser.add_argument("--max_batch_size", type=int, default=8, help="Batch size of the batched run.")
+    arg_parser.add_argument("--max_wait", type=float, default=0.005, help="Latency budget to group requests.")
+    arg_parser.add_argument("--hidden_size", type=int, default=128, help="Hidden size of the tiny model.")
+    arg_parser.add_argument("--num_hidden_layers", type=int, default=4, help="Layers of the tiny model.")
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    model, tokenizer = build_tiny_model(hidden_size=args.hidden_size, num_hidden_layers=args.num_hidden_layers)
+    load = make_load(args.num_requests, args.rate, args.max_new_tokens)
+
+    runs = {}
+    for name, max_batch_size in [("unbatched", 1), (f"batched ({args.max_batch_size})", args.max_batch_size)]:
+        engine = CompletionEngine(model, tokenizer, max_batch_size=max_batch_size, max_wait=args.max_wait)
+        runs[name] = run_load(engine, load)
+        if engine.scheduler is not None:
+            runs[name][1]["mean_batch_size"] = engine.scheduler.stats()["mean_batch_size"]
+        engine.close()
+
+    (serial, _), (batched, _) = runs.values()
+    n_same = sum(a == b for a, b in zip(serial, batched))
+    if n_same != len(load):
+        raise AssertionError(f"{len(load) - n_same} of {len(load)} batched completions differ.")
+
+    print(f"{args.num_requests} requests at {args.rate:g}/s, up to {args.max_new_tokens} tokens each")
+    print(f"{'':<16} {'p50':>7} {'p95':>7} {'ttft p50':>9} {'ttft p95':>9} {'tokens/s':>9}")
+    for name, (_, stats) in runs.items():
+        print(f"{name:<16} {stats['p50']:6.2f}s {stats['p95']:6.2f}s {stats['ttft_p50'] * 1000:7.0f}ms "
+              f"{stats['ttft_p95'] * 1000:7.0f}ms {stats['tokens_per_s']:9.0f}"
+              + (f"  (mean batch {stats['mean_batch_size']:.1f})" if "mean_batch_size" in stats else ""))
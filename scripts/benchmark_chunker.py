@@ -0,0 +1,89 @@
+"""
+Micro-benchmark utils.chunking.split_batch_into_chunks against run_clm.split_ids_into_chunks
+on synthetic long documents. Checks that both produce identical chunks.
+
+E.g. python -m scripts.benchmark_chunker --num_docs 8 --doc_len 100000
+"""
+import random
+import time
+from argparse import ArgumentParser
+import typing
+from typing import List, Callable
+
+from run_clm import split_ids_into_chunks
+from utils.chunking import split_batch_into_chunks
+
+CHUNK_SEP_IDS = [25380, 13] # Same as run_clm: 25380=@@ and 13=newline
+
+
+def make_documents(num_docs: int, doc_len: int, vocab_size: int=32000, seed: int=0) -> List[List[int]]:
+    """
+    Random token documents with NLP++-like separator density (a newline every ~12 ids, "@@" every ~300).
+    """
+    rng = random.Random(seed)
+    docs = []
+    for _ in range(num_docs):
+        doc = []
+        for _ in range(doc_len):
+            r = rng.random()
+            if r < 1 / 300:
+                doc.append(CHUNK_SEP_IDS[0])
+            elif r < 1 / 12:
+                doc.append(CHUNK_SEP_IDS[1])
+            else:
+                doc.append(rng.randrange(vocab_size))
+        docs.append(doc)
+    return docs
+
+
+def legacy_chunks(docs: List[List[int]], block_size: int) -> List[List[int]]:
+    """
+    Chunking as previously done in run_clm.group_texts.
+    """
+    chunks = []
+    for doc in docs:
+        if len(doc) <= block_size:
+            chunks.append(doc)
+        else:
+            doc_chunks, _ = split_ids_into_chunks(doc, chunk_size=block_size, split_id=CHUNK_SEP_IDS)
+            chunks += doc_chunks
+    return chunks
+
+
+def vectorized_chunks(docs: List[List[int]], block_size: int) -> List[List[int]]:
+    return split_batch_into_chunks(docs, chunk_size=block_size, split_id=CHUNK_SEP_IDS)
+
+
+def time_fn(fn: Callable, docs: List[List[int]], block_size: int, repeats: int) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(docs, block_size)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def get_args():
+    arg_parser = ArgumentParser(description = "Benchmark token chunking.")
+    arg_parser.add_argument("--num_docs", type=int, default=8, help="Number of synthetic documents.")
+    arg_parser.add_argument("--doc_len", type=int, default=100000, help="Tokens per synthetic document.")
+    arg_parser.add_argument("--block_size", type=int, default=1024, help="Chunk size.")
+    arg_parser.add_argument("--repeats", type=int, default=3, help="Timing repeats (best is reported).")
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    docs = make_documents(args.num_docs, args.doc_len)
+
+    expected = legacy_chunks(docs, args.block_size)
+    actual = vectorized_chunks(docs, args.block_size)
+    if expected != actual:
+        raise AssertionError("Vectorized chunker boundaries differ from split_ids_into_chunks.")
+    print(f"Parity ok: {len(actual)} chunks from {args.num_docs} docs of {args.doc_len} tokens")
+
+    legacy_time = time_fn(legacy_chunks, docs, args.block_size, args.repeats)
+    vectorized_time = time_fn(vectorized_chunks, docs, args.block_size, args.repeats)
+    print(f"split_ids_into_chunks:   {legacy_time:.4f}s")
+    print(f"split_batch_into_chunks: {vectorized_time:.4f}s")
+    print(f"Speedup: {legacy_time / vectorized_time:.1f}x")
@@ -0,0 +1,82 @@
+"""
+Benchmark the throughput of scripts.clean_data on a synthetic NLP++ corpus, for
+several numbers of worker processes. Checks that every run matches the serial output.
+
+E.g. python -m scripts.benchmark_clean_data --num_samples 20000 --num_workers 1 2 4 8
+"""
+import time
+import random
+from argparse import ArgumentParser
+import typing
+from typing import List
+
+from scripts.clean_data import clean_data
+
+NAMES = ["David", "amnon", "Ashton", "elvis", "dave", "Meyers"]
+WORDS = ["noun", "verb", "phrase", "node", "rule", "pass", "match", "token", "line", "zone"]
+
+
+def make_sample(rng: random.Random) -> str:
+    """
+    An NLP++ pass file with a #### header block and comments containing names, dates and urls.
+    """
+    lines = [
+        "###############################################",
+        f"# FILE: {rng.choice(WORDS)}_{rng.randrange(1000)}.pass",
+        f"# SUBJ: {' '.join(rng.choices(WORDS, k=4))}",
+        f"# AUTH: {rng.choice(NAMES)}",
+        f"# CREATED: {rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/{rng.randint(0, 99):02d}",
+        "###############################################",
+        "",
+        "@NODES _ROOT",
+        "",
+        "@RULES",
+    ]
+    for _ in range(rng.randint(5, 60)):
+        r = rng.random()
+        if r < 0.1:
+            lines.append(f"# {' '.join(rng.choices(WORDS, k=5))} - {rng.choice(NAMES)} {rng.randint(1, 12)}/{rng.randint(1, 28)}/{rng.randint(1990, 2020)}")
+        elif r < 0.15:
+            lines.append(f"# see https://www.{rng.choice(WORDS)}.com/{rng.choice(WORDS)} for {rng.choice(WORDS)}")
+        elif r < 0.3:
+            lines.append(f"# {' '.join(rng.choices(WORDS, k=rng.randint(2, 8)))}")
+        elif r < 0.35:
+            lines.append(f"L(\"{rng.choice(WORDS)}\") = N(\"$text\", 1); # {rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/{rng.randint(0, 99):02d} {rng.choice(['AM', 'PM'])}.")
+        else:
+            lines.append(f"_{rng.choice(WORDS)} <- _xWILD [one match=({' '.join(rng.choices(WORDS, k=3))})] @@")
+    sep = "\r\n" if rng.random() < 0.1 else "\n"
+    return sep.join(lines) + sep
+
+
+def make_corpus(num_samples: int, seed: int=0) -> List[str]:
+    rng = random.Random(seed)
+    return [make_sample(rng) for _ in range(num_samples)]
+
+
+def get_args():
+    arg_parser = ArgumentParser(description = "Benchmark clean_data throughput.")
+    arg_parser.add_argument("--num_samples", type=int, default=20000, help="Number of synthetic samples.")
+    arg_parser.add_argument("--num_workers", type=int, nargs="+", default=[1, 2, 4], help="Numbers of processes to time.")
+    arg_parser.add_argument("--chunk_size", type=int, default=256, help="Samples per chunk.")
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    corpus = make_corpus(args.num_samples)
+    n_bytes = sum(len(sample) for sample in corpus)
+    print(f"{len(corpus)} samples, {n_bytes / 1e6:.1f}MB")
+
+    reference = None
+    base_time = None
+    for num_workers in args.num_workers:
+        start = time.perf_counter()
+        data = clean_data(corpus, num_workers=num_workers, chunk_size=args.chunk_size)
+        elapsed = time.perf_counter() - start
+        if reference is None:
+            reference = clean_data(corpus) if num_workers != 1 else data
+        if data != reference:
+            raise AssertionError(f"Output with {num_workers} workers differs from serial output.")
+        base_time = base_time or elapsed * num_workers
+        print(f"{num_workers:>3} workers: {elapsed:.2f}s, {len(corpus) / elapsed:,.0f} samples/s, "
+              f"{n_bytes / elapsed / 1e6:.1f}MB/s, efficiency {base_time / elapsed / num_workers:.0%}")
@@ -0,0 +1,126 @@
+"""
+Benchmark scripts.completion_server against the previous code_gen_demo flow (load the
+model, then model.generate one prompt at a time) with a tiny randomly initialized Llama
+on CPU. Sends concurrent /generate and /generate_stream requests, and checks that greedy
+completions match model.generate. With --sentencepiece the tiny model gets a
+SentencePiece-style tokenizer, as CodeLlama's, which strips the leading space of the
+text it decodes.
+
+E.g. python -m scripts.benchmark_completion_server --num_requests 32 --concurrency 8
+     python -m scripts.benchmark_completion_server --hidden_size 256 --num_hidden_layers 4
+"""
+import json
+import time
+import tempfile
+import statistics
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import typing
+from typing import Dict, List, Tuple
+
+import requests
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from utils.completion import CompletionEngine, load_model, build_tiny_model, nlp_pp_samples
+from scripts.completion_server import CompletionServer
+
+
+def legacy_generate(model_path: str, prompt: str, max_new_tokens: int) -> str:
+    """
+    One code_gen_demo invocation: load the model and tokenizer, then generate. The prompt
+    and completion are decoded together, as code_gen_demo did, and the decoded prompt is
+    cut off.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = AutoModelForCausalLM.from_pretrained(model_path)
+    input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+    generated_ids = model.generate(input_ids, max_new_tokens=max_new_tokens, do_sample=False)
+    prompt_text = tokenizer.decode(input_ids[0], skip_special_tokens=True)
+    return tokenizer.decode(generated_ids[0], skip_special_tokens=True)[len(prompt_text):]
+
+
+def post(base_url: str, prompt: str, max_new_tokens: int) -> Tuple[str, float]:
+    start = time.perf_counter()
+    response = requests.post(base_url + "generate", json={"inputs": prompt, "parameters": {"max_new_tokens": max_new_tokens}})
+    response.raise_for_status()
+    return response.json()["generated_text"], time.perf_counter() - start
+
+
+def post_stream(base_url: str, prompt: str, max_new_tokens: int) -> Tuple[str, float, float]:
+    """
+    Generated text, time to first token and total time of a /generate_stream request.
+    Checks that the streamed tokens add up to the generated text.
+    """
+    start = time.perf_counter()
+    first_token_time = None
+    tokens, generated_text = [], None
+    with requests.post(base_url + "generate_stream", json={"inputs": prompt, "parameters": {"max_new_tokens": max_new_tokens}},
+                       stream=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line.startswith(b"data:"):
+                continue
+            event = json.loads(line[len(b"data:"):])
+            if event["token"] is not None:
+                first_token_time = first_token_time or time.perf_counter() - start
+                tokens.append(event["token"]["text"])
+            else:
+                generated_text = event["generated_text"]
+    if not generated_text.startswith("".join(tokens)):
+        raise AssertionError("Streamed tokens differ from the generated text.")
+    return generated_text, first_token_time, time.perf_counter() - start
+
+
+def get_args():
+    arg_parser = ArgumentParser(description = "Benchmark the completion server with a tiny model on CPU.")
+    arg_parser.add_argument("--num_requests", type=int, default=32, help="Number of completion requests.")
+    arg_parser.add_argument("--concurrency", type=int, default=8, help="Concurrent requests to the server.")
+    arg_parser.add_argument("--max_new_tokens", type=int, default=32, help="Tokens per completion.")
+    arg_parser.add_argument("--hidden_size", type=int, default=64, help="Hidden size of the tiny model.")
+    arg_parser.add_argument("--num_hidden_layers", type=int, default=2, help="Layers of the tiny model.")
+    arg_parser.add_argument("--sentencepiece", action="store_true", help="Give the tiny model a SentencePiece-style tokenizer.")
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    torch.set_num_threads(1)
+    model, tokenizer = build_tiny_model(hidden_size=args.hidden_size, num_hidden_layers=args.num_hidden_layers,
+                                        sentencepiece=args.sentencepiece)
+    prompts = [sample[:sample.index("@@") + 2] + "\n" for sample in nlp_pp_samples(args.num_requests, seed=1)]
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        model.save_pretrained(model_dir)
+        tokenizer.save_pretrained(model_dir)
+
+        start = time.perf_counter()
+        legacy = [legacy_generate(model_dir, prompt, args.max_new_tokens) for prompt in prompts]
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        engine = CompletionEngine(*load_model(model_dir))
+        load_time = time.perf_counter() - start
+
+    with CompletionServer(engine) as server:
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            start = time.perf_counter()
+            results = list(executor.map(lambda p: post(server.base_url, p, args.max_new_tokens), prompts))
+            server_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            streamed = list(executor.map(lambda p: post_stream(server.base_url, p, args.max_new_tokens), prompts))
+            stream_time = time.perf_counter() - start
+
+    if [text for text, _ in results] != legacy or [text for text, _, _ in streamed] != legacy:
+        raise AssertionError("Server completions differ from model.generate.")
+
+    n_tokens = args.num_requests * args.max_new_tokens
+    latencies = sorted(latency for _, latency in results)
+    print(f"{args.num_requests} requests of {args.max_new_tokens} tokens, {args.concurrency} concurrent")
+    print(f"legacy load + generate per prompt:  {legacy_time:.2f}s ({n_tokens / legacy_time:.0f} tokens/s)")
+    print(f"server model load (once):           {load_time:.2f}s")
+    print(f"server /generate:                   {server_time:.2f}s ({n_tokens / server_time:.0f} tokens/s), "
+          f"p50 latency {statistics.median(latencies) * 1000:.0f}ms")
+    print(f"server /generate_stream:            {stream_time:.2f}s, "
+          f"p50 time to first token {statistics.median(t for _, t, _ in streamed) * 1000:.0f}ms")
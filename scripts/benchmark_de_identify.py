@@ -0,0 +1,79 @@
+"""
+Check that scripts.clean_data.de_identify (DeIdentifier) is byte-identical to the
+line by line de_identify_lines on a golden corpus, and time both. The golden corpus
+is the synthetic NLP++ corpus of scripts.benchmark_clean_data plus randomly
+assembled edge cases (unicode whitespace, case-changing characters, date stamps,
+dropped last lines, ...).
+
+E.g. python -m scripts.benchmark_de_identify --num_samples 20000 --num_names 1 1000 5000
+"""
+import time
+import random
+import string
+from argparse import ArgumentParser
+import typing
+from typing import List, Callable
+
+import scripts.clean_data as clean_data
+from scripts.clean_data import DeIdentifier, de_identify_lines, REMOVE_NAMES
+from scripts.benchmark_clean_data import make_corpus
+
+EDGE_TOKENS = [
+    "#", "# ", "  #", "\t#", "12", "1/2/2003", "12:30", "3-4-5", "david", "Elvis", "AMNON", "ashton", "-", " - ",
+    "http://x.com/a", "www.foo.org", "a.comb", "x.edu/y", "HTTPS://Q", "\r", "\x0b", "\x1c", " ", " ",
+    "Σ", "İ", "ς", "ſ", "K", "# 02/12/02 AM.", "#02/12/02 PM.", "#\t01/01/01 AM.",
+    "@@", "word", "longer words here", "\n", "\n", "\n", "",
+]
+
+
+def edge_cases(num_samples: int, seed: int=0) -> List[str]:
+    rng = random.Random(seed)
+    return ["".join(rng.choice(EDGE_TOKENS) for _ in range(rng.randint(0, 30))) for _ in range(num_samples)]
+
+
+def random_names(num_names: int, seed: int=0) -> List[str]:
+    rng = random.Random(seed)
+    names = set(REMOVE_NAMES)
+    while len(names) < num_names:
+        names.add("".join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 9))))
+    return sorted(names)
+
+
+def time_fn(fn: Callable[[str], str], corpus: List[str]) -> float:
+    start = time.perf_counter()
+    for sample in corpus:
+        fn(sample)
+    return time.perf_counter() - start
+
+
+def get_args():
+    arg_parser = ArgumentParser(description = "Check and benchmark de_identify.")
+    arg_parser.add_argument("--num_samples", type=int, default=20000, help="Synthetic NLP++ samples.")
+    arg_parser.add_argument("--num_edge_cases", type=int, default=100000, help="Random edge case samples.")
+    arg_parser.add_argument("--num_names", type=int, nargs="+", default=[len(REMOVE_NAMES), 1000, 5000],
+                            help="Sizes of the name list to time.")
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    corpus = make_corpus(args.num_samples)
+    golden = corpus + edge_cases(args.num_edge_cases)
+
+    for num_names in args.num_names:
+        names = random_names(num_names)
+        de_identifier = DeIdentifier(names)
+        # de_identify_lines reads the module level name list
+        clean_data.REMOVE_NAMES = names
+        try:
+            mismatches = [sample for sample in golden if de_identifier(sample) != de_identify_lines(sample)]
+            if mismatches:
+                raise AssertionError(f"{len(mismatches)} mismatches with {num_names} names, e.g. {mismatches[0]!r}")
+
+            legacy_time = time_fn(de_identify_lines, corpus)
+            compiled_time = time_fn(de_identifier, corpus)
+        finally:
+            clean_data.REMOVE_NAMES = REMOVE_NAMES
+        print(f"{num_names:>5} names: identical on {len(golden)} golden samples. "
+              f"de_identify_lines {legacy_time:.2f}s, DeIdentifier {compiled_time:.2f}s, "
+              f"speedup {legacy_time / compiled_time:.1f}x")
@@ -0,0 +1,208 @@
+"""
+Benchmark the processing of scripts.scrape_viztext (clean_records, add_prompts and
+flatten, as run by run) against the previous per-record dict implementation on
+synthetic help page records with heterogeneous fields. Checks that they give the same
+columns.
+
+E.g. python -m scripts.benchmark_flatten --num_records 100000 --num_extra_fields 20
+"""
+import os
+import time
+import copy
+import gc
+import random
+import tempfile
+import logging
+from argparse import ArgumentParser
+import typing
+from typing import Dict, List
+
+from scripts.scrape_viztext import flatten, save_columns, clean_records, add_prompts
+
+
+def make_records(num_records: int, num_extra_fields: int=20, field_prop: float=0.3, seed: int=0) -> Dict[str, Dict]:
+    """
+    Records shaped like scraped help pages (example, title, purpose), each with a random
+    subset (field_prop) of num_extra_fields extra fields.
+    """
+    rng = random.Random(seed)
+    records = {}
+    for i in range(num_records):
+        first = rng.choice([
+            f"# Match word{i} and name the node\n@NODES _ROOT",
+            f"In this example, we define a function to find word{i}.",
+            "@NODES _ROOT",
+        ])
+        example = [first] + [
+            f"_xNIL <- _xWILD [one match=(word{rng.randrange(10**6)})] @@\n@@RULES{{\nIf(x)\nG(\"a\") = 1;\n}}"
+            for _ in range(rng.randint(1, 5))
+        ]
+        purpose = [rng.choice(["Obsolete.", f"Find word{i} in the parse tree.", "Get the node text."])]
+        record = {"example": example, "title": f"fn{i}", "purpose": purpose}
+        for f in range(num_extra_fields):
+            if rng.random() < field_prop:
+                record[f"field{f}"] = rng.choice([f"value{i}", [f"line{i}", "line"]])
+        records[f"https://example.com/help/fn{i}.htm"] = record
+    return records
+
+
+def legacy_clean_examples(example_dict: Dict[str, Dict[str,str]]) -> Dict[str, Dict[str,str]]:
+    clean_dict = {}
+    for k, v in example_dict.items():
+        raw_text = v["example"]
+        clean_text = []
+        for i, line in enumerate(raw_text):
+            if i == 0 and ";" not in line and "@@" not in line and " = " not in line and not line.lstrip().startswith("#"):
+                line = line.replace("\n", " ").replace("  ", " ")
+
+            new_line = line.replace("If(", "if(").replace("While(", "while(")
+            new_line = new_line.replace("\n<<", " <<").replace("  <<", " <<")
+
+            if "{" in new_line:
+                pre_brack, post_brack = new_line.split("{", 1)
+                if "}" in post_brack:
+                    interior, exterior = post_brack.split("}", 1)
+                    interior = interior.replace("\n", "\n\t").replace('\\n\t', "\\n")
+                    if interior.endswith("\t"):
+                        interior = interior[:-1]
+                    new_line = pre_brack + "{" + interior + "}" + exterior
+
+            clean_text.append(new_line)
+
+        v["example"] = clean_text
+        clean_dict[k] = v
+    return clean_dict
+
+
+def legacy_get_prompts(example_dict: Dict[str, Dict[str,str]]) -> Dict[str, Dict[str,str]]:
+    formatted_dict = {}
+    for k, v in example_dict.items():
+        example = v["example"]
+        prompt = []
+        purpose = v["purpose"] if "purpose" in v else None
+        if purpose is not None and "".join(v["purpose"]).lower().startswith("obsolete"):
+            continue
+
+        if example == [] or example == '':
+            continue
+
+        first_line = example[0]
+        if first_line.strip().startswith("#"):
+            sublines = first_line.split("\n")
+            for l in sublines:
+                if l.startswith("#"):
+                    prompt.append(l)
+                else:
+                    break
+            for x in prompt:
+                sublines.remove(x)
+            example = sublines
+        elif ";" not in first_line and "<-" not in first_line and " = " not in first_line and "@" not in first_line:
+            prompt.append(first_line)
+            example = example[1:]
+        else:
+            if "purpose" in v:
+                prompt.append(v["purpose"])
+
+        if prompt != []:
+            prompt = [" ".join(p) if isinstance(p, list) else p for p in prompt]
+            prompt = ". ".join(prompt).replace("#", "").replace("  ", " ").strip()
+
+            if "," in prompt:
+                pre, post = prompt.split(",",1)
+                if len(pre) < 20:
+                    prompt = post.strip()
+            if prompt.lower().startswith("we "):
+                prompt = prompt[3:]
+
+            prompt = "# " + prompt
+            v["prompt"] = prompt
+
+        v["example"] = "\n".join(example)
+        formatted_dict[k] = v
+    return formatted_dict
+
+
+def legacy_flatten(data_dict: Dict[str, Dict[str,str]], key_col_name: str="url", null_val=None) -> Dict[str, List[str]]:
+    """
+    flatten as previously implemented: appends to every column and re-checks every
+    column length per record.
+    """
+    flattened = {}
+    first_iter = True
+    for k, v in data_dict.items():
+        if first_iter:
+            flattened[key_col_name] = [k]
+        else:
+            flattened[key_col_name].append(k)
+
+        col_length = len(flattened[key_col_name])
+        for field, val in v.items():
+            if isinstance(val, list):
+                clean_val = "\n".join(val)
+            else:
+                clean_val = val
+            if first_iter:
+                flattened[field] = [clean_val]
+            else:
+                if field not in flattened:
+                    col = [null_val] * col_length
+                    col[-1] = clean_val
+                    flattened[field] = col
+                else:
+                    flattened[field].append(clean_val)
+
+        if not first_iter:
+            for k, v in flattened.items():
+                if len(v) != col_length:
+                    flattened[k].append(null_val)
+
+        first_iter = False
+    return flattened
+
+
+def get_args():
+    arg_parser = ArgumentParser(description = "Benchmark columnar help page processing.")
+    arg_parser.add_argument("--num_records", type=int, default=100000, help="Number of synthetic records.")
+    arg_parser.add_argument("--num_extra_fields", type=int, default=20, help="Optional fields besides example, title and purpose.")
+    arg_parser.add_argument("--tmp_dir", type=str, default=None, help="Where to write the parquet file.")
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    logging.disable(logging.WARNING)
+    records = make_records(args.num_records, args.num_extra_fields)
+    legacy_records = copy.deepcopy(records)
+    # Keep the collector from rescanning the inputs on every pass, for both implementations
+    gc.freeze()
+
+    start = time.perf_counter()
+    legacy_flat = legacy_flatten(legacy_records)
+    legacy_flatten_time = time.perf_counter() - start
+    start = time.perf_counter()
+    flat = flatten(records)
+    flatten_time = time.perf_counter() - start
+    if legacy_flat != flat or list(legacy_flat) != list(flat):
+        raise AssertionError("flatten differs from the legacy implementation.")
+
+    start = time.perf_counter()
+    legacy = legacy_flatten(legacy_get_prompts(legacy_clean_examples(legacy_records)))
+    legacy_time = time.perf_counter() - start
+    start = time.perf_counter()
+    columns = flatten(add_prompts(clean_records(records)))
+    pipeline_time = time.perf_counter() - start
+    if legacy != columns or list(legacy) != list(columns):
+        raise AssertionError("Processing differs from the legacy implementation.")
+
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        start = time.perf_counter()
+        save_columns(columns, os.path.join(tmp_dir, "viztext.parquet"))
+        parquet_time = time.perf_counter() - start
+
+    print(f"{args.num_records} records, {len(flat)} columns, {len(columns['url'])} with prompts")
+    print(f"legacy flatten:                 {legacy_flatten_time:.2f}s")
+    print(f"columnar flatten:               {flatten_time:.2f}s ({legacy_flatten_time / flatten_time:.1f}x)")
+    print(f"legacy clean/prompts/flatten:   {legacy_time:.2f}s")
+    print(f"clean/prompts/flatten:          {pipeline_time:.2f}s ({legacy_time / pipeline_time:.1f}x)")
+    print(f"write parquet:                  {parquet_time:.2f}s")
@@ -0,0 +1,127 @@
+"""
+Compare token-native grouping (utils.chunking.group_chunks) with the decode and
+re-tokenize path (utils.chunking.retokenize_chunks) on the NLP++ dataset.
+Reports timing for both paths and how many chunks differ. With --tiny it runs offline,
+on synthetic NLP++ passes with the SentencePiece-style tokenizer of
+utils.completion.build_tiny_model, as a stand-in for CodeLlama's.
+
+E.g. python -m scripts.benchmark_grouping --tokenizer_name codellama/CodeLlama-7b-hf
+     python -m scripts.benchmark_grouping --tiny --num_samples 20000
+"""
+import os
+import time
+from argparse import ArgumentParser
+import typing
+from typing import List, Tuple
+
+from datasets import load_dataset, load_from_disk
+from transformers import AutoTokenizer, LlamaTokenizer
+
+from utils.completion import build_tiny_model, nlp_pp_samples
+from utils.chunking import (
+    split_batch_into_chunks,
+    group_chunks,
+    retokenize_chunks,
+    special_token_affixes,
+)
+
+CHUNK_SEP_IDS = [25380, 13] # Same as run_clm: 25380=@@ and 13=newline
+MIN_SEQ_LEN = 10
+
+
+def get_args():
+    arg_parser = ArgumentParser(description = "Benchmark grouping of tokenized texts.")
+    arg_parser.add_argument(
+        "--dataset_name",
+        type=str,
+        default="AshtonIsNotHere/nlp_pp_code_dataset",
+        help="Hub dataset name or path to dataset saved with save_to_disk."
+    )
+    arg_parser.add_argument("--split", type=str, default="train", help="Dataset split to use.")
+    arg_parser.add_argument(
+        "--tokenizer_name",
+        type=str,
+        default="codellama/CodeLlama-7b-hf",
+        help="Pretrained tokenizer name or path."
+    )
+    arg_parser.add_argument("--block_size", type=int, default=1024, help="Chunk size.")
+    arg_parser.add_argument("--batch_size", type=int, default=500, help="Samples per group_texts batch.")
+    arg_parser.add_argument("--tiny", action="store_true", help="Use synthetic passes and a tiny tokenizer, offline.")
+    arg_parser.add_argument("--num_samples", type=int, default=20000, help="Synthetic passes with --tiny.")
+    return arg_parser.parse_args()
+
+
+def load_tokenizer(tokenizer_name: str):
+    # Same tokenizer selection as run_clm
+    if "llama" in tokenizer_name:
+        return LlamaTokenizer.from_pretrained(tokenizer_name)
+    return AutoTokenizer.from_pretrained(tokenizer_name)
+
+
+def load_texts(dataset_name: str, split: str) -> List[str]:
+    if os.path.isdir(dataset_name):
+        dataset = load_from_disk(dataset_name)[split]
+    else:
+        dataset = load_dataset(dataset_name, split=split)
+    column_name = "text" if "text" in dataset.column_names else dataset.column_names[0]
+    return dataset[column_name]
+
+
+def run_path(batches: List[List[List[int]]], group_fn) -> Tuple[List[List[int]], float]:
+    input_ids = []
+    start = time.perf_counter()
+    for batch in batches:
+        input_ids += group_fn(batch)["input_ids"]
+    return input_ids, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.tiny:
+        _, tokenizer = build_tiny_model(sentencepiece=True)
+        texts = nlp_pp_samples(args.num_samples)
+        vocab = tokenizer.get_vocab()
+        chunk_sep_ids = [vocab["@@"], vocab["\n"]]
+    else:
+        tokenizer = load_tokenizer(args.tokenizer_name)
+        texts = load_texts(args.dataset_name, args.split)
+        chunk_sep_ids = CHUNK_SEP_IDS
+    ids = tokenizer(texts)["input_ids"]
+    batches = [ids[i:i + args.batch_size] for i in range(0, len(ids), args.batch_size)]
+    prefix_ids, suffix_ids = special_token_affixes(tokenizer)
+
+    def chunk(batch):
+        return split_batch_into_chunks(batch, chunk_size=args.block_size, split_id=chunk_sep_ids)
+
+    retokenized, retokenize_time = run_path(
+        batches, lambda b: retokenize_chunks(chunk(b), tokenizer, args.block_size, min_seq_len=MIN_SEQ_LEN)
+    )
+    token_native, token_time = run_path(
+        batches, lambda b: group_chunks(chunk(b), args.block_size, min_seq_len=MIN_SEQ_LEN,
+                                        prefix_ids=prefix_ids, suffix_ids=suffix_ids)
+    )
+
+    if len(retokenized) != len(token_native):
+        raise AssertionError(f"Chunk counts differ: {len(retokenized)} vs {len(token_native)}")
+
+    n_differ = 0
+    n_differ_after_bos = 0
+    n_differ_text = 0
+    for a, b in zip(retokenized, token_native):
+        if a != b:
+            n_differ += 1
+            # Retokenizing the decoded first chunk of a document repeats its BOS
+            if a[len(prefix_ids):] != b:
+                n_differ_after_bos += 1
+                # ...and the space decoded after it may come back as a token of its own
+                if (tokenizer.decode(a, skip_special_tokens=True).strip()
+                        != tokenizer.decode(b, skip_special_tokens=True).strip()):
+                    n_differ_text += 1
+
+    print(f"{len(texts)} samples -> {len(token_native)} chunks (block_size={args.block_size})")
+    print(f"Chunks differing from retokenize path: {n_differ} ({100 * n_differ / max(len(token_native), 1):.2f}%)")
+    print(f"  ...excluding repeated BOS: {n_differ_after_bos}")
+    print(f"  ...with different text: {n_differ_text}")
+    print(f"retokenize: {retokenize_time:.2f}s")
+    print(f"tokens:     {token_time:.2f}s")
+    print(f"Speedup: {retokenize_time / token_time:.1f}x")
@@ -0,0 +1,126 @@
+"""
+Benchmark fill-in-the-middle completions (CompletionEngine.infill) against the previous
+code_gen_demo flow (model.generate left to right on the whole text before the cursor)
+over NLP++ files of growing size, with a tiny randomly initialized Llama on CPU. The
+cursor is placed inside a rule in the middle of each file. Checks that an infill prompt
+with a budget over the file size keeps the whole file, with the suffix tokenized without
+a dummy "▁" prefix, and that infill matches model.generate on it. With --sentencepiece
+the tiny model gets a SentencePiece-style tokenizer, as CodeLlama's.
+
+E.g. python -m scripts.benchmark_infill --file_passes 4 16 48 256 --max_input_tokens 1024
+"""
+import time
+import statistics
+from argparse import ArgumentParser
+import typing
+from typing import List, Tuple
+
+import torch
+
+from utils.completion import CompletionEngine, build_tiny_model, nlp_pp_samples
+from utils.infill import FIM_TOKENS, fim_token_ids, encode_suffix, infill_ids
+
+
+def make_file(n_passes: int, seed: int=0) -> Tuple[str, str]:
+    """
+    (prefix, suffix) of a file of n_passes NLP++ passes, split inside a rule of the
+    middle pass.
+    """
+    text = "".join(nlp_pp_samples(n_passes, seed=seed))
+    cursor = text.index(" <- ", len(text) // 2) + len(" <- _xWILD")
+    return text[:cursor], text[cursor:]
+
+
+@torch.no_grad()
+def legacy_generate(model, tokenizer, prefix: str, max_new_tokens: int) -> str:
+    """
+    Left to right completion of the whole text before the cursor, as code_gen_demo did.
+    """
+    input_ids = tokenizer(prefix, return_tensors="pt").input_ids
+    generated_ids = model.generate(input_ids, max_new_tokens=max_new_tokens, do_sample=False)
+    return tokenizer.decode(generated_ids[0, input_ids.shape[1]:], skip_special_tokens=True)
+
+
+def timed(fn, repeat: int) -> float:
+    """
+    Median seconds of repeat calls of fn.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def timed_infill(engine: CompletionEngine, prefix: str, suffix: str, max_new_tokens: int) -> Tuple[float, float, float]:
+    """
+    Seconds to build the trimmed prompt, to the first token and in all of an infill.
+    """
+    start = time.perf_counter()
+    infill_ids(engine.tokenizer, prefix, suffix, engine.max_input_tokens)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    first_token_time = None
+    for _ in engine.stream_infill(prefix, suffix, max_new_tokens=max_new_tokens):
+        first_token_time = first_token_time or time.perf_counter() - start
+    return build_time, first_token_time or time.perf_counter() - start, time.perf_counter() - start
+
+
+def get_args():
+    arg_parser = ArgumentParser(description = "Benchmark infill latency over file size with a tiny model on CPU.")
+    arg_parser.add_argument("--file_passes", type=int, nargs="+", default=[4, 16, 48, 256], help="Passes per file, one run each.")
+    arg_parser.add_argument("--max_input_tokens", type=int, default=1024, help="Token budget of infill prompts.")
+    arg_parser.add_argument("--legacy_max_tokens", type=int, default=4096, help="Skip the legacy flow on longer prefixes (the tiny model's context).")
+    arg_parser.add_argument("--max_new_tokens", type=int, default=16, help="Tokens per completion.")
+    arg_parser.add_argument("--repeat", type=int, default=3, help="Runs per file, the median is reported.")
+    arg_parser.add_argument("--hidden_size", type=int, default=256, help="Hidden size of the tiny model.")
+    arg_parser.add_argument("--num_hidden_layers", type=int, default=4, help="Layers of the tiny model.")
+    arg_parser.add_argument("--sentencepiece", action="store_true", help="Give the tiny model a SentencePiece-style tokenizer.")
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    model, tokenizer = build_tiny_model(hidden_size=args.hidden_size, num_hidden_layers=args.num_hidden_layers,
+                                        special_tokens=list(FIM_TOKENS), sentencepiece=args.sentencepiece)
+    engine = CompletionEngine(model, tokenizer, max_input_tokens=args.max_input_tokens)
+
+    # Over budget, the whole file is kept and infill is plain greedy decoding of the prompt
+    prefix, suffix = make_file(4)
+    prefix_id, suffix_id, middle_id, eot_id = fim_token_ids(tokenizer)
+    prefix_ids = tokenizer(prefix, add_special_tokens=False).input_ids
+    suffix_ids = encode_suffix(tokenizer, suffix)
+    # The suffix tokens spell it exactly, with no dummy "▁" in front
+    suffix_tokens = tokenizer.convert_ids_to_tokens(suffix_ids)
+    spelled = "".join(suffix_tokens).replace("▁", " ") if args.sentencepiece else tokenizer.decode(suffix_ids)
+    if spelled != suffix:
+        raise AssertionError(f"Suffix tokens {suffix_tokens[:4]}... don't spell the suffix.")
+    full_ids = [tokenizer.bos_token_id, prefix_id] + prefix_ids + [suffix_id] + suffix_ids + [middle_id]
+    if infill_ids(tokenizer, prefix, suffix, max_tokens=len(full_ids)) != full_ids:
+        raise AssertionError("Infill prompt within budget differs from the whole file's.")
+    with torch.no_grad():
+        generated_ids = model.generate(torch.tensor([full_ids]), max_new_tokens=args.max_new_tokens, do_sample=False,
+                                       eos_token_id=eot_id)
+    # The middle is decoded following the prefix
+    prefix_text = tokenizer.decode(prefix_ids, skip_special_tokens=True)
+    expected = tokenizer.decode(prefix_ids + generated_ids[0, len(full_ids):].tolist(), skip_special_tokens=True)[len(prefix_text):]
+    if CompletionEngine(model, tokenizer, max_input_tokens=len(full_ids)).infill(prefix, suffix, max_new_tokens=args.max_new_tokens) != expected:
+        raise AssertionError("Infill differs from model.generate.")
+
+    print(f"infill budget {args.max_input_tokens} tokens, {args.max_new_tokens} new tokens, median of {args.repeat} runs")
+    print(f"{'passes':>6} {'prefix tokens':>13} {'legacy total':>12} {'infill prompt':>13} {'infill ttft':>11} {'infill total':>12}")
+    for n_passes in args.file_passes:
+        prefix, suffix = make_file(n_passes)
+        n_prefix = len(tokenizer(prefix).input_ids)
+        if n_prefix <= args.legacy_max_tokens:
+            legacy_time = timed(lambda: legacy_generate(model, tokenizer, prefix, args.max_new_tokens), args.repeat)
+            legacy = f"{legacy_time * 1000:10.0f}ms"
+        else:
+            legacy = f"{'skipped':>12}"
+        build_time, first_token_time, total_time = map(
+            statistics.median, zip(*[timed_infill(engine, prefix, suffix, args.max_new_tokens) for _ in range(args.repeat)])
+        )
+        print(f"{n_passes:6d} {n_prefix:13d} {legacy} {build_time * 1000:11.1f}ms {first_token_time * 1000:9.0f}ms "
+              f"{total_time * 1000:10.0f}ms")
@@ -0,0 +1,100 @@
+"""
+Benchmark utils.data_utils.merge_datasets against the previous set-based merge on
+overlapping synthetic NLP++ sources. Reports time, peak Python heap and Arrow
+output memory (texts of in-memory sources are shared by the set, copied to the
+table), and whether the output order is the same across processes with
+different hash seeds.
+
+E.g. python -m scripts.benchmark_merge_datasets --num_samples 100000 --num_sources 4
+"""
+import os
+import sys
+import time
+import random
+import hashlib
+import tracemalloc
+import subprocess
+from argparse import ArgumentParser
+import typing
+from typing import List, Dict
+
+import pyarrow as pa
+
+from utils.data_utils import merge_datasets
+from scripts.benchmark_clean_data import make_corpus
+
+
+def make_sources(num_samples: int, num_sources: int, overlap: float=0.3, seed: int=0) -> List[List[str]]:
+    """
+    num_sources lists of num_samples texts, each sharing a fraction overlap of its texts with the other sources.
+    """
+    rng = random.Random(seed)
+    corpus = make_corpus(int(num_samples * num_sources * (1 - overlap)) + 1, seed=seed)
+    return [rng.sample(corpus, num_samples) for _ in range(num_sources)]
+
+
+def legacy_merge_datasets(*args) -> Dict[str, List[str]]:
+    """
+    merge_datasets as previously implemented: a set of texts, order not preserved.
+    """
+    merged_data = set()
+    for arg in args:
+        if isinstance(arg, list):
+            merged_data.update(arg)
+        elif isinstance(arg, dict):
+            merged_data.update(list(arg.values()))
+    return {"text": list(merged_data)}
+
+
+def order_digest(texts: List[str]) -> str:
+    return hashlib.blake2b("\0".join(texts).encode(), digest_size=8).hexdigest()
+
+
+def run(merge: str, num_samples: int, num_sources: int) -> Dict:
+    sources = make_sources(num_samples, num_sources)
+    tracemalloc.start()
+    arrow_start = pa.total_allocated_bytes()
+    start = time.perf_counter()
+    if merge == "legacy":
+        merged = legacy_merge_datasets(*sources)
+    else:
+        merged = merge_datasets(*sources)
+    elapsed = time.perf_counter() - start
+    heap_peak = tracemalloc.get_traced_memory()[1]
+    arrow_bytes = pa.total_allocated_bytes() - arrow_start
+    tracemalloc.stop()
+    if merge == "legacy":
+        texts = merged["text"]
+        fingerprint = order_digest(texts)
+    else:
+        texts = merged.column("text").to_pylist()
+        fingerprint = merged.schema.metadata[b"fingerprint"].decode()
+    return {"time": elapsed, "heap_peak": heap_peak, "arrow_bytes": arrow_bytes, "n": len(texts), "order": order_digest(texts), "fingerprint": fingerprint}
+
+
+def run_in_subprocess(merge: str, num_samples: int, num_sources: int, hash_seed: int) -> Dict:
+    code = (
+        "from scripts.benchmark_merge_datasets import run; "
+        f"print(repr(run({merge!r}, {num_samples}, {num_sources})))"
+    )
+    env = dict(os.environ, PYTHONHASHSEED=str(hash_seed))
+    output = subprocess.run([sys.executable, "-c", code], env=env, check=True, capture_output=True, text=True)
+    return eval(output.stdout.strip().splitlines()[-1])
+
+
+def get_args():
+    arg_parser = ArgumentParser(description = "Benchmark merge_datasets.")
+    arg_parser.add_argument("--num_samples", type=int, default=100000, help="Samples per source.")
+    arg_parser.add_argument("--num_sources", type=int, default=4, help="Number of sources.")
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    for merge in ["legacy", "merge_datasets"]:
+        # Memory is measured apart from the sources, which are built before tracing starts
+        results = [run_in_subprocess(merge, args.num_samples, args.num_sources, hash_seed) for hash_seed in [1, 2]]
+        deterministic = results[0]["order"] == results[1]["order"] and results[0]["fingerprint"] == results[1]["fingerprint"]
+        print(f"{merge:>15}: {results[0]['n']} unique samples, {results[0]['time']:.2f}s, "
+              f"Python heap peak {results[0]['heap_peak'] / 1e6:.0f}MB, Arrow output {results[0]['arrow_bytes'] / 1e6:.0f}MB, "
+              f"same order across hash seeds: {deterministic}")
@@ -0,0 +1,88 @@
+"""
+Benchmark utils.near_dedup.MinHashLSH on a synthetic NLP++ corpus with copy-pasted
+pass files: copies of a pass with a different header and a few edited lines.
+Reports throughput, cluster statistics, texts wrongly removed, and the removal
+rate of copies by their exact Jaccard similarity to the original, which should
+follow the LSH S-curve around the threshold.
+
+E.g. python -m scripts.benchmark_near_dedup --num_samples 20000 --copy_prop 0.3 --threshold 0.85
+"""
+import time
+import random
+from argparse import ArgumentParser
+import typing
+from typing import List, Tuple
+
+import numpy as np
+
+from utils.near_dedup import MinHashLSH
+from scripts.benchmark_clean_data import make_corpus, make_sample
+
+
+def make_copies(corpus: List[str], copy_prop: float, edit_prop: float, seed: int=0) -> Tuple[List[str], List[int]]:
+    """
+    Append edited copies of a fraction copy_prop of samples: a new header, and a fraction
+    edit_prop of the other lines replaced. Returns texts and, per text, the index of its original.
+    """
+    rng = random.Random(seed)
+    texts = list(corpus)
+    originals = list(range(len(corpus)))
+    for i in rng.sample(range(len(corpus)), int(copy_prop * len(corpus))):
+        lines = corpus[i].split("\n")
+        header = make_sample(rng).split("\n")[:6]
+        body = [
+            make_sample(rng).split("\n")[-2] if rng.random() < edit_prop else line
+            for line in lines[6:]
+        ]
+        texts.append("\n".join(header + body))
+        originals.append(i)
+    order = list(range(len(texts)))
+    rng.shuffle(order)
+    return [texts[i] for i in order], [originals[i] for i in order]
+
+
+def jaccard(lsh: MinHashLSH, a: str, b: str) -> float:
+    a, b = set(lsh.shingles(a).tolist()), set(lsh.shingles(b).tolist())
+    return len(a & b) / max(len(a | b), 1)
+
+
+def get_args():
+    arg_parser = ArgumentParser(description = "Benchmark MinHash/LSH near-dedup.")
+    arg_parser.add_argument("--num_samples", type=int, default=20000, help="Number of original samples.")
+    arg_parser.add_argument("--copy_prop", type=float, default=0.3, help="Fraction of samples copied.")
+    arg_parser.add_argument("--edit_prop", type=float, default=0.05, help="Fraction of lines edited in a copy.")
+    arg_parser.add_argument("--threshold", type=float, default=0.85, help="Jaccard threshold.")
+    arg_parser.add_argument("--num_perm", type=int, default=128, help="Hash functions per signature.")
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    texts, originals = make_copies(make_corpus(args.num_samples), args.copy_prop, args.edit_prop)
+    lsh = MinHashLSH(threshold=args.threshold, num_perm=args.num_perm)
+
+    start = time.perf_counter()
+    signatures = lsh.signatures(texts)
+    signature_time = time.perf_counter() - start
+    start = time.perf_counter()
+    roots, stats = lsh.clusters(signatures)
+    cluster_time = time.perf_counter() - start
+
+    # Removal rate of copies by their exact Jaccard similarity to the first text of their family
+    first = {}
+    for i, original in enumerate(originals):
+        first.setdefault(original, i)
+    copies = np.array([i for i, original in enumerate(originals) if first[original] != i])
+    similarity = np.array([jaccard(lsh, texts[i], texts[first[originals[i]]]) for i in copies])
+    removed = roots != np.arange(len(texts))
+
+    print(f"{len(texts)} texts ({len(copies)} copies), {int(removed.sum())} removed")
+    print(f"signatures: {signature_time:.2f}s ({len(texts) / signature_time:,.0f} texts/s), "
+          f"clustering: {cluster_time:.2f}s")
+    print(f"removed texts that are not copies: {int(removed.sum() - removed[copies].sum())}")
+    print("Jaccard to original    copies  removed")
+    for low in np.arange(0, 1, 0.05):
+        in_bucket = (similarity >= low) & (similarity < low + 0.05 if low < 0.95 else similarity <= 1)
+        if in_bucket.any():
+            print(f"  [{low:.2f}, {low + 0.05:.2f})    {int(in_bucket.sum()):>6}  {removed[copies[in_bucket]].mean():>6.1%}")
+    print(f"cluster stats: {stats}")
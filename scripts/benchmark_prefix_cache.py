@@ -0,0 +1,87 @@
+"""
+Benchmark the prefix KV cache (utils.prefix_cache.PrefixCache) on simulated editor
+sessions, with a tiny randomly initialized Llama on CPU. Every session types through an
+NLP++ file, requesting a completion of the file up to the cursor every few characters.
+Reports time to first token with and without the cache, its hit rates and memory, and
+checks that greedy completions are the same.
+
+E.g. python -m scripts.benchmark_prefix_cache --num_sessions 4 --file_passes 20
+     python -m scripts.benchmark_prefix_cache --prefix_cache_mb 4   # small budget, evicts
+"""
+import time
+import random
+import statistics
+from argparse import ArgumentParser
+import typing
+from typing import Dict, List, Tuple
+
+from utils.completion import CompletionEngine, build_tiny_model, nlp_pp_samples
+
+
+def make_sessions(num_sessions: int, file_passes: int, num_requests: int, seed: int=0) -> List[str]:
+    """
+    Prompts of num_sessions interleaved editor sessions, each typing through a file of
+    file_passes NLP++ passes from its middle, a few characters per request.
+    """
+    rng = random.Random(seed)
+    sessions = []
+    for s in range(num_sessions):
+        text = "".join(nlp_pp_samples(file_passes, seed=seed + s + 1))
+        cursor = len(text) // 2
+        prompts = []
+        for _ in range(num_requests):
+            cursor = min(cursor + rng.randint(1, 6), len(text))
+            prompts.append(text[:cursor])
+        sessions.append(prompts)
+    return [prompt for step in zip(*sessions) for prompt in step]
+
+
+def time_to_first_token(engine: CompletionEngine, prompts: List[str], max_new_tokens: int) -> Tuple[List[str], List[float]]:
+    completions, ttfts = [], []
+    for prompt in prompts:
+        start = time.perf_counter()
+        ttft, token_ids = None, []
+        for token_id, _ in engine.stream(prompt, max_new_tokens=max_new_tokens):
+            ttft = ttft or time.perf_counter() - start
+            token_ids.append(token_id)
+        completions.append(token_ids)
+        ttfts.append(ttft)
+    return completions, ttfts
+
+
+def get_args():
+    arg_parser = ArgumentParser(description = "Benchmark the prefix KV cache on simulated editor sessions.")
+    arg_parser.add_argument("--num_sessions", type=int, default=4, help="Interleaved editor sessions.")
+    arg_parser.add_argument("--num_requests", type=int, default=25, help="Completion requests per session.")
+    arg_parser.add_argument("--file_passes", type=int, default=20, help="Passes per edited file (file length).")
+    arg_parser.add_argument("--max_new_tokens", type=int, default=8, help="Tokens per completion.")
+    arg_parser.add_argument("--prefix_cache_mb", type=int, default=256, help="Memory budget of the prefix cache.")
+    arg_parser.add_argument("--hidden_size", type=int, default=256, help="Hidden size of the tiny model.")
+    arg_parser.add_argument("--num_hidden_layers", type=int, default=4, help="Layers of the tiny model.")
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    model, tokenizer = build_tiny_model(hidden_size=args.hidden_size, num_hidden_layers=args.num_hidden_layers)
+    prompts = make_sessions(args.num_sessions, args.file_passes, args.num_requests)
+
+    engine = CompletionEngine(model, tokenizer, max_input_tokens=8192)
+    cached_engine = CompletionEngine(model, tokenizer, max_input_tokens=8192, prefix_cache_bytes=args.prefix_cache_mb * 2**20)
+    completions, ttfts = time_to_first_token(engine, prompts, args.max_new_tokens)
+    cached_completions, cached_ttfts = time_to_first_token(cached_engine, prompts, args.max_new_tokens)
+
+    n_same = sum(a == b for a, b in zip(completions, cached_completions))
+    if n_same != len(prompts):
+        raise AssertionError(f"{len(prompts) - n_same} of {len(prompts)} completions differ with the prefix cache.")
+
+    stats = cached_engine.prefix_cache.stats()
+    n_tokens = statistics.mean(len(engine.encode(prompt)) for prompt in prompts)
+    print(f"{len(prompts)} requests from {args.num_sessions} sessions, {n_tokens:.0f} prompt tokens on average")
+    print(f"time to first token, no cache:    p50 {statistics.median(ttfts) * 1000:6.1f}ms  "
+          f"mean {statistics.mean(ttfts) * 1000:6.1f}ms")
+    print(f"time to first token, prefix cache: p50 {statistics.median(cached_ttfts) * 1000:6.1f}ms  "
+          f"mean {statistics.mean(cached_ttfts) * 1000:6.1f}ms")
+    print(f"hit rate {stats['hit_rate']:.1%}, token hit rate {stats['token_hit_rate']:.1%}, "
+          f"{stats['bytes'] / 2**20:.1f}MB in {stats['nodes']} nodes, {stats['evicted']} evicted "
+          f"(budget {args.prefix_cache_mb}MB)")
@@ -0,0 +1,104 @@
+"""
+Benchmark utils.data_utils.scrape_dir against the previous rglob + serial read
+implementation on a synthetic tree of NLP++ analyzer checkouts. Checks that both
+keep the same set of unique texts.
+
+E.g. python -m scripts.benchmark_scrape_dir --num_files 100000
+"""
+import os
+import time
+import random
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from pathlib import Path
+import typing
+from typing import Dict, List
+
+from utils.data_utils import scrape_dir
+
+
+def make_tree(root: str, num_files: int, files_per_dir: int=50, dup_prop: float=0.2, seed: int=0) -> None:
+    """
+    analyzer{a}/spec/{d}/pass{f}.nlp files, plus a .txt and a .dict file per directory.
+    A fraction dup_prop of passes duplicates an earlier pass.
+    """
+    rng = random.Random(seed)
+    texts = []
+    for i in range(num_files):
+        d = i // files_per_dir
+        dir_path = os.path.join(root, f"analyzer{d // 20}", "spec", f"{d % 20}")
+        if i % files_per_dir == 0:
+            os.makedirs(dir_path)
+            with open(os.path.join(dir_path, "notes.txt"), "w") as f:
+                f.write(f"notes {d}\n")
+            with open(os.path.join(dir_path, "words.dict"), "w") as f:
+                f.write(f"word{d} pos=noun\n")
+
+        if texts and rng.random() < dup_prop:
+            text = rng.choice(texts)
+        else:
+            text = (
+                f"###############################################\n# FILE: pass{i}.nlp\n"
+                f"###############################################\n\n@NODES _ROOT\n\n@RULES\n"
+                + "".join(f"_xNIL <- _xWILD [one match=(word{rng.randrange(10**6)})] @@\n" for _ in range(rng.randint(2, 20)))
+            )
+            texts.append(text)
+        with open(os.path.join(dir_path, f"pass{i % files_per_dir}.nlp"), "w") as f:
+            f.write(text)
+
+
+def legacy_scrape_dir(dir_path: str, file_endings: List[str]) -> Dict[str, str]:
+    """
+    scrape_dir as previously implemented: rglob, serial reads, text-keyed dedup.
+    """
+    file_paths = []
+    for ending in file_endings:
+        file_paths += list(Path(dir_path).rglob("*." + ending.lstrip(".")))
+
+    data = {}
+    for path in file_paths:
+        path = str(path)
+        with open(path, "r") as f:
+            text = f.read()
+            if text not in data:
+                data[text] = path
+    return {v: k for k, v in data.items()}
+
+
+def get_args():
+    arg_parser = ArgumentParser(description = "Benchmark scrape_dir on a synthetic tree.")
+    arg_parser.add_argument("--num_files", type=int, default=100000, help="Number of .nlp files.")
+    arg_parser.add_argument("--max_workers", type=int, default=16, help="Threads of scrape_dir.")
+    arg_parser.add_argument("--mmap_threshold", type=int, default=None, help="Memory map files of at least this many bytes.")
+    arg_parser.add_argument("--tmp_dir", type=str, default=None, help="Where to create the synthetic tree.")
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    root = tempfile.mkdtemp(dir=args.tmp_dir)
+    try:
+        start = time.perf_counter()
+        make_tree(root, args.num_files)
+        print(f"Created {args.num_files} files in {time.perf_counter() - start:.1f}s")
+
+        start = time.perf_counter()
+        legacy = legacy_scrape_dir(root, ["nlp"])
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        data = scrape_dir(root, file_endings=["nlp"], max_workers=args.max_workers,
+                          mmap_threshold=args.mmap_threshold)
+        new_time = time.perf_counter() - start
+    finally:
+        shutil.rmtree(root)
+
+    if set(legacy.values()) != set(data.values()) or len(legacy) != len(data):
+        raise AssertionError("scrape_dir kept different texts than the legacy implementation.")
+    if not all(path.endswith(".nlp") for path in data):
+        raise AssertionError("scrape_dir returned files not matching the suffix filter.")
+    print(f"{len(data)} unique files")
+    print(f"legacy rglob + serial read:    {legacy_time:.2f}s")
+    print(f"scrape_dir ({args.max_workers:>2} workers):      {new_time:.2f}s")
+    print(f"Speedup: {legacy_time / new_time:.1f}x")
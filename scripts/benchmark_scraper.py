@@ -0,0 +1,311 @@
+"""
+Benchmark utils.scraper.GitHubScraper against a local fake GitHub API that
+simulates network latency. No GitHub token or network access is needed.
+
+E.g. python -m scripts.benchmark_scraper --num_repos 4 --files_per_repo 100 --latency 0.05
+     python -m scripts.benchmark_scraper --num_users 4 --num_repos 150 --files_per_repo 2
+
+Add --rate_limit/--window to make the fake API enforce a GitHub-style rate limit
+(X-RateLimit-* headers, 403 once exhausted) and --error_rate to inject 502 and
+429 (Retry-After) responses, e.g.
+    python -m scripts.benchmark_scraper --rate_limit 150 --window 2 --error_rate 0.02
+
+Add --blob_cache to also re-scrape with a warm blob cache (see utils.blob_store),
+after changing --changed_files files of the fake API. Add --response_cache to make
+those scrapes use conditional requests (see utils.response_cache), the fake API
+serves ETags and answers If-None-Match with 304s that don't count against its rate limit.
+"""
+import os
+import json
+import math
+import time
+import random
+import base64
+import hashlib
+import tempfile
+import threading
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import typing
+from typing import Dict, List, Tuple, Optional
+
+from utils.scraper import GitHubScraper
+
+
+class _Server(ThreadingHTTPServer):
+    # The default listen backlog of 5 drops connections opened by many workers at once
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class FakeGitHubAPI:
+    """
+    Minimal stand-in for the GitHub REST endpoints used by GitHubScraper:
+        /users/{user}/repos
+        /repos/{user}/{repo}/git/trees/{sha}?recursive=1
+        /repos/{user}/{repo}/git/blobs/{sha}
+    Every response is delayed by latency seconds.
+
+    With rate_limit, at most rate_limit requests are served per window seconds. Responses
+    carry X-RateLimit-* headers and requests over the limit get 403 responses, like GitHub.
+    A fraction error_rate of requests fails with 502, or 429 with Retry-After.
+    """
+    def __init__(
+        self,
+        users: List[str],
+        num_repos: int=4,
+        files_per_repo: int=100,
+        latency: float=0.05,
+        rate_limit: Optional[int]=None,
+        window: float=60.0,
+        error_rate: float=0.0,
+        seed: int=0
+    ):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.window = window
+        self.error_rate = error_rate
+        self.n_requests = 0
+        self.n_rejected = 0
+        self.n_not_modified = 0
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self._window_end = time.time() + window
+        self._used = 0
+        self.repos = {user: [f"repo{r}" for r in range(num_repos)] for user in users}
+        self.trees = {}
+        self.blobs = {}
+        for user, repos in self.repos.items():
+            for repo in repos:
+                tree = []
+                for f in range(files_per_repo):
+                    text = f"# {user}/{repo} pass {f}\n@NODES _ROOT\n@RULES\n_xNIL <- _xWILD [one match=(file{f})] @@\n"
+                    sha = self.git_blob_sha(text)
+                    self.blobs[sha] = text
+                    tree.append({"path": f"spec/pass{f}.nlp", "type": "blob", "sha": sha})
+                self.trees[(user, repo)] = tree
+
+        self.server = _Server(("127.0.0.1", 0), self._handler())
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @staticmethod
+    def git_blob_sha(text: str) -> str:
+        data = text.encode()
+        return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+    def change_files(self, n: int) -> None:
+        """
+        Give the first n files of every repo new content (and so a new blob sha).
+        """
+        with self._lock:
+            for tree in self.trees.values():
+                for item in tree[:n]:
+                    text = self.blobs[item["sha"]] + "# changed\n"
+                    item["sha"] = self.git_blob_sha(text)
+                    self.blobs[item["sha"]] = text
+
+    def __enter__(self) -> "FakeGitHubAPI":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def admit(self, not_modified: bool=False) -> Tuple[int, Dict[str, str], Optional[dict]]:
+        """
+        Apply the rate limit and error injection to a request. Not modified (304) responses aren't counted.
+        Returns the status, rate limit headers and an error body (None if the request is served).
+        """
+        with self._lock:
+            self.n_requests += 1
+            self.n_not_modified += not_modified
+            if self.error_rate > 0 and self._rng.random() < self.error_rate:
+                self.n_rejected += 1
+                if self._rng.random() < 0.5:
+                    return 502, {}, {"message": "Server Error"}
+                return 429, {"Retry-After": "1"}, {"message": "You have exceeded a secondary rate limit."}
+            if self.rate_limit is None:
+                return 200, {}, None
+
+            now = time.time()
+            if now >= self._window_end:
+                self._window_end = now + self.window
+                self._used = 0
+            served = not_modified or self._used < self.rate_limit
+            self._used += served and not not_modified
+            headers = {
+                "X-RateLimit-Limit": str(self.rate_limit),
+                "X-RateLimit-Remaining": str(self.rate_limit - self._used),
+                "X-RateLimit-Reset": str(math.ceil(self._window_end)),
+            }
+            if not served:
+                self.n_rejected += 1
+                return 403, headers, {"message": "API rate limit exceeded"}
+            return 200, headers, None
+
+    def route(self, path: str) -> Tuple[int, object, Dict[str, str]]:
+        """
+        Status, body and extra headers (Link for paginated listings) of a GET path.
+        """
+        url = urlparse(path)
+        parts = [p for p in url.path.split("/") if p]
+        if len(parts) == 3 and parts[0] == "users" and parts[2] == "repos":
+            user = parts[1]
+            repos = [
+                {
+                    "name": repo,
+                    "url": self.base_url + f"repos/{user}/{repo}",
+                    "trees_url": self.base_url + f"repos/{user}/{repo}/git/trees{{/sha}}",
+                    "default_branch": "main",
+                    "fork": False,
+                    "private": False,
+                    "size": 1,
+                }
+                for repo in self.repos.get(user, [])
+            ]
+            return self.paginate(f"users/{user}/repos", repos, parse_qs(url.query))
+        if len(parts) == 6 and parts[0] == "repos" and parts[3] == "git" and parts[4] == "trees":
+            tree = self.trees.get((parts[1], parts[2]))
+            if tree is None:
+                return 404, {"message": "Not Found"}, {}
+            return 200, {"tree": [
+                dict(item, url=self.base_url + f"repos/{parts[1]}/{parts[2]}/git/blobs/{item['sha']}")
+                for item in tree
+            ]}, {}
+        if len(parts) == 6 and parts[0] == "repos" and parts[3] == "git" and parts[4] == "blobs":
+            text = self.blobs.get(parts[5])
+            if text is None:
+                return 404, {"message": "Not Found"}, {}
+            return 200, {"sha": parts[5], "content": base64.b64encode(text.encode()).decode()}, {}
+        return 404, {"message": "Not Found"}, {}
+
+    def paginate(self, path: str, items: list, query: Dict[str, List[str]]) -> Tuple[int, list, Dict[str, str]]:
+        """
+        One page of items, GitHub style: ?per_page= (default 30, max 100) and ?page= (from 1),
+        with a Link header to the next and last pages.
+        """
+        per_page = min(int(query.get("per_page", ["30"])[0]), 100)
+        page = int(query.get("page", ["1"])[0])
+        n_pages = max(math.ceil(len(items) / per_page), 1)
+        links = []
+        if page < n_pages:
+            links.append(f'<{self.base_url}{path}?per_page={per_page}&page={page + 1}>; rel="next"')
+            links.append(f'<{self.base_url}{path}?per_page={per_page}&page={n_pages}>; rel="last"')
+        headers = {"Link": ", ".join(links)} if links else {}
+        return 200, items[(page - 1) * per_page:page * per_page], headers
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                time.sleep(api.latency)
+                status, body, route_headers = api.route(self.path)
+                payload = json.dumps(body).encode()
+                etag = '"' + hashlib.sha1(payload).hexdigest() + '"' if status == 200 else None
+                not_modified = etag is not None and self.headers.get("If-None-Match") == etag
+
+                error_status, headers, error = api.admit(not_modified)
+                if error is not None:
+                    status, payload, etag = error_status, json.dumps(error).encode(), None
+                elif not_modified:
+                    status, payload = 304, b""
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                if error is None:
+                    for key, value in route_headers.items():
+                        self.send_header(key, value)
+                if etag is not None:
+                    self.send_header("ETag", etag)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def get_args():
+    arg_parser = ArgumentParser(description = "Benchmark GitHubScraper against a local fake API.")
+    arg_parser.add_argument("--num_users", type=int, default=1, help="Number of fake users.")
+    arg_parser.add_argument("--num_repos", type=int, default=4, help="Repos per user.")
+    arg_parser.add_argument("--files_per_repo", type=int, default=100, help=".nlp files per repo.")
+    arg_parser.add_argument("--latency", type=float, default=0.05, help="Seconds of latency per request.")
+    arg_parser.add_argument("--max_workers", type=int, default=16, help="Concurrency of the concurrent run.")
+    arg_parser.add_argument("--rate_limit", type=int, default=None, help="Requests allowed per window (default unlimited).")
+    arg_parser.add_argument("--window", type=float, default=60.0, help="Seconds per rate limit window.")
+    arg_parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of requests answered with 502/429.")
+    arg_parser.add_argument("--blob_cache", action="store_true", help="Also benchmark re-scraping with a warm blob cache.")
+    arg_parser.add_argument("--response_cache", action="store_true", help="Use conditional requests in the blob cache runs.")
+    arg_parser.add_argument("--changed_files", type=int, default=5, help="Files per repo changed before re-scraping.")
+    return arg_parser.parse_args()
+
+
+def run_scrape(
+    base_url: str,
+    users: List[str],
+    max_workers: int,
+    blob_cache: Optional[str]=None,
+    response_cache: Optional[str]=None
+) -> Tuple[List[str], float, Dict]:
+    scraper = GitHubScraper(base_url=base_url, use_tqdm=False, max_workers=max_workers,
+                            backoff_factor=0.05, blob_cache=blob_cache, response_cache=response_cache)
+    start = time.perf_counter()
+    data = scraper.scrape(users, file_endings="nlp", remove_duplicates=False)
+    stats = scraper.scheduler.stats()
+    if scraper.response_cache is not None:
+        stats["response_cache"] = scraper.response_cache.stats()
+    return data, time.perf_counter() - start, stats
+
+
+if __name__ == '__main__':
+    args = get_args()
+    users = [f"user{u}" for u in range(args.num_users)]
+    n_files = args.num_users * args.num_repos * args.files_per_repo
+    with FakeGitHubAPI(users, args.num_repos, args.files_per_repo, args.latency,
+                       rate_limit=args.rate_limit, window=args.window, error_rate=args.error_rate) as api:
+        serial, serial_time, serial_stats = run_scrape(api.base_url, users, max_workers=1)
+        concurrent, concurrent_time, concurrent_stats = run_scrape(api.base_url, users, max_workers=args.max_workers)
+        n_rejected = api.n_rejected
+
+        if args.blob_cache:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                blob_cache = os.path.join(tmp_dir, "blobs.sqlite")
+                response_cache = os.path.join(tmp_dir, "responses.sqlite") if args.response_cache else None
+                _, cold_time, cold_stats = run_scrape(api.base_url, users, args.max_workers, blob_cache, response_cache)
+                api.change_files(args.changed_files)
+                n_not_modified = api.n_not_modified
+                warm, warm_time, warm_stats = run_scrape(api.base_url, users, args.max_workers, blob_cache, response_cache)
+                n_not_modified = api.n_not_modified - n_not_modified
+                fresh, _, _ = run_scrape(api.base_url, users, args.max_workers)
+            if warm != fresh:
+                raise AssertionError("Re-scrape with blob cache differs from scrape without it.")
+
+    if len(serial) != n_files or len(concurrent) != n_files:
+        raise AssertionError(f"Lost files: expected {n_files}, got {len(serial)} serial and {len(concurrent)} concurrent.")
+    if serial != concurrent:
+        raise AssertionError("Concurrent scrape output differs from serial scrape.")
+    print(f"Scraped {len(concurrent)} files ({args.latency * 1000:.0f}ms latency per request)")
+    if args.rate_limit is not None or args.error_rate > 0:
+        print(f"Fake API rejected {n_rejected} requests (rate limit {args.rate_limit} per {args.window:g}s, "
+              f"error rate {args.error_rate:g})")
+    print(f"serial:                 {serial_time:.2f}s {serial_stats}")
+    print(f"concurrent ({args.max_workers:>2} workers): {concurrent_time:.2f}s {concurrent_stats}")
+    print(f"Speedup: {serial_time / concurrent_time:.1f}x")
+    if args.blob_cache:
+        print(f"blob cache, cold:       {cold_time:.2f}s {cold_stats['requests']} requests")
+        print(f"blob cache, warm ({args.changed_files} changed files per repo): "
+              f"{warm_time:.2f}s {warm_stats['requests']} requests, "
+              f"{warm_stats['requests'] - n_not_modified} counted against the rate limit")
+        if args.response_cache:
+            print(f"response cache, warm:   {warm_stats['response_cache']}")
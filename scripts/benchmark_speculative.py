@@ -0,0 +1,81 @@
+"""
+Benchmark speculative greedy decoding (utils.speculative) against plain decoding and the
+previous code_gen_demo flow (model.generate), with tiny randomly initialized Llamas on
+CPU. Drafters: prompt lookup, prompt lookup plus an NLP++ corpus, a smaller random Llama
+and, as an upper bound on acceptance, the model itself. Checks that every drafter gives
+the same completions as plain greedy decoding, and reports acceptance rates and speedups.
+
+A random draft model almost never agrees with a random model, so it only measures the
+cost of drafting. A distilled draft of a fine-tuned model lands in between it and the
+self draft.
+
+E.g. python -m scripts.benchmark_speculative --num_requests 8 --max_new_tokens 64
+"""
+import time
+from argparse import ArgumentParser
+import typing
+from typing import List, Tuple
+
+import torch
+
+from utils.completion import CompletionEngine, build_tiny_model, nlp_pp_samples
+from utils.speculative import NgramDrafter, ModelDrafter
+
+
+@torch.no_grad()
+def legacy_generate(model, tokenizer, prompt: str, max_new_tokens: int) -> str:
+    input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+    generated_ids = model.generate(input_ids, max_new_tokens=max_new_tokens, do_sample=False)
+    return tokenizer.decode(generated_ids[0, input_ids.shape[1]:], skip_special_tokens=True)
+
+
+def timed_completions(engine: CompletionEngine, prompts: List[str], max_new_tokens: int) -> Tuple[List[str], float]:
+    start = time.perf_counter()
+    completions = [engine.complete(prompt, max_new_tokens=max_new_tokens) for prompt in prompts]
+    return completions, time.perf_counter() - start
+
+
+def get_args():
+    arg_parser = ArgumentParser(description = "Benchmark speculative decoding with tiny models on CPU.")
+    arg_parser.add_argument("--num_requests", type=int, default=8, help="Number of completion requests.")
+    arg_parser.add_argument("--max_new_tokens", type=int, default=64, help="Tokens per completion.")
+    arg_parser.add_argument("--num_draft_tokens", type=int, default=4, help="Tokens drafted per step.")
+    arg_parser.add_argument("--hidden_size", type=int, default=512, help="Hidden size of the tiny model.")
+    arg_parser.add_argument("--num_hidden_layers", type=int, default=8, help="Layers of the tiny model.")
+    arg_parser.add_argument("--draft_hidden_size", type=int, default=64, help="Hidden size of the draft model.")
+    arg_parser.add_argument("--draft_num_hidden_layers", type=int, default=1, help="Layers of the draft model.")
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    model, tokenizer = build_tiny_model(hidden_size=args.hidden_size, num_hidden_layers=args.num_hidden_layers)
+    # Same seed, so the same tokenizer
+    draft_model, _ = build_tiny_model(hidden_size=args.draft_hidden_size, num_hidden_layers=args.draft_num_hidden_layers)
+    prompts = [sample[:sample.index("@@") + 2] + "\n" for sample in nlp_pp_samples(args.num_requests, seed=1)]
+    corpus = [tokenizer(sample).input_ids for sample in nlp_pp_samples(200, seed=2)]
+
+    start = time.perf_counter()
+    legacy = [legacy_generate(model, tokenizer, prompt, args.max_new_tokens) for prompt in prompts]
+    legacy_time = time.perf_counter() - start
+    completions, plain_time = timed_completions(CompletionEngine(model, tokenizer), prompts, args.max_new_tokens)
+    if completions != legacy:
+        raise AssertionError("Completions differ from model.generate.")
+
+    print(f"{args.num_requests} requests of up to {args.max_new_tokens} tokens, {args.num_draft_tokens} draft tokens per step")
+    print(f"{'legacy model.generate':<22} {legacy_time:6.2f}s")
+    print(f"{'plain decoding':<22} {plain_time:6.2f}s")
+    drafters = [
+        ("prompt lookup", NgramDrafter()),
+        ("prompt lookup + corpus", NgramDrafter(corpus=corpus)),
+        ("random draft model", ModelDrafter(draft_model)),
+        ("self draft", ModelDrafter(model)),
+    ]
+    for name, drafter in drafters:
+        engine = CompletionEngine(model, tokenizer, drafter=drafter, num_draft_tokens=args.num_draft_tokens)
+        speculative, speculative_time = timed_completions(engine, prompts, args.max_new_tokens)
+        if speculative != completions:
+            raise AssertionError(f"Speculative completions with {name} differ from plain decoding.")
+        stats = engine.speculative.stats()
+        print(f"{name:<22} {speculative_time:6.2f}s  speedup {plain_time / speculative_time:4.2f}x  "
+              f"acceptance {stats['acceptance_rate']:6.1%}  {stats['tokens_per_step']:.2f} tokens per model pass")
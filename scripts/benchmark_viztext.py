@@ -0,0 +1,178 @@
+"""
+Benchmark scripts.scrape_viztext.scrape against the previous serial implementation
+(bare requests.get and "html.parser" per page). Help pages are served from a local
+directory by a stub HTTP server that simulates network latency. The directory is either
+given (--pages_dir, e.g. saved VisualText help pages with an index page) or filled with
+synthetic help pages. Checks that every run returns the same content.
+
+E.g. python -m scripts.benchmark_viztext --num_pages 500 --latency 0.05
+     python -m scripts.benchmark_viztext --pages_dir help/ --index_page index.htm
+"""
+import os
+import time
+import random
+import tempfile
+import threading
+from argparse import ArgumentParser
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import typing
+from typing import Dict, Optional, Tuple
+
+import requests
+
+from scripts.scrape_viztext import scrape, get_links, parse_content
+
+
+class _Server(ThreadingHTTPServer):
+    # The default listen backlog of 5 drops connections opened by many workers at once
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class StubHelpServer:
+    """
+    Serves the files of pages_dir, delaying every response by latency seconds.
+    """
+    def __init__(self, pages_dir: str, latency: float=0.05):
+        self.latency = latency
+        self.n_requests = 0
+        self._lock = threading.Lock()
+        self.server = _Server(("127.0.0.1", 0), partial(self._handler(), directory=pages_dir))
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def _handler(self):
+        stub = self
+
+        class Handler(SimpleHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                with stub._lock:
+                    stub.n_requests += 1
+                time.sleep(stub.latency)
+                super().do_GET()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self) -> "StubHelpServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_pages(root: str, num_pages: int, no_example_prop: float=0.1, seed: int=0) -> str:
+    """
+    Write num_pages help pages shaped like the VisualText ones (title, purpose and example
+    sections among unrelated markup), and an index page linking to them. A fraction
+    no_example_prop of pages has no example section. Returns the index page file name.
+    """
+    rng = random.Random(seed)
+    filler = "".join(f"<div class='nav'><a href='#s{i}'>Section {i}</a><span>{'x' * 40}</span></div>\n" for i in range(30))
+    links = []
+    for i in range(num_pages):
+        name = f"fn{i}.htm"
+        links.append(f"<li><a href='{name}'>fn{i}</a></li>")
+        example = "" if rng.random() < no_example_prop else (
+            "<h2>Example</h2>\n"
+            f"<p># Match word{i} and name the node</p>\n"
+            "<p>@NODES _ROOT</p>\n"
+            + "".join(f"<p>_xNIL &lt;- _xWILD [one match=(word{rng.randrange(10**6)})] @@</p>\n" for _ in range(rng.randint(2, 10)))
+            + "<p>&#160;</p>\n<img src='output.png'>\n"
+        )
+        page = (
+            f"<html><head><title>fn{i}</title><script>var x = {i};</script></head><body>\n{filler}"
+            f"<h1>fn{i}</h1>\n<h2>Purpose</h2>\n<p>Find word{i} in the parse tree.</p>\n<table><tr><td>ret</td></tr></table>\n"
+            f"<h2>Syntax</h2>\n<p>fn{i}(node)</p>\n{example}{filler}</body></html>\n"
+        )
+        with open(os.path.join(root, name), "w") as f:
+            f.write(page)
+
+    # Links the scraper skips: not lowercase, not .htm, starting with "_"
+    links += ["<li><a href='Overview.htm'>Overview</a></li>", "<li><a href='notes.txt'>notes</a></li>",
+              "<li><a href='_private.htm'>private</a></li>"]
+    with open(os.path.join(root, "index.htm"), "w") as f:
+        f.write(f"<html><body><ul>\n{chr(10).join(links)}\n</ul></body></html>\n")
+    return "index.htm"
+
+
+def legacy_scrape(index_page_url: str) -> Dict[str, Dict]:
+    """
+    scrape as previously implemented: one bare requests.get after another, parsed with
+    "html.parser" (page parsing is shared with the current version, see parse_content).
+    """
+    content = {}
+    for page in get_links(index_page_url):
+        response = requests.get(page)
+        if response.status_code != 200:
+            continue
+        page_content = parse_content(response.content, parser="html.parser")
+        if page_content is not None:
+            content[page] = page_content
+    return content
+
+
+def timed_scrape(server: StubHelpServer, index_page: str, **scrape_kwargs) -> Tuple[Dict[str, Dict], float, int]:
+    """
+    Returns the scraped content, seconds taken and the number of requests made to the server.
+    """
+    n_requests = server.n_requests
+    start = time.perf_counter()
+    if scrape_kwargs.pop("legacy", False):
+        content = legacy_scrape(server.base_url + index_page)
+    else:
+        content = scrape(server.base_url + index_page, **scrape_kwargs)
+    return content, time.perf_counter() - start, server.n_requests - n_requests
+
+
+def get_args():
+    arg_parser = ArgumentParser(description = "Benchmark scrape_viztext.scrape against a local stub server.")
+    arg_parser.add_argument("--pages_dir", type=str, default=None, help="Directory of saved help pages (default synthetic).")
+    arg_parser.add_argument("--index_page", type=str, default="index.htm", help="Index page file in pages_dir.")
+    arg_parser.add_argument("--num_pages", type=int, default=500, help="Number of synthetic help pages.")
+    arg_parser.add_argument("--latency", type=float, default=0.05, help="Seconds of latency per request.")
+    arg_parser.add_argument("--max_workers", type=int, default=16, help="Concurrency of the concurrent runs.")
+    arg_parser.add_argument("--parser", type=str, default="lxml", help="Faster BeautifulSoup parser to compare.")
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pages_dir, index_page = args.pages_dir, args.index_page
+        if pages_dir is None:
+            pages_dir = os.path.join(tmp_dir, "pages")
+            os.makedirs(pages_dir)
+            index_page = make_pages(pages_dir, args.num_pages)
+        cache_dir = os.path.join(tmp_dir, "cache")
+
+        with StubHelpServer(pages_dir, args.latency) as server:
+            runs = [
+                ("legacy serial, html.parser", dict(legacy=True)),
+                (f"{args.max_workers} workers, html.parser", dict(max_workers=args.max_workers)),
+                (f"{args.max_workers} workers, {args.parser}", dict(max_workers=args.max_workers, parser=args.parser)),
+                (f"{args.max_workers} workers, {args.parser}, strained", dict(max_workers=args.max_workers, parser=args.parser, strain=True)),
+                ("cold cache", dict(max_workers=args.max_workers, parser=args.parser, strain=True, cache_dir=cache_dir)),
+                ("warm cache (offline)", dict(max_workers=args.max_workers, parser=args.parser, strain=True, cache_dir=cache_dir)),
+            ]
+            results = [(name, *timed_scrape(server, index_page, **kwargs)) for name, kwargs in runs]
+
+    expected = results[0][1]
+    for name, content, _, _ in results[1:]:
+        if content != expected:
+            raise AssertionError(f"Content of the {name} run differs from the legacy scrape.")
+    if results[-1][3] != 0:
+        raise AssertionError(f"Warm cache run made {results[-1][3]} requests.")
+
+    print(f"Scraped {len(expected)} pages with examples ({args.latency * 1000:.0f}ms latency per request)")
+    legacy_time = results[0][2]
+    for name, _, seconds, n_requests in results:
+        print(f"{name + ':':<32} {seconds:6.2f}s  {n_requests:>5} requests  ({legacy_time / seconds:.1f}x)")
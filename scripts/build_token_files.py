@@ -0,0 +1,62 @@
+"""
+Write preprocessed (tokenized and grouped) datasets to memory-mapped token files
+for run_clm.py --tokenized_data_dir.
+
+The preprocessed datasets are e.g. a cache entry written by
+run_clm.py --preprocess_only (see --preprocessing_cache_dir). Alternatively run
+run_clm.py --preprocess_only --tokenized_data_dir <dir> to do both in one step.
+
+E.g. python -m scripts.build_token_files --dataset_dir .project_cache/lm_datasets/<key> \
+        --output_dir data/tokens --tokenizer_name codellama/CodeLlama-13b-hf
+"""
+from argparse import ArgumentParser
+import logging
+
+from datasets import load_from_disk
+from transformers import AutoTokenizer
+
+from utils.indexed_dataset import build_indexed_datasets
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    arg_parser = ArgumentParser(description = "Build memory-mapped token files from preprocessed datasets.")
+    arg_parser.add_argument(
+        "--dataset_dir",
+        type=str,
+        required=True,
+        help="Preprocessed DatasetDict saved with save_to_disk, with an input_ids column."
+    )
+    arg_parser.add_argument(
+        "--output_dir",
+        type=str,
+        required=True,
+        help="Directory to write <split>.bin/.idx.npy/.json token files to."
+    )
+    arg_parser.add_argument(
+        "--tokenizer_name",
+        type=str,
+        default=None,
+        help="Tokenizer used for preprocessing, determines the token dtype."
+    )
+    arg_parser.add_argument(
+        "--vocab_size",
+        type=int,
+        default=None,
+        help="Vocabulary size, if no tokenizer is given."
+    )
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    if args.vocab_size is None:
+        if args.tokenizer_name is None:
+            raise ValueError("Need either --tokenizer_name or --vocab_size.")
+        args.vocab_size = len(AutoTokenizer.from_pretrained(args.tokenizer_name))
+
+    counts = build_indexed_datasets(load_from_disk(args.dataset_dir), args.output_dir, vocab_size=args.vocab_size)
+    for split, count in counts.items():
+        print(f"{split}: {count} sequences")
@@ -2,14 +2,21 @@ import pickle
 import json
 import os
 import re
+import itertools
+import collections
 import typing
-from typing import List, Union, Dict
+from typing import List, Union, Dict, Iterable, Iterator, Optional
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 import logging
 from constants import SAVE_DIR
-from datasets import Dataset
+import numpy as np
+from datasets import Dataset, load_from_disk
 from dateutil import parser
 
+from utils.shard_writer import read_shards
+from utils.near_dedup import MinHashLSH, near_dedup
+
 logger = logging.getLogger(__name__)
 
 # Proper nouns to remove frmo comments (lowercase)
@@ -24,9 +31,7 @@ def remove_header(sample: str) -> str:
     lines = sample.split('\n')
     header_end_idx = 0
     header_seps = 0
-    while lines[header_end_idx].startswith('#') or lines[header_end_idx] == '':
-        if header_end_idx >= len(lines):
-            return ""
+    while header_end_idx < len(lines) and (lines[header_end_idx].startswith('#') or lines[header_end_idx] == ''):
         if lines[header_end_idx].startswith('####'):
             header_seps += 1
         header_end_idx += 1
@@ -48,10 +53,10 @@ def resolve_line_endings(sample: str) -> str:
     clean_sample = clean_sample.replace("\r\n", "\n") 
     return clean_sample
 
-def de_identify(sample: str) -> str:
+def de_identify_lines(sample: str) -> str:
     """
     Remove dates, times, names, emails, and websites from comments.
-    Not rigorous.
+    Not rigorous. Reference line by line implementation of de_identify.
     """
     lines = sample.split("\n")
     clean_lines = []
@@ -95,21 +100,219 @@ def de_identify(sample: str) -> str:
         
     return "\n".join(clean_lines)
 
-def clean_data(data: List[str]) -> Dict[int, str]:
-    clean_data = []
-    for sample in data:
-        clean_sample = resolve_line_endings(sample)
-        clean_sample = remove_header(clean_sample)
-        clean_sample = de_identify(clean_sample)
-        if clean_sample != "":
-            clean_data.append(clean_sample)
+# Patterns of de_identify_lines. Comment line patterns are matched against lowercased lines.
+DATETIME_PATTERN = r'\d{1,4}[/-:]\d{1,2}[/-:]?\d{0,4}?'
+URL_PATTERN = r'https?://\S*|www\.\S+\.\S*|\S+\.com\S+|\S+\.net\S+|\S+\.org\S+|\S+\.edu\S+|\S+\.uk\S+'
+DATE_STAMP_PATTERN = r'#\s*\d{2}/\d{2}/\d{2} [AP]M\.'
+
+# Characters whose lowercase depends on context or changes string length,
+# so lowercasing the whole sample isn't equivalent to lowercasing each line
+_UNSAFE_LOWER = re.compile('[\u0130\u03a3]')
+
+def names_pattern(names: List[str]) -> str:
+    """
+    Regex matching any of names, as a trie of literal strings (e.g. da(?:vid|ve)).
+    Unlike a plain alternation, its cost barely grows with the number of names.
+    """
+    trie = {}
+    for name in names:
+        node = trie
+        for char in name:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def to_regex(node: dict) -> str:
+        optional = "" in node
+        alternatives = [re.escape(char) + to_regex(child) for char, child in sorted(node.items()) if char != ""]
+        if not alternatives:
+            return ""
+        regex = alternatives[0] if len(alternatives) == 1 else "(?:" + "|".join(alternatives) + ")"
+        if optional:
+            regex = "(?:" + regex + ")?"
+        return regex
+
+    return to_regex(trie) if trie else "(?!)"
+
+class DeIdentifier:
+    """
+    Compiled, whole-sample version of de_identify_lines, with identical output.
+
+    Instead of visiting every line, the sample is scanned once (in C) for anything
+    the rules could act on: a date, name or url in the lowercased text, or a date
+    stamp. Only lines containing a hit are split out and scrubbed with the
+    precompiled line rules, the rest of the sample is copied as is.
+
+    Args
+        names: lowercase names to remove from comments, matched literally
+    """
+    def __init__(self, names: List[str]):
+        self.names = list(names)
+        self.datetime = re.compile(DATETIME_PATTERN)
+        self.name = re.compile(names_pattern(self.names))
+        self.url = re.compile(URL_PATTERN)
+        self.date_stamp = re.compile(DATE_STAMP_PATTERN)
+        # Necessary conditions of the comment line patterns: a date has a digit, separator and digit,
+        # a url has a scheme, www. or a domain. Only comment lines are searched.
+        trigger = "|".join([r'\d[/-:]\d', r'https?://|www\.|\.(?:com|net|org|edu|uk)', names_pattern(self.names)])
+        self.comment_trigger = re.compile(r'^[^\S\n]*#[^\n]*?(?:' + trigger + ')', re.MULTILINE)
+        # \s can't cross line boundaries when matching single lines
+        self.date_stamp_trigger = re.compile(DATE_STAMP_PATTERN.replace("\\s", "[^\\S\\n]"))
+
+    def __call__(self, sample: str) -> str:
+        if "#" not in sample:
+            # No comments or date stamps
+            return sample
+        if _UNSAFE_LOWER.search(sample):
+            return de_identify_lines(sample)
+
+        line_starts = set()
+        for match in self.comment_trigger.finditer(sample.lower()):
+            line_starts.add(match.start())
+        for match in self.date_stamp_trigger.finditer(sample):
+            line_starts.add(sample.rfind("\n", 0, match.start()) + 1)
+        if not line_starts:
+            return sample
+
+        pieces = []
+        prev_end = 0
+        for start in sorted(line_starts):
+            end = sample.find("\n", start)
+            end = len(sample) if end == -1 else end
+            pieces.append(sample[prev_end:start])
+            line = self.scrub_line(sample[start:end])
+            if line is not None:
+                pieces.append(line)
+                prev_end = end
+            elif end < len(sample):
+                # Drop the line and its newline
+                prev_end = end + 1
+            else:
+                # Drop the last line and the newline before it. Whatever was kept before 
+                # the line ends with a newline (or is empty).
+                kept = "".join(pieces)
+                pieces = [kept[:-1] if kept.endswith("\n") else kept]
+                prev_end = end
+        pieces.append(sample[prev_end:])
+        return "".join(pieces)
+
+    def scrub_line(self, l: str) -> Optional[str]:
+        """
+        de_identify_lines for a single line. Returns None if the line is dropped.
+        """
+        if l.lstrip().startswith("#"):
+            dt_match = self.datetime.search(l.lower())
+            if dt_match:
+                l = l[:dt_match.start()].rstrip()
+                if l.endswith("-"):
+                    l = l[:-1].rstrip()
+
+            name_match = self.name.search(l.lower())
+            if name_match:
+                l = l[:name_match.start()].rstrip()
+                if l.endswith("-"):
+                    l = l[:-1].rstrip()
+
+            url_match = self.url.search(l.lower())
+            if url_match:
+                l = l[:url_match.start()] + l[url_match.end():]
+
+            if name_match or dt_match or url_match:
+                return l if len(l.strip()) > 10 else None
+            return l
+
+        date_stamp_match = self.date_stamp.search(l)
+        if date_stamp_match:
+            l = l[:date_stamp_match.start()].rstrip()
+        return l
+
+_de_identifier = None
+
+def de_identify(sample: str) -> str:
+    """
+    Remove dates, times, names, emails, and websites from comments.
+    Not rigorous. Same output as de_identify_lines, see DeIdentifier.
+    """
+    global _de_identifier
+    if _de_identifier is None or _de_identifier.names != REMOVE_NAMES:
+        _de_identifier = DeIdentifier(REMOVE_NAMES)
+    return _de_identifier(sample)
+
+def clean_sample(sample: str) -> str:
+    """
+    Resolve line endings, remove header and de-identify a single sample.
+    """
+    sample = resolve_line_endings(sample)
+    sample = remove_header(sample)
+    return de_identify(sample)
+
+def _clean_chunk(chunk: List[str]) -> List[str]:
+    cleaned = (clean_sample(sample) for sample in chunk)
+    return [sample for sample in cleaned if sample != ""]
+
+def clean_stream(
+    samples: Iterable[str],
+    num_workers: int=1,
+    chunk_size: int=256
+) -> Iterator[str]:
+    """
+    Clean samples lazily, dropping empty results. With num_workers > 1, chunks of 
+    chunk_size samples are cleaned in a process pool and yielded in input order. 
+    At most 2 * num_workers chunks are in flight, so memory stays bounded.
+    """
+    chunks = iter(lambda it=iter(samples): list(itertools.islice(it, chunk_size)), [])
+    if num_workers <= 1:
+        for chunk in chunks:
+            yield from _clean_chunk(chunk)
+        return
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        in_flight = collections.deque()
+        for chunk in chunks:
+            in_flight.append(executor.submit(_clean_chunk, chunk))
+            if len(in_flight) >= 2 * num_workers:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
 
+def clean_data(
+    data: Iterable[str],
+    num_workers: int=1,
+    chunk_size: int=256
+) -> Dict[int, str]:
+    clean_data = clean_stream(data, num_workers=num_workers, chunk_size=chunk_size)
     clean_data = {i: sample for i, sample in enumerate(clean_data)}
     return clean_data
 
 def read_data(pickled_data_path: str) -> List[str]:
-    with open(pickled_data_path, "rb") as f:
-        return pickle.load(f)
+    """
+    Read scraped texts from a pickled list, or from jsonl/parquet shards written by 
+    GitHubScraper.scrape(output_dir=...) (a shard directory or a single shard).
+    """
+    return list(iter_data(pickled_data_path))
+
+def iter_data(data_path: str, batch_size: int=1000) -> Iterator[str]:
+    """
+    Stream texts from
+     - jsonl/parquet shards written by GitHubScraper.scrape(output_dir=...) (a shard directory or a single shard)
+     - an arrow dataset saved with save_to_disk or a single .arrow file (memory mapped), with a "text" column
+     - a pickled list of texts (or dict of path -> text, e.g. from scrape_dir), which is loaded at once
+    """
+    if os.path.isdir(data_path) and os.path.isfile(os.path.join(data_path, "state.json")):
+        dataset = load_from_disk(data_path)
+    elif data_path.endswith(".arrow"):
+        dataset = Dataset.from_file(data_path)
+    elif os.path.isdir(data_path) or data_path.endswith((".jsonl", ".parquet")):
+        for record in read_shards(data_path, columns=["text"]):
+            yield record["text"]
+        return
+    else:
+        with open(data_path, "rb") as f:
+            data = pickle.load(f)
+        yield from data.values() if isinstance(data, dict) else data
+        return
+
+    for batch in dataset.select_columns(["text"]).iter(batch_size=batch_size):
+        yield from batch["text"]
 
 def save_clean_data(data: Dict[int, str], save_path: str, force: bool=False) -> None:
     if not force and os.path.exists(save_path):
@@ -118,29 +321,84 @@ def save_clean_data(data: Dict[int, str], save_path: str, force: bool=False) ->
     with open(save_path, "w") as f:
         json.dump(data, f, indent=4)
 
+def stream_clean_data(
+    samples: Iterable[str],
+    save_path: str,
+    force: bool=False,
+    num_workers: int=1,
+    chunk_size: int=256,
+    keep: Optional[np.ndarray]=None
+) -> int:
+    """
+    Clean samples and write them to save_path as they arrive. The file is identical 
+    to save_clean_data(clean_data(samples), save_path), without holding the data in memory.
+    If keep is given, only the i-th clean sample with keep[i] is written (see near_dedup_mask).
+
+    Returns
+        number of samples written
+    """
+    if not force and os.path.exists(save_path):
+        raise FileExistsError("save_path exists. Set force = True to overwrite.")
+
+    n_samples = 0
+    with open(save_path, "w") as f:
+        for j, sample in enumerate(clean_stream(samples, num_workers=num_workers, chunk_size=chunk_size)):
+            if keep is not None and not keep[j]:
+                continue
+            # Same layout as json.dump(dict, f, indent=4)
+            f.write(("{\n    " if n_samples == 0 else ",\n    ") + json.dumps(str(n_samples)) + ": " + json.dumps(sample))
+            n_samples += 1
+        f.write("\n}" if n_samples > 0 else "{}")
+    return n_samples
+
+def near_dedup_mask(
+    samples: Iterable[str],
+    threshold: float,
+    num_workers: int=1,
+    chunk_size: int=256
+) -> np.ndarray:
+    """
+    Clean samples and find near-duplicates among them (see utils.near_dedup), keeping only 
+    MinHash signatures in memory. Returns the mask of clean samples to keep.
+    """
+    cleaned = clean_stream(samples, num_workers=num_workers, chunk_size=chunk_size)
+    keep, stats = MinHashLSH(threshold=threshold).keep_mask(cleaned)
+    logger.info(f"Near-dedup at Jaccard threshold {threshold}: {stats}")
+    return keep
+
 def clean(
     raw_data: List[str]=None,
     pickled_data_path: str=None,
     save_path: str=None,
-    force: bool=False
+    force: bool=False,
+    num_workers: int=1,
+    chunk_size: int=256,
+    near_dedup_threshold: Optional[float]=None
 ) -> Dict[int, str]:
     """
     Read pickled data, remove headers from samples, save as json, 
     and return clean data.
 
     Args
-        pickled_data_path: path to pickled data file
+        pickled_data_path: path to pickled data file (or shards/arrow data, see iter_data)
         save_path: name of save file
         force: whether to overwrite save_path, if it exists
+        num_workers: number of cleaning processes
+        chunk_size: number of samples sent to a process at a time
+        near_dedup_threshold: if not None, also remove near-duplicate samples with a 
+                              Jaccard similarity of at least this (see utils.near_dedup)
     
     Return
         dict of sample idx -> sample string
     """
     if raw_data is None and pickled_data_path is not None:
-        data = read_data(pickled_data_path)
+        data = iter_data(pickled_data_path)
     else:
         data = raw_data
-    data = clean_data(data)
+    data = clean_data(data, num_workers=num_workers, chunk_size=chunk_size)
+    if near_dedup_threshold is not None:
+        texts, stats = near_dedup(list(data.values()), threshold=near_dedup_threshold)
+        data = {i: sample for i, sample in enumerate(texts)}
     if save_path is not None:
         save_clean_data(data, save_path, force)
     return data
@@ -158,7 +416,7 @@ def parse_args():
         "--pickled_data_path",
         type=str,
         default=None,
-        help="Path to pickled data file to load"
+        help="Path to pickled data file to load, or to scraped jsonl/parquet shards or an arrow dataset"
     )
     arg_parser.add_argument(
         "--save_path",
@@ -171,9 +429,38 @@ def parse_args():
         action="store_true",
         help="Whether to overwrite save path."
     )
+    arg_parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of cleaning processes."
+    )
+    arg_parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=256,
+        help="Number of samples sent to a cleaning process at a time."
+    )
+    arg_parser.add_argument(
+        "--near_dedup_threshold",
+        type=float,
+        default=None,
+        help="If set, remove near-duplicate samples with at least this MinHash Jaccard similarity, e.g. 0.85."
+    )
     return arg_parser.parse_args()
 
 if __name__ == '__main__':
     args = parse_args()
-    _ = clean(pickled_data_path=args.pickled_data_path, 
-              save_path=args.save_path, force=args.force)
+    if args.save_path is not None:
+        # Stream from input to output. Near-dedup reads the input twice, once to find duplicates.
+        keep = None
+        if args.near_dedup_threshold is not None:
+            keep = near_dedup_mask(iter_data(args.pickled_data_path), args.near_dedup_threshold,
+                                   num_workers=args.num_workers, chunk_size=args.chunk_size)
+        n_samples = stream_clean_data(iter_data(args.pickled_data_path), args.save_path, force=args.force,
+                                      num_workers=args.num_workers, chunk_size=args.chunk_size, keep=keep)
+        logger.info(f"Wrote {n_samples} clean samples to {args.save_path}")
+    else:
+        _ = clean(pickled_data_path=args.pickled_data_path, 
+                  num_workers=args.num_workers, chunk_size=args.chunk_size,
+                  near_dedup_threshold=args.near_dedup_threshold)
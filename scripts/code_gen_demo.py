@@ -1,11 +1,9 @@
-from transformers import (
-    AutoModelForCausalLM,
-    AutoTokenizer
-)
 from argparse import ArgumentParser
 import typing
 from typing import Optional
 
+from utils.completion import CompletionEngine, load_model
+
 def get_args():
     arg_parser = ArgumentParser(description = "Generate text with model.")
     arg_parser.add_argument(
@@ -26,18 +24,35 @@ def get_args():
         default=None,
         help="Optionally pass text as flag."
     )
+    arg_parser.add_argument(
+        "--suffix",
+        type=str,
+        default=None,
+        help="Optionally pass text after the cursor, to fill in the middle between text and suffix."
+    )
+    arg_parser.add_argument(
+        "--max_new_tokens",
+        type=int,
+        default=128,
+        help="Number of tokens to generate after the prompt."
+    )
     return arg_parser.parse_args()
 
-def generate(model: AutoModelForCausalLM, tokenizer: AutoTokenizer, text: str):
-    input_ids = tokenizer(text, return_tensors="pt").input_ids
-    generated_ids = model.generate(input_ids, max_length=128)
-    return tokenizer.decode(generated_ids[0], skip_special_tokens=True)
+def generate(engine: CompletionEngine, text: str, max_new_tokens: int=128, suffix: Optional[str]=None):
+    if suffix is not None:
+        return text + engine.infill(text, suffix, max_new_tokens=max_new_tokens) + suffix
+    return text + engine.complete(text, max_new_tokens=max_new_tokens)
 
-def run(model_path: str, tokenizer_path: Optional[str]=None, text: Optional[str]=None):
-    tokenizer = AutoTokenizer.from_pretrained(model_path)
-    model = AutoModelForCausalLM.from_pretrained(tokenizer_path if tokenizer_path is not None else model_path)
+def run(
+    model_path: str,
+    tokenizer_path: Optional[str]=None,
+    text: Optional[str]=None,
+    max_new_tokens: int=128,
+    suffix: Optional[str]=None
+):
+    engine = CompletionEngine(*load_model(model_path, tokenizer_path))
     if text is not None:
-        print(generate(model, tokenizer, text))
+        print(generate(engine, text, max_new_tokens, suffix))
     else:
         print("CODE GENERATION DEMO")
         print(f"Generating code with model: {model_path}")
@@ -46,7 +61,7 @@ def run(model_path: str, tokenizer_path: Optional[str]=None, text: Optional[str]
         
         text = input("Prompt: ")
         while text.lower() not in ['e', 'exit']: 
-            generated_code = generate(model, tokenizer, text)
+            generated_code = generate(engine, text, max_new_tokens)
             print(generated_code)
             print()
             text = input("Prompt: ")
@@ -55,4 +70,4 @@ def run(model_path: str, tokenizer_path: Optional[str]=None, text: Optional[str]
 
 if __name__=='__main__':
     args = get_args()
-    run(args.model_path, args.tokenizer_path, args.text)
+    run(args.model_path, args.tokenizer_path, args.text, args.max_new_tokens, args.suffix)
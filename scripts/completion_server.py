@@ -0,0 +1,266 @@
+"""
+Local completion server keeping a model loaded, e.g. as a backend for the HF VS Code
+extension (llm-vscode) or Continue. Speaks the text-generation-inference (TGI) API:
+
+    POST /                 {"inputs": ..., "parameters": {...}, "stream": false} -> [{"generated_text": ...}]
+    POST /generate         {"inputs": ..., "parameters": {...}} -> {"generated_text": ...}
+    POST /generate_stream  server-sent events, one {"token": {...}, "generated_text": null}
+                           per token, the last one with the full generated_text
+    GET  /health, /info
+
+Supported parameters: max_new_tokens, temperature, do_sample, top_p, stop, seed and
+return_full_text (default false). Infill prompts "<PRE> {prefix} <SUF>{suffix} <MID>" (as
+sent by llm-vscode for CodeLlama) fill in the middle, with the context trimmed around
+the cursor to --max_input_tokens. With --draft_model or --prompt_lookup, greedy requests
+are decoded speculatively, one at a time, see utils.speculative. Otherwise concurrent
+requests are decoded together in a continuous batch of up to --max_batch_size requests.
+Prompts sharing a prefix with an earlier one (e.g. on every keystroke) only prefill the
+rest, see utils.completion.CompletionEngine.
+
+E.g. python -m scripts.completion_server --model_path AshtonIsNotHere/CodeLlama_7B_nlp_pp --port 8080
+     python -m scripts.completion_server --tiny   # random tiny Llama on CPU, for testing
+"""
+import json
+import threading
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import typing
+from typing import Dict, Iterator, Optional
+import logging
+
+from utils.completion import CompletionEngine, load_model, build_tiny_model
+from utils.infill import FIM_TOKENS, split_infill
+from utils.speculative import NgramDrafter, ModelDrafter
+
+logger = logging.getLogger(__name__)
+
+
+class _Server(ThreadingHTTPServer):
+    # The default listen backlog of 5 drops connections opened by many editors at once
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def generation_kwargs(parameters: Dict) -> Dict:
+    """
+    CompletionEngine.stream arguments from TGI request parameters. Raises a ValueError
+    (or TypeError) on invalid parameters.
+    """
+    max_new_tokens = parameters.get("max_new_tokens")
+    max_new_tokens = 60 if max_new_tokens is None else int(max_new_tokens)
+    if max_new_tokens <= 0:
+        raise ValueError("`max_new_tokens` must be strictly positive")
+    # As TGI: greedy unless do_sample or a temperature is given, do_sample alone samples at 1.0
+    temperature = parameters.get("temperature")
+    if temperature is not None:
+        temperature = float(temperature)
+        if temperature <= 0:
+            raise ValueError("`temperature` must be strictly positive")
+    elif parameters.get("do_sample", False):
+        temperature = 1.0
+    else:
+        temperature = 0.0
+    top_p = parameters.get("top_p")
+    top_p = 1.0 if top_p is None else float(top_p)
+    if not 0 < top_p <= 1:
+        raise ValueError("`top_p` must be > 0.0 and <= 1.0")
+    stop = parameters.get("stop") or []
+    if not isinstance(stop, list) or not all(isinstance(s, str) for s in stop):
+        raise ValueError("`stop` must be a list of strings")
+    seed = parameters.get("seed")
+    return {
+        "max_new_tokens": max_new_tokens,
+        "temperature": temperature,
+        "top_p": top_p,
+        "stop": stop,
+        "seed": int(seed) if seed is not None else None,
+    }
+
+
+class CompletionServer:
+    """
+    Serve engine over HTTP on host:port (0 picks a free port) from a background thread.
+    """
+    def __init__(self, engine: CompletionEngine, host: str="127.0.0.1", port: int=0, model_id: str="model"):
+        self.engine = engine
+        self.model_id = model_id
+        self.server = _Server((host, port), self._handler())
+        self.base_url = f"http://{host}:{self.server.server_address[1]}/"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self) -> "CompletionServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def serve_forever(self) -> None:
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+
+    def events(self, prompt: str, parameters: Dict, kwargs: Dict) -> Iterator[Dict]:
+        """
+        TGI stream events for a request with generation_kwargs kwargs, the last one has
+        the generated text.
+        """
+        token_ids, texts = [], []
+        infill = split_infill(prompt)
+        tokens = self.engine.stream_infill(*infill, **kwargs) if infill is not None else self.engine.stream(prompt, **kwargs)
+        for token_id, text in tokens:
+            token_ids.append(token_id)
+            texts.append(text)
+            yield {"token": {"id": token_id, "text": text, "logprob": None, "special": False},
+                   "generated_text": None, "details": None}
+
+        # The token texts are decoded following the prompt, see utils.completion.TextStreamer
+        generated_text = "".join(texts)
+        if any(generated_text.endswith(s) for s in kwargs["stop"]):
+            finish_reason = "stop_sequence"
+        else:
+            finish_reason = "length" if len(token_ids) == kwargs["max_new_tokens"] else "eos_token"
+        if parameters.get("return_full_text", False):
+            generated_text = prompt + generated_text
+        yield {"token": None, "generated_text": generated_text,
+               "details": {"finish_reason": finish_reason, "generated_tokens": len(token_ids)}}
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def send_json(self, status: int, body) -> None:
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                if self.path == "/health":
+                    self.send_json(200, {})
+                elif self.path == "/info":
+                    info = {"model_id": server.model_id, "max_input_length": server.engine.max_input_tokens}
+                    if server.engine.prefix_cache is not None:
+                        info["prefix_cache"] = server.engine.prefix_cache.stats()
+                    if server.engine.speculative is not None:
+                        info["speculative"] = server.engine.speculative.stats()
+                    self.send_json(200, info)
+                else:
+                    self.send_json(404, {"error": f"Unknown route {self.path}"})
+
+            def do_POST(self):
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                    prompt = request["inputs"]
+                    if not isinstance(prompt, str):
+                        raise TypeError("`inputs` must be a string")
+                    parameters = request.get("parameters") or {}
+                    kwargs = generation_kwargs(parameters)
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    self.send_json(422, {"error": f"Invalid request: {e}", "error_type": "validation"})
+                    return
+
+                if self.path == "/generate_stream" or (self.path == "/" and request.get("stream", False)):
+                    self.stream(server.events(prompt, parameters, kwargs))
+                elif self.path in ["/", "/generate"]:
+                    try:
+                        *_, last = server.events(prompt, parameters, kwargs)
+                    except Exception as e:
+                        logger.exception("Generation failed")
+                        self.send_json(500, {"error": str(e), "error_type": "generation"})
+                        return
+                    body = {"generated_text": last["generated_text"]}
+                    self.send_json(200, [body] if self.path == "/" else {**body, "details": last["details"]})
+                else:
+                    self.send_json(404, {"error": f"Unknown route {self.path}"})
+
+            def send_chunk(self, event: Dict) -> None:
+                data = f"data:{json.dumps(event)}\n\n".encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+
+            def stream(self, events: Iterator[Dict]) -> None:
+                """
+                Send events as server-sent events, in chunked encoding. A generation error
+                is sent as a last {"error", "error_type"} event, as TGI does.
+                """
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                try:
+                    try:
+                        for event in events:
+                            self.send_chunk(event)
+                    except (BrokenPipeError, ConnectionResetError):
+                        raise
+                    except Exception as e:
+                        logger.exception("Generation failed")
+                        self.send_chunk({"error": str(e), "error_type": "generation"})
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    # Editors cancel completions by closing the connection
+                    logger.info("Client closed the stream")
+                    self.close_connection = True
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def get_args():
+    arg_parser = ArgumentParser(description = "Serve code completions over HTTP.")
+    arg_parser.add_argument("--model_path", type=str, default=None, help="Path or hub id of model.")
+    arg_parser.add_argument("--tokenizer_path", type=str, default=None, help="Path to pretrained tokenizer, if different from model.")
+    arg_parser.add_argument("--tiny", action="store_true", help="Serve a randomly initialized tiny Llama instead.")
+    arg_parser.add_argument("--device", type=str, default="cpu", help="Device to run the model on.")
+    arg_parser.add_argument("--max_input_tokens", type=int, default=2048, help="Prompts are truncated to their last tokens.")
+    arg_parser.add_argument("--max_batch_size", type=int, default=8, help="Requests decoded together (1 disables batching).")
+    arg_parser.add_argument("--max_wait", type=float, default=0.005, help="Seconds an idle server waits to group requests.")
+    arg_parser.add_argument("--prefix_cache_mb", type=int, default=1024, help="Memory of the prompt prefix KV cache (0 disables it).")
+    arg_parser.add_argument("--draft_model", type=str, default=None, help="Path or hub id of a small model sharing the tokenizer, to draft tokens with.")
+    arg_parser.add_argument("--prompt_lookup", action="store_true", help="Draft tokens by looking up the last tokens in the prompt.")
+    arg_parser.add_argument("--num_draft_tokens", type=int, default=4, help="Tokens drafted per speculative decoding step.")
+    arg_parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on.")
+    arg_parser.add_argument("--port", type=int, default=8080, help="Port to listen on.")
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.tiny:
+        model, tokenizer = build_tiny_model(special_tokens=list(FIM_TOKENS))
+        model_id = "tiny-llama"
+    elif args.model_path is not None:
+        model, tokenizer = load_model(args.model_path, args.tokenizer_path, device=args.device)
+        model_id = args.model_path
+    else:
+        raise ValueError("Pass --model_path or --tiny.")
+
+    drafter = None
+    if args.draft_model is not None:
+        drafter = ModelDrafter(load_model(args.draft_model, device=args.device)[0])
+    elif args.prompt_lookup:
+        drafter = NgramDrafter()
+    max_batch_size = args.max_batch_size
+    if drafter is not None and max_batch_size > 1:
+        logger.info("Speculative decoding runs requests one at a time, ignoring --max_batch_size")
+        max_batch_size = 1
+
+    engine = CompletionEngine(model, tokenizer, max_input_tokens=args.max_input_tokens,
+                              max_batch_size=max_batch_size, max_wait=args.max_wait,
+                              prefix_cache_bytes=args.prefix_cache_mb * 2**20,
+                              drafter=drafter, num_draft_tokens=args.num_draft_tokens)
+    server = CompletionServer(engine, args.host, args.port, model_id=model_id)
+    logger.info(f"Serving {model_id} at {server.base_url}")
+    server.serve_forever()
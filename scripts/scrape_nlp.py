@@ -9,7 +9,8 @@ logger = logging.getLogger(__name__)
 
 def main():
     scraper = GitHubScraper(auth_username="ashtonomy", 
-                            auth_token=os.environ["GH_TOKEN"])
+                            auth_token=os.environ["GH_TOKEN"],
+                            blob_cache=os.path.join(SAVE_DIR, "blobs.sqlite"))
     
     data = scraper(users=USERS, hidden_files=False, file_endings="nlp",
                    save_dir=SAVE_DIR)
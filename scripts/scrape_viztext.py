@@ -1,25 +1,100 @@
 """
 Scrape Visual Text help files to generate prompt dataset.
+
+Help pages are fetched concurrently over a pooled session, and their raw HTML can be
+cached on disk (cache_dir) so that re-runs parse offline. Pages are parsed with
+html.parser, or faster with lxml (parser="lxml"), optionally only keeping the tags read
+by parse_content (strain).
+
+Scraped pages are cleaned and prompted as records ({url: {field: ...}}, clean_records and
+add_prompts), dropping obsolete and empty examples once, then flattened into columns
+({"url": [...], "example": [...], ...}, see to_columns) in a single pass. json output
+keeps these layouts, .parquet output holds columns.
 """
 import os
+import hashlib
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup, SoupStrainer
 import typing
-from typing import Union, Dict, List, Optional
+from typing import Union, Dict, List, Optional, Tuple
 from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser
 import logging
 import json
 from tqdm import tqdm
 from pprint import pprint
 
+# lxml is faster (parser="lxml", if installed), but repairs broken HTML differently, so
+# the default doesn't depend on the environment
+DEFAULT_PARSER = "html.parser"
+
 logger = logging.getLogger(__name__)
 
-def get_links(url: str, link_ending: str="htm") -> Dict[str,str]:
+# Tags read by parse_content: the title, headers, paragraphs, and the block tags that end 
+# an example or purpose section. Tags without a match (e.g. <body>, a wrapping <div>) are 
+# dropped and their matching children kept in order, so help pages must not nest paragraphs 
+# of different sections in different containers for strained parsing to match a full parse.
+HELP_PAGE_STRAINER = SoupStrainer([
+    "title", "h1", "h2", "h3", "h4", "h5", "h6", "p",
+    "img", "table", "pre", "ul", "ol", "dl", "hr", "blockquote"
+])
+
+def make_session(max_workers: int=16) -> requests.Session:
+    """
+    Session keeping up to max_workers connections per host alive.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def cache_path(url: str, cache_dir: str) -> str:
+    return os.path.join(cache_dir, hashlib.blake2b(url.encode("utf-8"), digest_size=16).hexdigest() + ".html")
+
+def fetch_html(
+    url: str,
+    session: Optional[requests.Session]=None,
+    cache_dir: Optional[str]=None
+) -> Optional[bytes]:
+    """
+    Raw HTML of url, or None if the response is not 200. If cache_dir is given, pages are
+    read from it if cached, and written to it when fetched.
+    """
+    if cache_dir is not None:
+        path = cache_path(url, cache_dir)
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                return f.read()
+
+    response = (session or requests).get(url)
+    if response.status_code != 200:
+        return None
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write then rename, so that an interrupted run leaves no partial page
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(response.content)
+        os.replace(tmp_path, path)
+    return response.content
+
+def get_links(
+    url: str,
+    link_ending: str="htm",
+    session: Optional[requests.Session]=None,
+    cache_dir: Optional[str]=None
+) -> List[str]:
     avoid_start_chars = ["$", "@", "_"] # These contain no examples and but may still slip through
-    response = requests.get(url)
+    html = fetch_html(url, session=session, cache_dir=cache_dir)
+    if html is None:
+        return []
 
     links = []
-    for link in BeautifulSoup(response.content, parse_only=SoupStrainer('a')):
+    for link in BeautifulSoup(html, DEFAULT_PARSER, parse_only=SoupStrainer('a')):
         if link.has_attr('href'):
             if link['href'].endswith(link_ending) and link['href'].islower() and link['href'][0] not in avoid_start_chars:
                 # Create absolute link, assumes relative links
@@ -27,17 +102,33 @@ def get_links(url: str, link_ending: str="htm") -> Dict[str,str]:
                 links.append(abs_link)
     return links
 
-def get_content(url: str) -> Optional[List[str]]:
+def get_content(
+    url: str,
+    session: Optional[requests.Session]=None,
+    cache_dir: Optional[str]=None,
+    parser: str=DEFAULT_PARSER,
+    strain: bool=False
+) -> Optional[Dict]:
     """
-    Get title, purpose, and example from url page.
+    Get title, purpose, and example from url page (see fetch_html and parse_content).
     """
-    content = {}
-
-    response = requests.get(url)
-    if response.status_code != 200:
+    html = fetch_html(url, session=session, cache_dir=cache_dir)
+    if html is None:
         return None
+    return parse_content(html, parser=parser, strain=strain)
+
+def parse_content(html: bytes, parser: str=DEFAULT_PARSER, strain: bool=False) -> Optional[Dict]:
+    """
+    Get title, purpose, and example from the HTML of a help page.
+
+    Args
+        html: raw page
+        parser: BeautifulSoup parser, e.g. "lxml" or "html.parser"
+        strain: only parse the tags of HELP_PAGE_STRAINER
+    """
+    content = {}
 
-    soup = BeautifulSoup(response.content, "html.parser")
+    soup = BeautifulSoup(html, parser, parse_only=HELP_PAGE_STRAINER if strain else None)
     target = soup.find('h2',string=lambda text: text.strip().lower() == "example")
     if target is None:
         return None
@@ -91,179 +182,248 @@ def get_content(url: str) -> Optional[List[str]]:
 
     return content
 
-def scrape(index_page_url: str):
-    help_pages = get_links(index_page_url)
+def scrape(
+    index_page_url: str,
+    max_workers: int=16,
+    cache_dir: Optional[str]=None,
+    parser: str=DEFAULT_PARSER,
+    strain: bool=False
+) -> Dict[str, Dict]:
+    """
+    Fetch and parse the help pages linked from index_page_url with max_workers threads.
+    Returns dict of page url -> content, in link order (see get_content).
+    """
+    session = make_session(max_workers)
+    help_pages = get_links(index_page_url, session=session, cache_dir=cache_dir)
     if len(help_pages) == 0:
         raise ValueError("No links found on index page.")
+
+    def scrape_page(page: str) -> Optional[Dict]:
+        return get_content(page, session=session, cache_dir=cache_dir, parser=parser, strain=strain)
     
     content = {}
-    for page in tqdm(help_pages, desc="Scraping web pages"):
-        page_content = get_content(page)
-        if page_content is None:
-            logger.warn(f"Unable to locate example on page <{page}>")
-        else:
-            content[page] = page_content
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pages = executor.map(scrape_page, help_pages)
+        for page, page_content in tqdm(zip(help_pages, pages), total=len(help_pages), desc="Scraping web pages"):
+            if page_content is None:
+                logger.warn(f"Unable to locate example on page <{page}>")
+            else:
+                content[page] = page_content
 
+    session.close()
     return content
 
-def clean_examples(example_dict: Dict[str, Dict[str,str]]) -> Dict[str, Dict[str,str]]:
+def to_columns(
+    data_dict: Dict[str, Dict],
+    key_col_name: str="url",
+    null_val=None,
+    join_sep: Optional[str]=None
+) -> Dict[str, List]:
     """
-    Clean up examples
+    Convert nested dictionary to dict of form {key_col_name: [...], "col1": [...], ...}
+    in a single pass. A column is preallocated with null_val for every record when its 
+    field first appears, and filled by row, so columns are in order of first appearance.
+    Args
+        data_dict: nested dataset
+        null_val: value to use for nonexistent column val
+        join_sep: if given, list values are joined into strings with it
     """
-    clean_dict = {}
-    for k, v in example_dict.items():
-        raw_text = v["example"]
-        clean_text = []
-        for i, line in enumerate(raw_text):
-            # Probably a text line. definitely not perfect.
-            if i == 0 and ";" not in line and "@@" not in line and " = " not in line and not line.lstrip().startswith("#"):
-                line = line.replace("\n", " ").replace("  ", " ")
-
-            new_line = line.replace("If(", "if(").replace("While(", "while(")
-            new_line = new_line.replace("\n<<", " <<").replace("  <<", " <<")
-
-            # Naive approach to indent bracketed blocks. Nested brackets are rare, if they exist at all
-            if "{" in new_line:
-                pre_brack, post_brack = new_line.split("{", 1)
-                if "}" in post_brack:
-                    interior, exterior = post_brack.split("}", 1)
-                    interior = interior.replace("\n", "\n\t").replace('\\n\t', "\\n") # <- Handle escaped newlines
-                    if interior.endswith("\t"):
-                        interior = interior[:-1]
-                    new_line = pre_brack + "{" + interior + "}" + exterior
-
-            clean_text.append(new_line)
-                
-        v["example"] = clean_text
-        clean_dict[k] = v
-    return clean_dict
-
-import copy
-import sys
-
-def get_prompts(example_dict: Dict[str, Dict[str,str]]) -> Dict[str, Dict[str,str]]:
+    n = len(data_dict)
+    columns = {key_col_name: list(data_dict)}
+    for i, record in enumerate(data_dict.values()):
+        for field, val in record.items():
+            col = columns.get(field)
+            if col is None:
+                col = columns[field] = [null_val] * n
+            col[i] = join_sep.join(val) if join_sep is not None and isinstance(val, list) else val
+    return columns
+
+def flatten(data_dict: Dict[str, Dict[str,str]], key_col_name: str="url", null_val=None) -> Dict[str, List[str]]:
     """
-    Attempt to create prompts for examples
+    Convert nested dictionary to dict of form {"col1": [...], "col2": [...],...}, joining
+    list values with newlines (see to_columns).
+    Args
+        data_dict: nested dataset to flatten
+        null_val: value to use for nonexistent column val
     """
-    formatted_dict = {}
-    for k, v in example_dict.items():
-        example = v["example"]
-        prompt = []
-        purpose = v["purpose"] if "purpose" in v else None
-        if purpose is not None and "".join(v["purpose"]).lower().startswith("obsolete"):
-            continue
-
-        if example == [] or example == '':
-            continue
-        
-        first_line = example[0]
-        if first_line.strip().startswith("#"):
-            sublines = first_line.split("\n")
-            for l in sublines:
-                if l.startswith("#"):
-                    prompt.append(l)
-                else:
-                    break
-            for x in prompt:
-                sublines.remove(x)
-            example = sublines
-        elif ";" not in first_line and "<-" not in first_line and " = " not in first_line and "@" not in first_line:
-            prompt.append(first_line)
-            example = example[1:]
-        else:
-            if "purpose" in v:
-                prompt.append(v["purpose"])
-            
-        if prompt != []:
-            prompt = [" ".join(p) if isinstance(p, list) else p for p in prompt]
-            prompt = ". ".join(prompt).replace("#", "").replace("  ", " ").strip()
-            
-            # E.g. In this example, we define a function to...
-            if "," in prompt:
-                pre, post = prompt.split(",",1)
-                if len(pre) < 20:
-                    prompt = post.strip()
-            if prompt.lower().startswith("we "):
-                prompt = prompt[3:]
-            
-            prompt = "# " + prompt
-            v["prompt"] = prompt
-        else:
-            name = v["title"]
-            logger.warn(f"Unable to create prompt for {name}. Consider adding manually.")
-        
-        v["example"] = "\n".join(example)
+    return to_columns(data_dict, key_col_name=key_col_name, null_val=null_val, join_sep="\n")
 
-        formatted_dict[k] = v
-    
-    return formatted_dict
+def to_table(columns: Dict[str, List]) -> "pyarrow.Table":
+    import pyarrow as pa
+    return pa.table(columns)
 
+def save_columns(columns: Dict[str, List], save_path: str) -> None:
+    """
+    Write columns to a .parquet file, or as json otherwise.
+    """
+    if save_path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        pq.write_table(to_table(columns), save_path)
+    else:
+        with open(save_path, "w") as f:
+            json.dump(columns, f, indent=4)
 
-def scrape_and_process(index_page_url: str, save_path: str=None) -> Dict[str, str]:
+def save_data(data: Dict, save_path: str, key_col_name: str="url") -> None:
     """
-    Scrape help pages, clean resuling data and generate prompts, if possible.
+    Write a nested dataset or columns as json, in the layout given, or to a .parquet file
+    as columns.
     """
-    content = scrape(index_page_url)
-    clean_content = clean_examples(content)
-    if save_path is not None:
+    if save_path.endswith(".parquet"):
+        nested = not isinstance(data.get(key_col_name), list)
+        save_columns(to_columns(data, key_col_name=key_col_name) if nested else data, save_path)
+    else:
         with open(save_path, "w") as f:
-            json.dump(clean_content, f, indent=4)
-    content_w_prompts = get_prompts(clean_content)
-    return content_w_prompts
+            json.dump(data, f, indent=4)
 
-def flatten(data_dict: Dict[str, Dict[str,str]], key_col_name: str="url", null_val=None) -> Dict[str, List[str]]:
+def clean_example(raw_text: List[str]) -> List[str]:
     """
-    Convert nested dictionary to dict of form {"col1": [...], "col2": [...],...}
-    Args
-        data_dict: nested dataset to flatten
-        null_val: value to use for nonexistent column val
+    Clean up the paragraphs of an example
     """
-    flattened = {}
-    first_iter = True
-    for k, v in data_dict.items():
-        if first_iter:
-            flattened[key_col_name] = [k]
-        else:
-            flattened[key_col_name].append(k)
-        
-        col_length = len(flattened[key_col_name])
-        for field, val in v.items():
-            if isinstance(val, list):
-                clean_val = "\n".join(val)
-            else:
-                clean_val = val
-            if first_iter:
-                flattened[field] = [clean_val]
+    clean_text = []
+    for i, line in enumerate(raw_text):
+        # Probably a text line. definitely not perfect.
+        if i == 0 and ";" not in line and "@@" not in line and " = " not in line and not line.lstrip().startswith("#"):
+            line = line.replace("\n", " ").replace("  ", " ")
+
+        new_line = line.replace("If(", "if(").replace("While(", "while(")
+        new_line = new_line.replace("\n<<", " <<").replace("  <<", " <<")
+
+        # Naive approach to indent bracketed blocks. Nested brackets are rare, if they exist at all
+        if "{" in new_line:
+            pre_brack, post_brack = new_line.split("{", 1)
+            if "}" in post_brack:
+                interior, exterior = post_brack.split("}", 1)
+                interior = interior.replace("\n", "\n\t").replace('\\n\t', "\\n") # <- Handle escaped newlines
+                if interior.endswith("\t"):
+                    interior = interior[:-1]
+                new_line = pre_brack + "{" + interior + "}" + exterior
+
+        clean_text.append(new_line)
+    return clean_text
+
+def clean_records(data_dict: Dict[str, Dict]) -> Dict[str, Dict]:
+    """
+    Clean up the examples of a nested dataset (see scrape) in place, and return it.
+    """
+    for record in data_dict.values():
+        record["example"] = clean_example(record["example"])
+    return data_dict
+
+def make_prompt(
+    example: List[str],
+    purpose: Optional[List[str]]=None,
+    title: Optional[str]=None
+) -> Optional[Tuple[Optional[str], str]]:
+    """
+    Attempt to create a prompt for a cleaned example. Returns the prompt (None if it can't
+    be created) and the example text, or None if the example is obsolete or empty.
+    """
+    prompt = []
+    if purpose is not None and "".join(purpose).lower().startswith("obsolete"):
+        return None
+
+    if example == [] or example == '':
+        return None
+    
+    first_line = example[0]
+    if first_line.strip().startswith("#"):
+        sublines = first_line.split("\n")
+        for l in sublines:
+            if l.startswith("#"):
+                prompt.append(l)
             else:
-                if field not in flattened:
-                    col = [null_val] * col_length
-                    col[-1] = clean_val
-                    flattened[field] = col
-                else:
-                    flattened[field].append(clean_val)
+                break
+        for x in prompt:
+            sublines.remove(x)
+        example = sublines
+    elif ";" not in first_line and "<-" not in first_line and " = " not in first_line and "@" not in first_line:
+        prompt.append(first_line)
+        example = example[1:]
+    else:
+        if purpose is not None:
+            prompt.append(purpose)
+        
+    if prompt != []:
+        prompt = [" ".join(p) if isinstance(p, list) else p for p in prompt]
+        prompt = ". ".join(prompt).replace("#", "").replace("  ", " ").strip()
+        
+        # E.g. In this example, we define a function to...
+        if "," in prompt:
+            pre, post = prompt.split(",",1)
+            if len(pre) < 20:
+                prompt = post.strip()
+        if prompt.lower().startswith("we "):
+            prompt = prompt[3:]
         
-        if not first_iter:
-            for k, v in flattened.items():
-                if len(v) != col_length:
-                    flattened[k].append(null_val)
+        prompt = "# " + prompt
+    else:
+        prompt = None
+        logger.warn(f"Unable to create prompt for {title}. Consider adding manually.")
+    
+    return prompt, "\n".join(example)
+
+def add_prompts(data_dict: Dict[str, Dict]) -> Dict[str, Dict]:
+    """
+    Attempt to create prompts for the cleaned examples of a nested dataset (see make_prompt).
+    Obsolete and empty examples are dropped, the rest are joined into strings and get a
+    "prompt" field if one could be created. Kept records are updated in place.
+    """
+    formatted = {}
+    for key, record in data_dict.items():
+        made = make_prompt(record["example"], record.get("purpose"), record.get("title"))
+        if made is None:
+            continue
+        prompt, record["example"] = made
+        if prompt is not None:
+            record["prompt"] = prompt
+        formatted[key] = record
+    return formatted
 
-        first_iter = False
 
-        
-    return flattened                
+def scrape_and_process(index_page_url: str, save_path: str=None, **scrape_kwargs) -> Dict[str, Dict]:
+    """
+    Scrape help pages, clean resuling data and generate prompts, if possible.
+    Returns the nested dataset, scrape_kwargs are passed to scrape. The cleaned
+    data is saved to save_path (see save_data).
+    """
+    content = scrape(index_page_url, **scrape_kwargs)
+    clean_content = clean_records(content)
+    if save_path is not None:
+        save_data(clean_content, save_path)
+    content_w_prompts = add_prompts(clean_content)
+    return content_w_prompts
 
 def run(
     index_page_url: str, 
     save_path: Optional[str]=None,
-    flatten_dataset: bool=True
+    flatten_dataset: bool=True,
+    **scrape_kwargs
 ) -> Union[Dict[str, List[str]], Dict[str, Dict[str,str]]]:
     """
-    Scrape, process, save, and return
+    Scrape, process, save, and return. scrape_kwargs are passed to scrape.
+    Returns (and saves) the flattened columns, or the nested dataset if not flatten_dataset.
+    Json files keep these layouts ({url: {field: ...}} for <name>_clean.json), .parquet
+    files hold columns (see save_data).
     """
-    data = scrape_and_process(index_page_url, save_path=save_path.replace(".json", "_clean.json"))
+    root, ext = os.path.splitext(save_path) if save_path is not None else (None, None)
+    clean_save_path = f"{root}_clean{ext}" if save_path is not None else None
+    data = scrape_and_process(index_page_url, save_path=clean_save_path, **scrape_kwargs)
     data = flatten(data) if flatten_dataset else data
     if save_path is not None:
-        with open(save_path, "w") as f:
-            json.dump(data, f, indent=4)
+        save_data(data, save_path)
     return data
 
+def parse_args():
+    arg_parser = ArgumentParser(description = "Scrape Visual Text help pages into a prompt dataset.")
+    arg_parser.add_argument("--index_page_url", type=str, required=True, help="Page linking to the help pages.")
+    arg_parser.add_argument("--save_path", type=str, default=None, help="Path to write json or .parquet data.")
+    arg_parser.add_argument("--max_workers", type=int, default=16, help="Number of concurrent requests.")
+    arg_parser.add_argument("--cache_dir", type=str, default=None, help="Directory caching raw HTML pages.")
+    arg_parser.add_argument("--parser", type=str, default=DEFAULT_PARSER, help="BeautifulSoup parser, e.g. lxml (faster, if installed).")
+    arg_parser.add_argument("--strain", action="store_true", help="Only parse the tags read from help pages.")
+    return arg_parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    _ = run(args.index_page_url, save_path=args.save_path, max_workers=args.max_workers,
+            cache_dir=args.cache_dir, parser=args.parser, strain=args.strain)
@@ -3,6 +3,10 @@ Annotator
 
 Annotator for .nlp files. Facilitates the addition of comments 
 to nlp pass files to prepare for code generation clm training.
+
+Dataset holds the samples being annotated as an in-memory pyarrow Table. Indexing and
+slicing are zero-copy, edits are kept in an overlay until the dataset is saved or
+converted, and datasets are saved as Arrow IPC stream files that load memory-mapped.
 """
 
 import pandas as pandas
@@ -10,12 +14,11 @@ import math
 import re
 import os
 import typing 
-from typing import Union, List, Tuple, Dict
+from typing import Union, List, Tuple, Dict, Optional
 from tqdm import tqdm
 import logging
 import warnings
-import pickle
-from datasets import Dataset
+import pyarrow as pa
 
 logger = logging.getLogger(__name__)
 
@@ -31,88 +34,177 @@ class Annotator:
         warnings.warn('utils.annotator.Annotator is deprecated.', DeprecationWarning, stacklevel=2)
 
 class Dataset:
-    def __init__(self, dataset: Union[List[str], dict], text_column_name: str="text"):
+    def __init__(self, dataset: Union[List[str], dict, pa.Table], text_column_name: str="text"):
+        """
+        Columnar dataset of a list of texts, a dict of columns or a pyarrow Table.
+        """
         if isinstance(dataset, list):
-            self._dataset = {text_column_name: dataset}
-        else:
-            self._dataset = dataset
-        
+            dataset = {text_column_name: dataset}
+        self._table = dataset if isinstance(dataset, pa.Table) else pa.table(dataset)
+        if text_column_name not in self._table.column_names:
+            raise KeyError(f"Column '{text_column_name}' not in dataset.")
+
         self.text_column_name = text_column_name
-        self.column_names = [text_column_name]
+        self.column_names = self._table.column_names
+        # Edited rows, index -> {column: value}, applied on read and on materialize
+        self._edits = {}
+        # Arrow file memory mapped by _table, if any
+        self._path = None
 
-        warnings.warn('utils.annotator.Dataset is deprecated.', DeprecationWarning, stacklevel=2)
-        
-    def __getitem__(self, key: Union[slice, int]):
+    def _index(self, key: int) -> int:
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError(f"Index {key} out of range for dataset of size {len(self)}.")
+        return key
+
+    def __getitem__(self, key: Union[slice, int, str]):
+        """
+        Row dict of an int key, dict of columns of a slice, or the values of a column name.
+        """
         if isinstance(key, slice):
-            result = {}
-            for k, v in self._dataset:
-                result[k] = v[key]
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                result = self._table.slice(start, max(stop - start, 0)).to_pydict()
+            else:
+                result = self._table.take(pa.array(range(start, stop, step), type=pa.int64())).to_pydict()
+            for i, row in self._edits.items():
+                if i in range(start, stop, step):
+                    for k, v in row.items():
+                        result[k][(i - start) // step] = v
         elif isinstance(key, int):
-            result = {}
-            for k, v in self._dataset:
-                result[k] = v[key]
+            key = self._index(key)
+            result = self._table.slice(key, 1).to_pylist()[0]
+            result.update(self._edits.get(key, {}))
+        elif isinstance(key, str):
+            if key not in self.column_names:
+                raise KeyError(f"Column '{key}' not in dataset.")
+            result = self._table.column(key).to_pylist()
+            for i, row in self._edits.items():
+                if key in row:
+                    result[i] = row[key]
         else:
-            raise ValueError
+            raise ValueError("Key must be type slice, int or str.")
         
         return result
     
     def __setitem__(self, key: int, value: Union[str, dict]):
+        """
+        Set the text of a single column dataset (str value), or every column of a row (dict value).
+        Values must convert to their column's type.
+        """
+        key = self._index(key)
         if isinstance(value, str):
-            if len(self._dataset) > 1:
-                logger.warn(f"Columns in value (1) must match dataset ({len(self._dataset)}).")
+            if len(self.column_names) > 1:
+                logger.warning(f"Columns in value (1) must match dataset ({len(self.column_names)}).")
                 raise ValueError
-            self._dataset[self.text_column_name][key]
+            value = {self.text_column_name: value}
 
         elif isinstance(value, dict):
-            if set(value.keys()) != set(self._dataset):
-                logger.warn(f"Columns in value (1) must match dataset ({len(self._dataset)}).")
+            if set(value.keys()) != set(self.column_names):
+                logger.warning(f"Columns in value ({len(value)}) must match dataset ({len(self.column_names)}).")
                 raise ValueError
             
         else:
             raise ValueError("Value must be type str or dict.")
 
+        # Check types now, rather than when edits are applied (to_table)
+        for k, v in value.items():
+            field = self._table.schema.field(k)
+            try:
+                pa.scalar(v, type=field.type)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError) as e:
+                raise ValueError(f"Value {v!r} of column '{k}' doesn't match its type {field.type}: {e}") from e
+        self._edits[key] = dict(value)
+
     def __len__(self):
-        return len(self._dataset[self.text_column_name])
+        return self._table.num_rows
 
     def _set_column_names(self):
         """
         Update column_names.
         """
-        self.column_names = list(self._dataset.keys())
+        self.column_names = self._table.column_names
 
     def rename_columns(self, column_mapping: Dict[str,str]):
         """
         Rename column(s) using mapping. 
         """
+        names = list(self.column_names)
         for k, v in column_mapping.items():
-            if k not in self._dataset:
+            if k not in names:
                 raise KeyError(f"Column '{k}' not in dataset.")
-            if v in self.dataset:
+            if v in names:
                 raise ValueError(f"Column '{v}' already in dataset.")
-            self._dataset[v] = self._dataset[k]
-            del self._dataset[k]
-
+            names[names.index(k)] = v
+        
+        self._table = self._table.rename_columns(names)
+        self._path = None
+        self._edits = {
+            i: {column_mapping.get(k, k): v for k, v in row.items()}
+            for i, row in self._edits.items()
+        }
+        self.text_column_name = column_mapping.get(self.text_column_name, self.text_column_name)
         self._set_column_names()
+
+    def to_table(self) -> pa.Table:
+        """
+        Table with pending edits applied. Edited columns are rebuilt once, others are shared.
+        """
+        if self._edits:
+            table = self._table
+            for j, name in enumerate(table.column_names):
+                edits = {i: row[name] for i, row in self._edits.items() if name in row}
+                if edits:
+                    values = table.column(name).to_pylist()
+                    for i, v in edits.items():
+                        values[i] = v
+                    table = table.set_column(j, table.field(j), pa.array(values, type=table.field(j).type))
+            self._table = table
+            self._edits = {}
+            self._path = None
+        return self._table
     
-    def to_hf_dataset(self):
+    def to_hf_dataset(self) -> "datasets.Dataset":
         """
-        Convert dataset to datasets.Dataset
+        Convert dataset to datasets.Dataset, sharing the arrow buffers. A random fingerprint
+        is used, since hashing the table would serialize every sample.
         """
-        return Dataset.from_dict(self._dataset)
+        from datasets import Dataset as HFDataset
+        from datasets.table import InMemoryTable, MemoryMappedTable
+        from datasets.fingerprint import generate_random_fingerprint
+        table = self.to_table()
+        # Memory mapped tables are pickled (e.g. for .map(num_proc=...)) as their path
+        table = MemoryMappedTable(table, self._path) if self._path is not None else InMemoryTable(table)
+        return HFDataset(table, fingerprint=generate_random_fingerprint())
 
     def save_dataset(self, save_path: str):
         """
-        pickle dataset
+        Write dataset to an Arrow IPC stream file (the format of datasets' cache files, so it
+        also opens with datasets.Dataset.from_file), see load_dataset.
         """
-        with open(save_path, "wb") as f:
-            pickle.dump(self.__dict__, f)
+        table = self.to_table()
+        metadata = dict(table.schema.metadata or {})
+        metadata[b"text_column_name"] = self.text_column_name.encode()
+        table = table.replace_schema_metadata(metadata)
+
+        # Write then rename, so that an interrupted save leaves no partial file
+        tmp_path = f"{save_path}.{os.getpid()}.tmp"
+        with pa.OSFile(tmp_path, "wb") as sink:
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, save_path)
 
     @classmethod
-    def load_dataset(cls, dataset_path: str) -> Dataset:
+    def load_dataset(cls, dataset_path: str) -> "Dataset":
         """
-        Load saved dataset from file.
+        Load saved dataset from file. The file is memory mapped, so loading reads no 
+        samples and they are paged in as they are accessed.
         """
-        with open(save_path, "rb") as f:
-            dataset = pickle.load(f)
-            return cls(dataset["_dataset"], dataset["text_column_name"])
-
+        with pa.memory_map(dataset_path, "r") as source:
+            table = pa.ipc.open_stream(source).read_all()
+        metadata = table.schema.metadata or {}
+        text_column_name = metadata.get(b"text_column_name", b"text").decode()
+        dataset = cls(table, text_column_name)
+        dataset._path = dataset_path
+        return dataset
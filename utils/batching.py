@@ -0,0 +1,239 @@
+"""
+Continuous (dynamic) batching of generation requests over one causal lm. Includes:
+ - cache_tensors(cache), make_cache(kv), crop_cache(cache, length)
+ - prefill(model, input_ids, prefix_cache)
+ - BatchScheduler
+
+BatchScheduler decodes the running requests together, one token per request per
+forward pass. Requests are prefilled one at a time and admitted into the batch between
+decoding steps, and finished requests are retired right away, so a long completion
+never holds back short ones. The batch KV cache is left padded to its longest request,
+padding is masked out and every request keeps its own position ids.
+
+Requests are duck typed, see utils.completion.GenerationRequest: input_ids, last_token,
+push(logits) -> finished and finish(error).
+"""
+import time
+import queue
+import threading
+import typing
+from typing import (
+    Optional,
+    Tuple,
+    List,
+    Dict
+)
+import logging
+
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+
+logger = logging.getLogger(__name__)
+
+KV = List[Tuple[torch.Tensor, torch.Tensor]]
+
+_STOP = object()
+
+
+def cache_tensors(cache) -> KV:
+    """
+    Per layer (keys, values) tensors of shape [batch, heads, length, head dim] of a cache.
+    """
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    if hasattr(cache, "key_cache"):
+        return list(zip(cache.key_cache, cache.value_cache))
+    return [(k, v) for k, v, *_ in cache]
+
+
+def make_cache(kv: KV) -> DynamicCache:
+    return DynamicCache(kv)
+
+
+def crop_cache(cache, length: int) -> DynamicCache:
+    """
+    Cache of the first length positions of cache.
+    """
+    return make_cache([(k[:, :, :length], v[:, :, :length]) for k, v in cache_tensors(cache)])
+
+
+def pad_left(kv: KV, length: int) -> KV:
+    """
+    Left pad the length dimension of every tensor of kv to length.
+    """
+    pad = length - kv[0][0].shape[2]
+    if pad == 0:
+        return kv
+    return [(F.pad(k, (0, 0, pad, 0)), F.pad(v, (0, 0, pad, 0))) for k, v in kv]
+
+
+@torch.no_grad()
+def prefill(model, input_ids: List[int], prefix_cache=None) -> Tuple[torch.Tensor, DynamicCache]:
+    """
+    Last position logits and cache of a forward pass over input_ids. With a prefix cache
+    (see utils.prefix_cache.PrefixCache), only the tokens after the longest cached prefix
+    are computed, and the states of input_ids are added to the cache.
+    """
+    device = next(model.parameters()).device
+    n_cached, kv = prefix_cache.lookup(input_ids) if prefix_cache is not None else (0, None)
+    out = model(
+        input_ids=torch.tensor([input_ids[n_cached:]], device=device),
+        past_key_values=make_cache(kv) if kv is not None else None,
+        use_cache=True
+    )
+    if prefix_cache is not None:
+        prefix_cache.insert(input_ids, cache_tensors(out.past_key_values))
+    return out.logits[0, -1], out.past_key_values
+
+
+class BatchScheduler:
+    """
+    Run submitted requests in a continuous batch from a background thread.
+
+    Args
+        model: causal lm, in eval mode
+        max_batch_size: maximum number of requests decoded together
+        max_wait: latency budget, seconds an idle scheduler waits for more requests to
+            start a batch with, once a first request arrives
+        prefix_cache: optional utils.prefix_cache.PrefixCache used to prefill requests
+    """
+    def __init__(self, model, max_batch_size: int=8, max_wait: float=0.005, prefix_cache=None):
+        self.model = model
+        self.prefix_cache = prefix_cache
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.device = next(model.parameters()).device
+        self.pending = queue.Queue()
+        self.n_steps = 0
+        self.n_decoded = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, request) -> None:
+        self.pending.put(request)
+
+    def close(self) -> None:
+        """
+        Stop the scheduler once the submitted requests are done.
+        """
+        self.pending.put(_STOP)
+        self._thread.join()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "steps": self.n_steps,
+            "mean_batch_size": self.n_decoded / self.n_steps if self.n_steps else 0.0,
+        }
+
+    def _admit(self, block: bool, n: int) -> Tuple[list, bool]:
+        """
+        Up to n pending requests, and whether the scheduler was stopped. If block, waits for
+        a first request, then up to max_wait for more.
+        """
+        new = []
+        deadline = None
+        while len(new) < n:
+            try:
+                if block and not new:
+                    request = self.pending.get()
+                    deadline = time.perf_counter() + self.max_wait
+                elif deadline is not None and deadline > time.perf_counter():
+                    request = self.pending.get(timeout=deadline - time.perf_counter())
+                else:
+                    request = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            if request is _STOP:
+                return new, True
+            new.append(request)
+        return new, False
+
+    def _prefill(self, request) -> KV:
+        logits, cache = prefill(self.model, request.input_ids, self.prefix_cache)
+        request.length = len(request.input_ids)
+        if request.push(logits):
+            return None
+        return cache_tensors(cache)
+
+    def _run(self) -> None:
+        active = []
+        # Batch cache (kept across steps while the batch doesn't change) and attention mask
+        cache, mask = None, None
+        stopped = False
+        while not (stopped and not active):
+            new = []
+            try:
+                if not stopped:
+                    new, stopped = self._admit(block=not active, n=self.max_batch_size - len(active))
+                    for request in new:
+                        request_kv = self._prefill(request)
+                        if request_kv is not None:
+                            cache, mask = self._merge(cache, mask, request_kv)
+                            active.append(request)
+                if not active:
+                    continue
+
+                finished = self._step(active, cache, mask)
+                mask = torch.cat([mask, mask.new_ones(len(active), 1)], dim=1)
+                if finished:
+                    keep = [i for i in range(len(active)) if i not in finished]
+                    active = [active[i] for i in keep]
+                    cache, mask = self._select(cache, mask, keep)
+            except Exception as e:
+                logger.exception("Batch decoding failed")
+                for request in set(active) | set(new):
+                    request.finish(e)
+                active, cache, mask = [], None, None
+
+    def _merge(self, cache: Optional[DynamicCache], mask: Optional[torch.Tensor], request_kv: KV) -> Tuple[DynamicCache, torch.Tensor]:
+        """
+        Add a prefilled request to the batch, left padding both to the same length.
+        """
+        request_mask = torch.ones(1, request_kv[0][0].shape[2], dtype=torch.long, device=self.device)
+        if cache is None:
+            return make_cache(request_kv), request_mask
+        length = max(mask.shape[1], request_mask.shape[1])
+        kv = [
+            (torch.cat([k, rk]), torch.cat([v, rv]))
+            for (k, v), (rk, rv) in zip(pad_left(cache_tensors(cache), length), pad_left(request_kv, length))
+        ]
+        mask = torch.cat([F.pad(mask, (length - mask.shape[1], 0)), F.pad(request_mask, (length - request_mask.shape[1], 0))])
+        return make_cache(kv), mask
+
+    def _select(self, cache: DynamicCache, mask: torch.Tensor, keep: List[int]) -> Tuple[Optional[DynamicCache], Optional[torch.Tensor]]:
+        """
+        Keep the batch rows of keep, dropping padding columns no row needs anymore.
+        """
+        if not keep:
+            return None, None
+        index = torch.tensor(keep, device=self.device)
+        mask = mask[index]
+        start = int((mask.sum(dim=0) > 0).nonzero()[0])
+        kv = [(k[index, :, start:], v[index, :, start:]) for k, v in cache_tensors(cache)]
+        return make_cache(kv), mask[:, start:]
+
+    @torch.no_grad()
+    def _step(self, active: list, cache: DynamicCache, mask: torch.Tensor) -> set:
+        """
+        Decode one token for every active request, updating cache in place. Returns the
+        indices of finished requests.
+        """
+        input_ids = torch.tensor([[request.last_token] for request in active], device=self.device)
+        position_ids = torch.tensor([[request.length] for request in active], device=self.device)
+        out = self.model(
+            input_ids=input_ids,
+            attention_mask=torch.cat([mask, mask.new_ones(len(active), 1)], dim=1),
+            position_ids=position_ids,
+            past_key_values=cache,
+            use_cache=True
+        )
+        self.n_steps += 1
+        self.n_decoded += len(active)
+
+        finished = set()
+        for i, request in enumerate(active):
+            request.length += 1
+            if request.push(out.logits[i, -1]):
+                finished.add(i)
+        return finished
@@ -0,0 +1,52 @@
+"""
+Persistent store of git blob contents keyed by blob SHA, for incremental scraping. Includes:
+ - BlobStore
+
+Git blobs are immutable, so a blob that is stored once never has to be fetched again:
+re-scraping a mostly unchanged user only costs the repo and tree listing requests.
+Every blob is committed as soon as it is stored, so an interrupted scrape resumes
+where it stopped.
+"""
+import typing
+from typing import Optional
+import logging
+
+from utils.sqlite_store import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+
+class BlobStore(SqliteStore):
+    """
+    SQLite table of blob SHA -> raw (base64 decoded) blob content. Safe to share between threads.
+
+    Args
+        path: database file, created if it doesn't exist
+    """
+    TABLE = "blobs"
+    COLUMNS = "sha TEXT PRIMARY KEY, content BLOB NOT NULL"
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, sha: str) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM blobs WHERE sha = ?", (sha,)).fetchone() is not None
+
+    def get(self, sha: str) -> Optional[bytes]:
+        """
+        Content of blob sha, or None if it isn't stored.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT content FROM blobs WHERE sha = ?", (sha,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return bytes(row[0])
+
+    def put(self, sha: str, content: bytes) -> None:
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO blobs (sha, content) VALUES (?, ?)", (sha, content))
@@ -0,0 +1,236 @@
+"""
+Array-backed chunking of tokenized sequences. Includes:
+ - flatten_sequences(sequences)
+ - chunk_boundaries(flat_ids, offsets, chunk_size, split_id, split_search_prop)
+ - split_batch_into_chunks(sequences, chunk_size, split_id, split_search_prop)
+ - group_chunks(chunks, block_size, min_seq_len, prefix_ids, suffix_ids)
+ - retokenize_chunks(chunks, tokenizer, block_size, min_seq_len)
+
+Produces the same chunks as run_clm.split_ids_into_chunks, but works on a whole
+batch at once: separator positions are located with a single vectorized pass
+over the flattened ids instead of re-slicing and re-scanning python lists.
+Chunks are turned into lm features directly from their ids (group_chunks), or
+by the older decode and re-tokenize round trip (retokenize_chunks).
+"""
+import typing
+from typing import (
+    Union,
+    Optional,
+    List,
+    Tuple
+)
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def flatten_sequences(sequences: List[List[int]]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Concatenate a batch of id sequences into one flat array.
+
+    Args
+        sequences: list of lists of token ids
+    Returns
+        flat_ids: 1d int64 array of all ids
+        offsets: 1d int64 array of len(sequences)+1, sequence i is flat_ids[offsets[i]:offsets[i+1]]
+    """
+    lengths = np.fromiter((len(seq) for seq in sequences), dtype=np.int64, count=len(sequences))
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    if offsets[-1] == 0:
+        return np.zeros(0, dtype=np.int64), offsets
+    flat_ids = np.concatenate([np.asarray(seq, dtype=np.int64) for seq in sequences])
+    return flat_ids, offsets
+
+
+def _last_occurrence(flat_ids: np.ndarray, val: int) -> np.ndarray:
+    """
+    For every position i, the index of the last occurrence of val at or before i (-1 if none).
+    """
+    positions = np.where(flat_ids == val, np.arange(len(flat_ids), dtype=np.int64), -1)
+    return np.maximum.accumulate(positions) if len(positions) > 0 else positions
+
+
+def chunk_boundaries(
+    flat_ids: np.ndarray,
+    offsets: np.ndarray,
+    chunk_size: int=1024,
+    split_id: Optional[Union[int, List[int]]]=None,
+    split_search_prop: float=0.125
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute chunk boundaries for every sequence in a flattened batch.
+
+    Args
+        flat_ids: 1d array of concatenated token ids (see flatten_sequences)
+        offsets: 1d array of sequence offsets into flat_ids, len = n_sequences + 1
+        chunk_size: positive int. Max size of chunks
+        split_id: Token id or list of ids (desc. priority) to split on (if possible). Splits on last occurence
+                  within the final floor(chunk_size*split_search_prop) ids of a chunk.
+        split_search_prop: Proportion of ids to search for split_id
+    Returns
+        starts, ends: 1d int64 arrays of absolute [start, end) indices into flat_ids, one entry per chunk,
+                      in sequence order. Sequences no longer than chunk_size yield a single chunk.
+    """
+    if chunk_size <= 0:
+        raise ValueError("chunk_size should be a positive int.")
+
+    if split_id is not None:
+        if not isinstance(split_id, list):
+            split_id = [split_id]
+        if split_search_prop >= 1.0 or split_search_prop < 0.0:
+            raise ValueError("split_search_prop should be a float between zero and one.")
+        search_start = chunk_size - int(chunk_size * split_search_prop)
+        # One vectorized pass per separator, reused by every chunk in the batch
+        last_seps = [_last_occurrence(flat_ids, sep) for sep in split_id]
+    else:
+        last_seps = []
+
+    offsets = np.asarray(offsets, dtype=np.int64)
+    starts = []
+    ends = []
+    for seq_start, seq_end in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+        start = seq_start
+        while seq_end - start > chunk_size:
+            end = start + chunk_size
+            window_start = start + search_start if last_seps else end
+            for last_sep in last_seps:
+                # Window is non-empty and lies inside this sequence since seq_end - start > chunk_size
+                sep_idx = last_sep[end - 1] if window_start < end else -1
+                if sep_idx >= window_start:
+                    end = int(sep_idx)
+                    break
+            starts.append(start)
+            ends.append(end)
+            start = end
+        starts.append(start)
+        ends.append(seq_end)
+
+    return np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+
+
+def split_batch_into_chunks(
+    sequences: List[List[int]],
+    chunk_size: int=1024,
+    split_id: Optional[Union[int, List[int]]]=None,
+    split_search_prop: float=0.125
+) -> List[List[int]]:
+    """
+    Split every sequence in a batch into chunks of at most chunk_size ids.
+
+    Args
+        sequences: list of lists of token ids
+        chunk_size, split_id, split_search_prop: see chunk_boundaries
+    Returns
+        Flat list of chunks (lists of ids), in sequence order
+    """
+    # Only sequences longer than chunk_size need splitting, so only those are converted to arrays
+    long_idxs = [i for i, seq in enumerate(sequences) if len(seq) > chunk_size]
+    if len(long_idxs) == 0:
+        return [seq for seq in sequences]
+
+    flat_ids, offsets = flatten_sequences([sequences[i] for i in long_idxs])
+    starts, ends = chunk_boundaries(flat_ids, offsets, chunk_size=chunk_size,
+                                    split_id=split_id, split_search_prop=split_search_prop)
+    flat_ids = flat_ids.tolist()
+    # Chunk starts that coincide with a sequence start mark where each long sequence's chunks begin
+    seq_first_chunk = np.searchsorted(starts, offsets[:-1]).tolist() + [len(starts)]
+    starts, ends = starts.tolist(), ends.tolist()
+
+    chunks = []
+    long_pos = 0
+    for i, seq in enumerate(sequences):
+        if long_pos < len(long_idxs) and long_idxs[long_pos] == i:
+            for c in range(seq_first_chunk[long_pos], seq_first_chunk[long_pos + 1]):
+                chunks.append(flat_ids[starts[c]:ends[c]])
+            long_pos += 1
+        else:
+            chunks.append(seq)
+    return chunks
+
+
+def special_token_affixes(tokenizer) -> Tuple[List[int], List[int]]:
+    """
+    Find the special ids a tokenizer adds around text (e.g. BOS for llama).
+
+    Returns
+        prefix_ids, suffix_ids: ids added before and after the text ids by tokenizer(text)
+    """
+    with_special = tokenizer("x")["input_ids"]
+    plain = tokenizer("x", add_special_tokens=False)["input_ids"]
+    for start in range(len(with_special) - len(plain) + 1):
+        if with_special[start:start + len(plain)] == plain:
+            return with_special[:start], with_special[start + len(plain):]
+    logger.warning("Unable to locate special tokens added by tokenizer. Assuming none.")
+    return [], []
+
+
+def retokenize_chunks(
+    chunks: List[List[int]],
+    tokenizer,
+    block_size: int,
+    min_seq_len: int=0
+) -> dict:
+    """
+    Build lm features by decoding chunks and tokenizing the text again.
+    Doubles tokenization cost and may not reproduce the original ids, see group_chunks.
+
+    Args
+        chunks: lists of token ids (see split_batch_into_chunks)
+        tokenizer: tokenizer used to produce the ids
+        block_size: max length of tokenized chunk, including special tokens
+        min_seq_len: chunks with min_seq_len ids or fewer are discarded
+    Returns
+        Dict with "input_ids", "attention_mask", "labels"
+    """
+    decoded_text = [tokenizer.decode(seq) for seq in chunks if len(seq) > min_seq_len]
+    results = tokenizer(decoded_text, truncation=True, max_length=block_size)
+    results["labels"] = results["input_ids"].copy()
+    return results
+
+
+def group_chunks(
+    chunks: List[List[int]],
+    block_size: int,
+    min_seq_len: int=0,
+    prefix_ids: Optional[List[int]]=None,
+    suffix_ids: Optional[List[int]]=None
+) -> dict:
+    """
+    Build lm features directly from chunk ids.
+
+    Special ids are added as tokenizer(text, truncation=True, max_length=block_size) would add them,
+    except that they are not repeated on chunks which already start (or end) with them,
+    e.g. the first chunk of a document tokenized with its BOS.
+
+    Args
+        chunks: lists of token ids (see split_batch_into_chunks)
+        block_size: max length of a feature, including special tokens
+        min_seq_len: chunks with min_seq_len ids or fewer are discarded
+        prefix_ids: ids to add before each chunk (see special_token_affixes)
+        suffix_ids: ids to add after each chunk
+    Returns
+        Dict with "input_ids", "attention_mask", "labels"
+    """
+    prefix_ids = prefix_ids or []
+    suffix_ids = suffix_ids or []
+    n_prefix, n_suffix = len(prefix_ids), len(suffix_ids)
+
+    input_ids = []
+    for seq in chunks:
+        if len(seq) <= min_seq_len:
+            continue
+        has_prefix = n_prefix > 0 and seq[:n_prefix] == prefix_ids
+        has_suffix = n_suffix > 0 and seq[-n_suffix:] == suffix_ids
+        body = seq[n_prefix if has_prefix else 0:len(seq) - n_suffix if has_suffix else len(seq)]
+        # Truncate body, keeping special ids, like tokenizer truncation
+        body = body[:max(block_size - n_prefix - n_suffix, 0)]
+        input_ids.append(prefix_ids + body + suffix_ids)
+
+    return {
+        "input_ids": input_ids,
+        "attention_mask": [[1] * len(ids) for ids in input_ids],
+        "labels": [list(ids) for ids in input_ids],
+    }
@@ -0,0 +1,433 @@
+"""
+Code completion with a causal LM loaded once and kept in memory. Includes:
+ - load_model(model_path, tokenizer_path)
+ - build_tiny_model()
+ - GenerationRequest
+ - CompletionEngine
+
+CompletionEngine decodes one token at a time over a KV cache, so completions can be
+streamed as they are generated, left to right or filling in the middle between a prefix
+and a suffix (see utils.infill), and with a drafter greedy completions decode several
+tokens per forward pass (see utils.speculative). It is thread safe: concurrent requests take turns
+running forward passes, one decoding step at a time, or with max_batch_size over 1 are
+decoded together in a continuous batch (see utils.batching). See
+scripts/completion_server.py for an HTTP server on top of it.
+
+build_tiny_model gives a small randomly initialized Llama with a byte-level BPE tokenizer
+(or a SentencePiece-style one, as CodeLlama's) trained on synthetic NLP++ code, to run
+and test the completion path on CPU, offline.
+"""
+import time
+import queue
+import string
+import random
+import threading
+import typing
+from typing import (
+    Optional,
+    Iterator,
+    Tuple,
+    List,
+    Dict
+)
+import logging
+
+import torch
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    PreTrainedModel,
+    PreTrainedTokenizerBase
+)
+
+from utils.batching import BatchScheduler, prefill
+from utils.prefix_cache import PrefixCache
+from utils.infill import fim_token_ids, infill_ids
+from utils.speculative import SpeculativeDecoder
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+def load_model(
+    model_path: str,
+    tokenizer_path: Optional[str]=None,
+    device: str="cpu",
+    torch_dtype: Optional[torch.dtype]=None
+) -> Tuple[PreTrainedModel, PreTrainedTokenizerBase]:
+    """
+    Load model from model_path and tokenizer from tokenizer_path (default model_path), in eval mode.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path if tokenizer_path is not None else model_path)
+    # Only pass the dtype if set, its keyword was renamed in recent transformers versions
+    dtype_kwargs = {"torch_dtype": torch_dtype} if torch_dtype is not None else {}
+    model = AutoModelForCausalLM.from_pretrained(model_path, **dtype_kwargs)
+    return model.to(device).eval(), tokenizer
+
+
+def nlp_pp_samples(n: int, seed: int=0) -> List[str]:
+    """
+    Synthetic NLP++ passes, e.g. to train the tokenizer of build_tiny_model.
+    """
+    rng = random.Random(seed)
+    return [
+        f"###############################################\n# FILE: pass{i}.nlp\n"
+        f"###############################################\n\n@NODES _ROOT\n\n@RULES\n"
+        + "".join(
+            f"_{rng.choice(['xNIL', 'noun', 'verb', 'phrase'])} <- _xWILD [one match=(word{rng.randrange(1000)})] "
+            f"_xWHITE [star] @@\n" for _ in range(rng.randint(2, 8))
+        )
+        + "\n@POST\n  G(\"count\") = G(\"count\") + 1;\n  single();\n@@POST\n"
+        for i in range(n)
+    ]
+
+
+def build_tiny_model(
+    vocab_size: int=512,
+    hidden_size: int=64,
+    num_hidden_layers: int=2,
+    num_attention_heads: int=4,
+    seed: int=0,
+    special_tokens: Optional[List[str]]=None,
+    sentencepiece: bool=False
+) -> Tuple[PreTrainedModel, PreTrainedTokenizerBase]:
+    """
+    Randomly initialized Llama and a byte-level BPE tokenizer (with <s>, </s> and <unk>,
+    plus special_tokens) trained on nlp_pp_samples. Needs no download or GPU. With
+    sentencepiece, the tokenizer works like (Code)Llama's instead: spaces become "▁", a
+    dummy "▁" is prepended to the text and stripped again when decoding.
+    """
+    from tokenizers import Tokenizer, models, normalizers, pre_tokenizers, decoders, trainers, processors
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    base_tokens = ["<unk>", "<s>", "</s>"]
+    bpe = Tokenizer(models.BPE(unk_token="<unk>"))
+    if sentencepiece:
+        # As Llama's: spaces become "▁" and a "▁" is prepended, words keep the "▁" in
+        # front of them and newlines are tokens of their own (byte fallback tokens)
+        bpe.normalizer = normalizers.Sequence([normalizers.Prepend("▁"), normalizers.Replace(" ", "▁")])
+        bpe.pre_tokenizer = pre_tokenizers.Sequence([
+            pre_tokenizers.Split("\n", behavior="isolated"),
+            pre_tokenizers.Split("▁", behavior="merged_with_next")
+        ])
+        bpe.decoder = decoders.Sequence([decoders.Replace("▁", " "), decoders.Fuse(), decoders.Strip(" ", 1, 0)])
+        alphabet = list(string.printable) + ["▁"]
+    else:
+        bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+        bpe.decoder = decoders.ByteLevel()
+        alphabet = pre_tokenizers.ByteLevel.alphabet()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=base_tokens + list(special_tokens or []),
+        initial_alphabet=alphabet,
+        show_progress=False
+    )
+    bpe.train_from_iterator(nlp_pp_samples(200, seed=seed), trainer=trainer)
+    bpe.post_processor = processors.TemplateProcessing(single="<s> $A", special_tokens=[("<s>", bpe.token_to_id("<s>"))])
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=bpe,
+        unk_token="<unk>",
+        bos_token="<s>",
+        eos_token="</s>",
+        additional_special_tokens=list(special_tokens or [])
+    )
+
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=num_hidden_layers,
+        num_attention_heads=num_attention_heads,
+        num_key_value_heads=max(num_attention_heads // 2, 1),
+        max_position_embeddings=4096,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.eos_token_id
+    )
+    torch.manual_seed(seed)
+    return LlamaForCausalLM(config).eval(), tokenizer
+
+
+def select_token(
+    logits: torch.Tensor,
+    temperature: float=0.0,
+    top_p: float=1.0,
+    generator: Optional[torch.Generator]=None
+) -> int:
+    """
+    Next token id from last position logits, greedy if temperature is 0, else sampled
+    from the top_p nucleus of the tempered distribution.
+    """
+    if temperature <= 0:
+        return int(torch.argmax(logits))
+    probs = torch.softmax(logits.float() / temperature, dim=-1)
+    if top_p < 1.0:
+        sorted_probs, sorted_ids = torch.sort(probs, descending=True)
+        # Keep the smallest set of tokens with cumulative probability over top_p
+        outside = torch.cumsum(sorted_probs, dim=-1) - sorted_probs > top_p
+        sorted_probs[outside] = 0.0
+        probs = torch.zeros_like(probs).scatter_(-1, sorted_ids, sorted_probs)
+    return int(torch.multinomial(probs, 1, generator=generator))
+
+
+class TextStreamer:
+    """
+    Incremental detokenization of generated ids, with offsets into the text they follow as
+    TGI does. push returns the text added by a token: the decoding of the last tokens read
+    and the new ones, minus the decoding of the last tokens read. It is held back while it
+    ends in an incomplete UTF-8 sequence, until more tokens complete it or flush is
+    called. text is the generated text so far.
+
+    Decoding the generated ids on their own would lose the leading space of the first one
+    with SentencePiece tokenizers (e.g. CodeLlama's), which strip the space of the first
+    token, so the streamer starts from the last non-special context_ids, e.g. the prompt.
+    """
+    def __init__(self, tokenizer: PreTrainedTokenizerBase, context_ids: Optional[List[int]]=None, n_context: int=5):
+        self.tokenizer = tokenizer
+        special_ids = set(tokenizer.all_special_ids)
+        self._ids = [i for i in context_ids or [] if i not in special_ids][-n_context:]
+        self._prefix_offset = 0
+        self._read_offset = len(self._ids)
+        self.ids = []
+        self.text = ""
+
+    def push(self, token_id: int) -> str:
+        self.ids.append(token_id)
+        self._ids.append(token_id)
+        prefix_text = self.tokenizer.decode(self._ids[self._prefix_offset:self._read_offset], skip_special_tokens=True)
+        text = self.tokenizer.decode(self._ids[self._prefix_offset:], skip_special_tokens=True)
+        if len(text) <= len(prefix_text) or text.endswith("\ufffd"):
+            return ""
+        new_text = text[len(prefix_text):]
+        self._prefix_offset, self._read_offset = self._read_offset, len(self._ids)
+        self.text += new_text
+        return new_text
+
+    def flush(self) -> str:
+        """
+        Text held back by push, decoded as it is.
+        """
+        prefix_text = self.tokenizer.decode(self._ids[self._prefix_offset:self._read_offset], skip_special_tokens=True)
+        text = self.tokenizer.decode(self._ids[self._prefix_offset:], skip_special_tokens=True)
+        new_text = text[len(prefix_text):]
+        self._prefix_offset, self._read_offset = self._read_offset, len(self._ids)
+        self.text += new_text
+        return new_text
+
+
+class GenerationRequest:
+    """
+    State of one completion: sampling parameters, generated tokens and the queue its
+    (token id, text) pairs are streamed to. Iterate over it to read them. eos_token_id
+    overrides the tokenizer's, e.g. the end of infill token, and context_ids the ids the
+    generated text follows (default input_ids), see TextStreamer.
+    """
+    def __init__(
+        self,
+        input_ids: List[int],
+        tokenizer: PreTrainedTokenizerBase,
+        max_new_tokens: int=60,
+        temperature: float=0.0,
+        top_p: float=1.0,
+        stop: Optional[List[str]]=None,
+        seed: Optional[int]=None,
+        eos_token_id: Optional[int]=None,
+        context_ids: Optional[List[int]]=None
+    ):
+        self.input_ids = input_ids
+        self.eos_token_id = eos_token_id if eos_token_id is not None else tokenizer.eos_token_id
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.stop = stop or []
+        self.generator = torch.Generator().manual_seed(seed) if seed is not None else None
+        self.streamer = TextStreamer(tokenizer, context_ids if context_ids is not None else input_ids)
+        self.queue = queue.Queue()
+        self.last_token = None
+        self.cancelled = False
+        self.submit_time = time.perf_counter()
+        self.first_token_time = None
+        self.finish_time = None
+
+    @property
+    def token_ids(self) -> List[int]:
+        return self.streamer.ids
+
+    def push(self, logits: torch.Tensor) -> bool:
+        """
+        Select the next token from last position logits and stream it. Returns whether the
+        request is finished: at max_new_tokens, at the eos token (not streamed), once the
+        completion ends with a stop sequence (streamed), or once cancelled. The last token
+        streamed carries any text the streamer held back.
+        """
+        if self.cancelled:
+            self.finish()
+            return True
+        token_id = select_token(logits, self.temperature, self.top_p, self.generator)
+        if token_id == self.eos_token_id:
+            self.finish()
+            return True
+
+        self.first_token_time = self.first_token_time or time.perf_counter()
+        text = self.streamer.push(token_id)
+        self.last_token = token_id
+        finished = len(self.token_ids) >= self.max_new_tokens or any(self.streamer.text.endswith(s) for s in self.stop)
+        if finished:
+            text += self.streamer.flush()
+        self.queue.put((token_id, text))
+        if finished:
+            self.finish()
+        return finished
+
+    def finish(self, error: Optional[Exception]=None) -> None:
+        self.finish_time = self.finish_time or time.perf_counter()
+        self.queue.put(error if error is not None else _END)
+
+    def cancel(self) -> None:
+        """
+        Stop generating at the next token, e.g. once the client is gone.
+        """
+        self.cancelled = True
+
+    def __iter__(self) -> Iterator[Tuple[int, str]]:
+        while True:
+            item = self.queue.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+class CompletionEngine:
+    """
+    Serve completions from a model kept in memory (see load_model).
+
+    Args
+        model: causal lm, in eval mode
+        tokenizer: tokenizer of model
+        max_input_tokens: prompts are truncated to their last max_input_tokens tokens,
+            infill prompts are trimmed to the max_input_tokens around the cursor
+        max_batch_size: if over 1, requests are decoded together in a continuous batch
+            of up to max_batch_size requests (see utils.batching.BatchScheduler)
+        max_wait: seconds an idle batch scheduler waits to group requests
+        prefix_cache_bytes: if over 0, the KV states of prompts are kept in a prefix cache
+            of this many bytes, so prompts sharing a prefix with an earlier one only
+            prefill the rest (see utils.prefix_cache.PrefixCache)
+        drafter: if set, greedy completions are decoded speculatively from the tokens it
+            drafts, num_draft_tokens per step (see utils.speculative). Needs max_batch_size 1
+    """
+    def __init__(
+        self,
+        model: PreTrainedModel,
+        tokenizer: PreTrainedTokenizerBase,
+        max_input_tokens: int=2048,
+        max_batch_size: int=1,
+        max_wait: float=0.005,
+        prefix_cache_bytes: int=0,
+        drafter=None,
+        num_draft_tokens: int=4
+    ):
+        if drafter is not None and max_batch_size > 1:
+            raise ValueError("Speculative decoding needs max_batch_size 1.")
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_input_tokens = max_input_tokens
+        self.device = next(model.parameters()).device
+        self.eos_token_id = tokenizer.eos_token_id
+        self.prefix_cache = PrefixCache(prefix_cache_bytes) if prefix_cache_bytes > 0 else None
+        self.scheduler = BatchScheduler(model, max_batch_size, max_wait, self.prefix_cache) if max_batch_size > 1 else None
+        self.speculative = SpeculativeDecoder(model, drafter, num_draft_tokens) if drafter is not None else None
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        if self.scheduler is not None:
+            self.scheduler.close()
+
+    def encode(self, prompt: str) -> List[int]:
+        input_ids = self.tokenizer(prompt).input_ids
+        return input_ids[-self.max_input_tokens:]
+
+    @torch.no_grad()
+    def _forward(self, input_ids: List[int], cache) -> Tuple[torch.Tensor, object]:
+        """
+        Last position logits and updated cache of a forward pass over input_ids.
+        """
+        with self._lock:
+            out = self.model(
+                input_ids=torch.tensor([input_ids], device=self.device),
+                past_key_values=cache,
+                use_cache=True
+            )
+        return out.logits[0, -1], out.past_key_values
+
+    def submit(self, prompt: str, **generation_kwargs) -> GenerationRequest:
+        """
+        Start generating a completion of prompt, read it by iterating over the returned
+        request. Needs a batch scheduler (max_batch_size over 1).
+        """
+        if self.scheduler is None:
+            raise ValueError("Submitting requests needs a batch scheduler (max_batch_size over 1).")
+        request = GenerationRequest(self.encode(prompt), self.tokenizer, **generation_kwargs)
+        self.scheduler.submit(request)
+        return request
+
+    def stream(self, prompt: str, **generation_kwargs) -> Iterator[Tuple[int, str]]:
+        """
+        Generate a completion of prompt, yielding (token id, text) as tokens are decoded.
+        generation_kwargs are max_new_tokens, temperature, top_p, stop and seed (see
+        GenerationRequest). Closing the iterator cancels the request.
+        """
+        yield from self._generate(GenerationRequest(self.encode(prompt), self.tokenizer, **generation_kwargs))
+
+    def stream_infill(self, prefix: str, suffix: str, **generation_kwargs) -> Iterator[Tuple[int, str]]:
+        """
+        Generate the text between prefix and suffix, yielding (token id, text) as tokens
+        are decoded (see stream). The context is trimmed to the rule blocks nearest the
+        cursor that fit max_input_tokens, see utils.infill.trim_context.
+        """
+        prefix_id, suffix_id, _, eot_id = fim_token_ids(self.tokenizer)
+        input_ids = infill_ids(self.tokenizer, prefix, suffix, self.max_input_tokens)
+        # The middle follows the prefix
+        context_ids = input_ids[input_ids.index(prefix_id) + 1:input_ids.index(suffix_id)]
+        yield from self._generate(GenerationRequest(input_ids, self.tokenizer, eos_token_id=eot_id,
+                                                    context_ids=context_ids, **generation_kwargs))
+
+    def _generate(self, request: GenerationRequest) -> Iterator[Tuple[int, str]]:
+        if self.scheduler is not None:
+            self.scheduler.submit(request)
+            try:
+                yield from request
+            finally:
+                request.cancel()
+            return
+
+        with self._lock:
+            logits, cache = prefill(self.model, request.input_ids, self.prefix_cache)
+        finished = request.push(logits)
+        while True:
+            while request.queue.qsize() > 0:
+                item = request.queue.get()
+                if item is not _END:
+                    yield item
+            if finished:
+                return
+            if self.speculative is not None and request.temperature <= 0:
+                with self._lock:
+                    finished, cache = self.speculative.step(request, cache)
+            else:
+                logits, cache = self._forward([request.last_token], cache)
+                finished = request.push(logits)
+
+    def complete(self, prompt: str, **generation_kwargs) -> str:
+        """
+        Completion of prompt (see stream).
+        """
+        return "".join(text for _, text in self.stream(prompt, **generation_kwargs))
+
+    def infill(self, prefix: str, suffix: str, **generation_kwargs) -> str:
+        """
+        Text between prefix and suffix (see stream_infill).
+        """
+        return "".join(text for _, text in self.stream_infill(prefix, suffix, **generation_kwargs))
@@ -1,106 +1,318 @@
 """
 Misc utilities for handling text data. Includes:
+ - walk_files(dir_path, suffixes, max_workers)
+ - read_file(path, mmap_threshold)
  - scrape_dir(dir_path, file_endings, filter_duplicates, save_path)
+ - iter_source(source)
+ - merge_datasets(*args, names, near_dedup_threshold)
+ - table_fingerprint(table)
+ - to_hf_dataset(table)
 """
 import os
 import json
+import mmap
 import pickle
+import hashlib
 import typing
 from typing import (
     Union, 
     Optional,
+    Iterator,
     List,
+    Tuple,
     Dict
 )
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from tqdm import tqdm
+import pyarrow as pa
 import logging
 
+from utils.near_dedup import MinHashLSH
+from utils.shard_writer import content_digest, shard_paths, read_shards
+
 logger = logging.getLogger(__name__)
 
+def walk_files(
+    dir_path: str,
+    suffixes: Optional[Tuple[str, ...]]=None,
+    max_workers: int=8
+) -> List[str]:
+    """
+    List files under dir_path recursively, scanning directories in parallel with os.scandir.
+    Symlinked directories aren't followed.
+
+    Args
+        dir_path: directory to walk
+        suffixes: if not None, only keep files whose names end with one of these (e.g. (".nlp",))
+        max_workers: max number of directories scanned concurrently
+    Returns
+        sorted list of file paths
+    """
+    def scan(path: str) -> Tuple[List[str], List[str]]:
+        files, dirs = [], []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(entry.path)
+                        elif entry.is_file() and (suffixes is None or entry.name.endswith(suffixes)):
+                            files.append(entry.path)
+                    except OSError:
+                        continue
+        except OSError as e:
+            logger.warning(f"Unable to scan directory {path}: {e}")
+        return files, dirs
+
+    file_paths = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(scan, dir_path)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, dirs = future.result()
+                file_paths += files
+                pending.update(executor.submit(scan, d) for d in dirs)
+
+    file_paths.sort()
+    return file_paths
+
+
+def read_file(
+    path: str,
+    mmap_threshold: Optional[int]=None
+) -> Tuple[str, bytes]:
+    """
+    Read a utf-8 text file, translating \r\n and \r line endings to \n like open(path, "r").
+
+    Args
+        path: file to read
+        mmap_threshold: if not None, memory map files of at least this many bytes instead of reading them
+    Returns
+        text and its 128-bit blake2b digest
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if mmap_threshold is not None and size >= max(mmap_threshold, 1):
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return _decode(memoryview(mapped))
+        return _decode(f.read())
+
+
+def _decode(raw) -> Tuple[str, bytes]:
+    text = str(raw, "utf-8")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+        raw = text.encode("utf-8")
+    digest = hashlib.blake2b(raw, digest_size=16).digest()
+    if isinstance(raw, memoryview):
+        raw.release()
+    return text, digest
+
+
 def scrape_dir(
     dir_path: str, 
     file_endings: Optional[Union[str, List[str]]]=None,
     filter_duplicates: bool=True,
-    save_path: Optional[str]=None
+    save_path: Optional[str]=None,
+    max_workers: int=16,
+    mmap_threshold: Optional[int]=None,
+    read_batch_size: int=256
 ) -> Dict[str, str]:
     """
     Retrieve files from directory recursively
     Assumes file contents in dir are small enough to fit in memory
 
+    Directories are walked and files read in parallel threads. Files are
+    deduplicated by a digest of their text, first in sorted path order.
+
     Args
         dir_path: Directory to scrape
         file_endings: target filename suffixes (e.g.: ["csv", ".txt"])
         filter_duplicates: whether to keep files with duplicated content
         save_path: If not None, file path to save data to. Must not exist.
+        max_workers: number of threads walking directories and reading files
+        mmap_threshold: if not None, memory map files of at least this many bytes
+        read_batch_size: number of files read per task
     Returns 
         Dictionary of form {"file_path": "raw file text",...}
     """
     
     # Get all file paths, filtered by file endings (or none)
-    file_paths = []
+    suffixes = None
     if file_endings is not None:
-        for ending in file_endings:
-            file_paths += list(Path(dir_path).rglob("*.nlp"))
-    else:
-        file_paths += [i for i in Path(dir_path).rglob("*") if i.is_file()]
+        if isinstance(file_endings, str):
+            file_endings = [file_endings]
+        suffixes = tuple("." + ending.lstrip(".") for ending in file_endings)
+    file_paths = walk_files(dir_path, suffixes=suffixes, max_workers=max_workers)
 
-    # To ensure unique contents, file text is key
-    data = {}
+    def read_batch(paths: List[str]) -> List[Optional[Tuple[str, bytes]]]:
+        results = []
+        for path in paths:
+            try:
+                results.append(read_file(path, mmap_threshold=mmap_threshold))
+            except Exception as e:
+                logger.warning(f"Unable to read file at {path}:")
+                logger.warning(e)
+                results.append(None)
+        return results
 
-    for path in tqdm(file_paths, desc="Reading data..."):
-        path = str(path)
-        try:
-            with open(path, "r") as f:
-                text = f.read()
+    # Read in batches, one future per file costs more than reading a small file
+    batches = [file_paths[i:i + read_batch_size] for i in range(0, len(file_paths), read_batch_size)]
+
+    # To ensure unique contents, keep digests of file texts seen so far
+    data = {}
+    digests = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+            tqdm(total=len(file_paths), desc="Reading data...") as pbar:
+        results = executor.map(read_batch, batches) if max_workers > 1 else map(read_batch, batches)
+        for paths, batch_results in zip(batches, results):
+            for path, result in zip(paths, batch_results):
+                if result is None:
+                    continue
+                text, digest = result
 
                 # If filter_duplicates, keep first file path read
                 if not filter_duplicates:
                     data[path] = text
-                elif text not in data:
-                    data[text] = path
+                elif digest not in digests:
+                    digests.add(digest)
+                    data[path] = text
                 else:
                     logger.debug(f"Filtering duplicate file: {path}")
-    
-        except Exception as e:
-            logger.warn(f"Unable to read file at {path}:")
-            logger.warn(e)
-
-    # invert dict to get file path to file text
-    if filter_duplicates:
-        data = {v:k for k, v in data.items()}
+            pbar.update(len(paths))
 
     if save_path is not None:
         if save_path.endswith(".pkl"):
             with open(save_path, "wb") as f:
-                pickle.dump(data, file)
+                pickle.dump(data, f)
         elif save_path.endswith(".json"):
             with open(save_path, "w") as f:
                 json.dump(data, f, indent=4)
         else:
-            logger.warn("Save file type not supported.")
-            logger.warn("Must be either '.json' or '.pkl'")
+            logger.warning("Save file type not supported.")
+            logger.warning("Must be either '.json' or '.pkl'")
 
     return data
 
-def merge_datasets(*args):
+MERGE_BATCH_SIZE = 10000
+MERGE_SCHEMA = pa.schema([
+    ("text", pa.large_string()),
+    ("source", pa.string()),
+    ("source_key", pa.string()),
+    ("digest", pa.binary(16)),
+])
+
+def iter_source(source: Union[List[str], Dict, "datasets.Dataset", str], batch_size: int=1000) -> Iterator[Tuple[str, str]]:
     """
-    Merge text, removing duplicates. Order is not preserved.
+    Stream (key, text) pairs of a source:
+     - list of texts: key is the list index
+     - dict of key -> text (e.g. path -> text from scrape_dir)
+     - datasets.Dataset with a "text" column: key is the row index
+     - path to jsonl/parquet shards (see utils.shard_writer), key is the record's "path"
+       or "url" if it has one, else shard:line
+     - path to an arrow dataset saved with save_to_disk
+    """
+    if isinstance(source, (list, tuple)):
+        for i, text in enumerate(source):
+            yield str(i), text
+    elif isinstance(source, dict):
+        for key, text in source.items():
+            yield str(key), text
+    elif isinstance(source, str) and not os.path.isfile(os.path.join(source, "state.json")):
+        for shard in shard_paths(source):
+            for i, record in enumerate(read_shards(shard)):
+                key = record.get("path") or record.get("url") or f"{os.path.basename(shard)}:{i}"
+                yield str(key), record["text"]
+    else:
+        if isinstance(source, str):
+            from datasets import load_from_disk
+            source = load_from_disk(source)
+        i = 0
+        for batch in source.select_columns(["text"]).iter(batch_size=batch_size):
+            for text in batch["text"]:
+                yield str(i), text
+                i += 1
+
+def table_fingerprint(table: pa.Table) -> str:
+    """
+    Deterministic fingerprint of a merged table: a digest of its rows' content digests and provenance, in order.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for batch in table.select(["digest", "source", "source_key"]).to_batches():
+        digests, sources, keys = batch.to_pydict().values()
+        for digest, source, key in zip(digests, sources, keys):
+            h.update(digest)
+            h.update(f"{source}\0{key}\0".encode("utf-8", errors="surrogatepass"))
+    return h.hexdigest()
+
+def merge_datasets(
+    *args,
+    names: Optional[List[str]]=None,
+    near_dedup_threshold: Optional[float]=None,
+    batch_size: int=MERGE_BATCH_SIZE
+) -> pa.Table:
+    """
+    Merge text sources, removing duplicates by a 128-bit digest of their text. Sources are
+    streamed and the first occurrence of each text is kept, in order, so the output (and its
+    fingerprint) is the same from run to run. Only digests and the output table are held in memory.
 
     Args:
-        Each arg should be either text list dict with text values
+        Each arg should be a text list, a dict with text values, a datasets.Dataset or a path 
+        to shards or a saved dataset (see iter_source)
+        names: name of each source in the provenance column (default: the path of path 
+               sources, else the index of the source)
+        near_dedup_threshold: if not None, also remove near-duplicates with a MinHash 
+                              Jaccard similarity of at least this (see utils.near_dedup)
+        batch_size: number of rows per record batch of the table
 
     Returns:
-        Dict of form {"text": [0,...,n_unique_samples]}
+        Arrow table with columns text, source, source_key (key of the sample in its source),
+        digest, and its fingerprint in the schema metadata (see table_fingerprint, to_hf_dataset)
     """
+    if names is None:
+        names = [arg if isinstance(arg, str) else str(i) for i, arg in enumerate(args)]
+    if len(names) != len(args):
+        raise ValueError(f"Got {len(names)} names for {len(args)} sources.")
+
+    digests = set()
+    batches = []
+    columns = {name: [] for name in MERGE_SCHEMA.names}
+    n_seen = 0
+    for name, arg in zip(names, args):
+        for key, text in iter_source(arg):
+            n_seen += 1
+            digest = content_digest(text)
+            if digest in digests:
+                continue
+            digests.add(digest)
+            columns["text"].append(text)
+            columns["source"].append(name)
+            columns["source_key"].append(key)
+            columns["digest"].append(digest)
+            if len(columns["text"]) == batch_size:
+                batches.append(pa.RecordBatch.from_pydict(columns, schema=MERGE_SCHEMA))
+                columns = {name: [] for name in MERGE_SCHEMA.names}
+    if columns["text"] or not batches:
+        batches.append(pa.RecordBatch.from_pydict(columns, schema=MERGE_SCHEMA))
+    table = pa.Table.from_batches(batches, schema=MERGE_SCHEMA)
+    logger.info(f"Merged {n_seen} samples from {len(args)} sources into {len(table)} unique samples")
 
-    merged_data = set()
-    for arg in args:
-        if isinstance(arg, list):
-            merged_data.update(arg)
-        elif isinstance(arg, dict):
-            merged_data.update(list(arg.values()))
+    if near_dedup_threshold is not None:
+        texts = (text for batch in table.select(["text"]).to_batches() for text in batch.column(0).to_pylist())
+        keep, stats = MinHashLSH(threshold=near_dedup_threshold).keep_mask(texts)
+        logger.info(f"Near-dedup at Jaccard threshold {near_dedup_threshold}: {stats}")
+        table = table.filter(pa.array(keep))
 
-    merged_data = {"text": list(merged_data)}
-    return merged_data
+    return table.replace_schema_metadata({"fingerprint": table_fingerprint(table)})
 
+def to_hf_dataset(table: pa.Table) -> "datasets.Dataset":
+    """
+    datasets.Dataset of a merged table, with its deterministic fingerprint, so that the cache
+    files of .map(...) (e.g. tokenization) are reused across runs.
+    """
+    from datasets import Dataset
+    from datasets.table import InMemoryTable
+    metadata = table.schema.metadata or {}
+    fingerprint = metadata.get(b"fingerprint", b"").decode() or table_fingerprint(table)
+    return Dataset(InMemoryTable(table), fingerprint=fingerprint)
@@ -0,0 +1,129 @@
+"""
+Content-addressed cache for preprocessed (tokenized and grouped) datasets. Includes:
+ - hash_tokenizer(tokenizer)
+ - datasets_fingerprint(raw_datasets)
+ - preprocessing_cache_key(raw_datasets, tokenizer, **params)
+ - load_cached_datasets(cache_dir, key)
+ - save_cached_datasets(lm_datasets, cache_dir, key)
+
+Datasets are written once with save_to_disk (arrow shards) to cache_dir/<key> and
+loaded with load_from_disk, which memory maps the shards, so every run and rank
+sharing cache_dir reads the same files without copying them.
+"""
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import typing
+from typing import (
+    Union,
+    Optional,
+    Dict
+)
+import logging
+
+from datasets import Dataset, DatasetDict, load_from_disk
+
+logger = logging.getLogger(__name__)
+
+# Bump when preprocessing code changes in a way that changes its output
+CACHE_VERSION = 1
+
+
+def _hash_file(path: str, hasher: "hashlib._Hash", block_size: int=1 << 20) -> None:
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            hasher.update(block)
+
+
+def hash_tokenizer(tokenizer) -> str:
+    """
+    Hash the files written by tokenizer.save_pretrained.
+    """
+    hasher = hashlib.sha256()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tokenizer.save_pretrained(tmp_dir)
+        for file_name in sorted(os.listdir(tmp_dir)):
+            hasher.update(file_name.encode())
+            _hash_file(os.path.join(tmp_dir, file_name), hasher)
+    return hasher.hexdigest()
+
+
+def datasets_fingerprint(raw_datasets: Union[Dataset, DatasetDict]) -> str:
+    """
+    Combine the fingerprints of all splits of a dataset.
+    """
+    if isinstance(raw_datasets, Dataset):
+        return raw_datasets._fingerprint
+    return json.dumps({split: ds._fingerprint for split, ds in sorted(raw_datasets.items())})
+
+
+def preprocessing_cache_key(raw_datasets: Union[Dataset, DatasetDict], tokenizer, **params) -> str:
+    """
+    Key for preprocessed datasets.
+
+    Args
+        raw_datasets: dataset before tokenization
+        tokenizer: tokenizer used for preprocessing
+        params: any other json serializable values the preprocessing output depends on,
+                e.g. block_size, chunk_sep_ids, min_seq_len
+    Returns
+        hex digest
+    """
+    key = {
+        "cache_version": CACHE_VERSION,
+        "datasets": datasets_fingerprint(raw_datasets),
+        "tokenizer": hash_tokenizer(tokenizer),
+        "params": params,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def load_cached_datasets(cache_dir: str, key: str) -> Optional[Union[Dataset, DatasetDict]]:
+    """
+    Load (memory mapped) preprocessed datasets if cached, otherwise return None.
+    """
+    path = os.path.join(cache_dir, key)
+    if not os.path.isdir(path):
+        return None
+    logger.info(f"Loading preprocessed datasets from cache at {path}")
+    return load_from_disk(path)
+
+
+def save_cached_datasets(
+    lm_datasets: Union[Dataset, DatasetDict],
+    cache_dir: str,
+    key: str,
+    num_proc: Optional[int]=None,
+    overwrite: bool=False
+) -> str:
+    """
+    Write preprocessed datasets to cache_dir/key. Written to a temporary directory first and
+    renamed, so concurrent writers and readers never see a partial cache entry.
+
+    Args
+        overwrite: whether to replace an existing cache entry
+    Returns
+        path to cache entry
+    """
+    path = os.path.join(cache_dir, key)
+    if os.path.isdir(path):
+        if not overwrite:
+            return path
+        shutil.rmtree(path)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix=f".{key}.", dir=cache_dir)
+    try:
+        lm_datasets.save_to_disk(tmp_path, num_proc=num_proc)
+        os.rename(tmp_path, path)
+        logger.info(f"Saved preprocessed datasets to cache at {path}")
+    except OSError:
+        # Another process finished writing the same entry first
+        if not os.path.isdir(path):
+            raise
+    finally:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    return path
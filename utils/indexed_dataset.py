@@ -0,0 +1,137 @@
+"""
+Flat, memory-mapped token files for training data (Megatron-style indexed dataset). Includes:
+ - write_indexed_dataset(sequences, path_prefix, vocab_size)
+ - build_indexed_datasets(lm_datasets, output_dir, vocab_size)
+ - IndexedTokenDataset
+
+Each split is stored as:
+    <split>.bin: all token ids back to back, uint16 (or uint32 for vocabularies over 65536 ids)
+    <split>.idx.npy: int64 offsets, sample i is tokens[offsets[i]:offsets[i+1]]
+    <split>.json: dtype and sizes
+Both arrays are opened with np.memmap / np.load(mmap_mode="r"), so opening a split
+is instant and samples are read straight from the page cache.
+"""
+import os
+import json
+import typing
+from typing import (
+    Union,
+    Optional,
+    Iterable,
+    List,
+    Dict
+)
+import logging
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset as TorchDataset
+
+logger = logging.getLogger(__name__)
+
+
+def token_dtype(vocab_size: int) -> np.dtype:
+    """
+    Smallest unsigned dtype able to hold every id of the vocabulary.
+    """
+    return np.dtype(np.uint16) if vocab_size <= np.iinfo(np.uint16).max + 1 else np.dtype(np.uint32)
+
+
+def write_indexed_dataset(
+    sequences: Iterable[List[int]],
+    path_prefix: str,
+    vocab_size: int
+) -> int:
+    """
+    Write token id sequences to path_prefix.bin, path_prefix.idx.npy and path_prefix.json.
+
+    Args
+        sequences: iterable of lists of token ids, consumed once
+        path_prefix: output path without extension
+        vocab_size: tokenizer vocabulary size, determines token dtype
+    Returns
+        number of sequences written
+    """
+    dtype = token_dtype(vocab_size)
+    offsets = [0]
+    with open(path_prefix + ".bin", "wb") as f:
+        for seq in sequences:
+            f.write(np.asarray(seq, dtype=dtype).tobytes())
+            offsets.append(offsets[-1] + len(seq))
+
+    np.save(path_prefix + ".idx.npy", np.asarray(offsets, dtype=np.int64))
+    with open(path_prefix + ".json", "w") as f:
+        json.dump({"dtype": dtype.name, "n_sequences": len(offsets) - 1, "n_tokens": offsets[-1]}, f, indent=4)
+    return len(offsets) - 1
+
+
+def build_indexed_datasets(
+    lm_datasets,
+    output_dir: str,
+    vocab_size: int,
+    batch_size: int=1000
+) -> Dict[str, int]:
+    """
+    Write every split of preprocessed (grouped) datasets to token files in output_dir.
+
+    Args
+        lm_datasets: datasets.DatasetDict with an "input_ids" column, e.g. the output of run_clm preprocessing
+        output_dir: directory to write <split>.bin/.idx.npy/.json to
+        vocab_size: tokenizer vocabulary size
+        batch_size: rows read from each dataset at a time
+    Returns
+        dict of split -> number of sequences written
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    counts = {}
+    for split, dataset in lm_datasets.items():
+        if "seq_lens" in dataset.column_names:
+            raise ValueError("Packed datasets are not supported by token files, build them without packing.")
+
+        input_ids = dataset.remove_columns([c for c in dataset.column_names if c != "input_ids"])
+
+        def sequences():
+            for batch in input_ids.iter(batch_size=batch_size):
+                yield from batch["input_ids"]
+
+        counts[split] = write_indexed_dataset(sequences(), os.path.join(output_dir, split), vocab_size)
+        logger.info(f"Wrote {counts[split]} {split} sequences to {output_dir}")
+    return counts
+
+
+class IndexedTokenDataset(TorchDataset):
+    """
+    Serve samples from token files written by write_indexed_dataset.
+    Items are dicts of "input_ids", "attention_mask" and "labels" tensors.
+    """
+    def __init__(self, path_prefix: str):
+        with open(path_prefix + ".json", "r") as f:
+            self.meta = json.load(f)
+        self.path_prefix = path_prefix
+        self._offsets = np.load(path_prefix + ".idx.npy", mmap_mode="r")
+        if self.meta["n_tokens"] > 0:
+            self._tokens = np.memmap(path_prefix + ".bin", dtype=np.dtype(self.meta["dtype"]), mode="r")
+        else:
+            # Empty files can't be memory mapped
+            self._tokens = np.zeros(0, dtype=np.dtype(self.meta["dtype"]))
+
+    @classmethod
+    def exists(cls, path_prefix: str) -> bool:
+        return all(os.path.isfile(path_prefix + ext) for ext in [".bin", ".idx.npy", ".json"])
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError(f"Index {idx} out of range for dataset of size {len(self)}.")
+
+        start, end = self._offsets[idx], self._offsets[idx + 1]
+        input_ids = torch.from_numpy(self._tokens[start:end].astype(np.int64))
+        return {
+            "input_ids": input_ids,
+            "attention_mask": torch.ones_like(input_ids),
+            "labels": input_ids.clone(),
+        }
@@ -0,0 +1,190 @@
+"""
+Fill-in-the-middle (FIM) prompts for CodeLlama style infilling. Includes:
+ - FIM_TOKENS
+ - fim_token_ids(tokenizer)
+ - split_infill(prompt)
+ - encode_suffix(tokenizer, suffix)
+ - trim_context(tokenizer, prefix, suffix, max_tokens, suffix_weight)
+ - infill_ids(tokenizer, prefix, suffix, max_tokens, suffix_weight)
+
+An infill prompt is <s> <PRE> prefix <SUF> suffix <MID>, and the model generates the
+middle up to <EOT>. The suffix is tokenized without the dummy "▁" prefix (encode_suffix). To bound prefill latency on large NLP++ pass files, trim_context
+keeps the rule blocks (text up to the end of a line with an @@) nearest to the cursor
+that fit a token budget, working outwards from the cursor so that only the kept text
+is tokenized, whatever the file size.
+"""
+import re
+import typing
+from typing import (
+    Optional,
+    Iterator,
+    Tuple,
+    List
+)
+import logging
+
+from transformers import PreTrainedTokenizerBase
+
+logger = logging.getLogger(__name__)
+
+FIM_TOKENS = ("<PRE>", "<SUF>", "<MID>", "<EOT>")
+
+# Text prompts from editor extensions, e.g. llm-vscode's "<PRE> {prefix} <SUF>{suffix} <MID>"
+_INFILL_PROMPT = re.compile(r"<PRE> ?(.*?) ?<SUF>(.*?) ?<MID>", re.DOTALL)
+
+# Upper bound on characters per token, to cap the text tokenized around the cursor
+_MAX_CHARS_PER_TOKEN = 16
+
+# Text the suffix is tokenized after, then dropped, as in CodeLlama's encode_infilling
+_SUFFIX_ANCHOR = "☺"
+
+
+def fim_token_ids(tokenizer: PreTrainedTokenizerBase) -> Tuple[int, int, int, Optional[int]]:
+    """
+    Ids of the prefix, suffix, middle and end of infill (None if missing) tokens of
+    tokenizer. CodeLlama tokenizers name them prefix_id, suffix_id, middle_id and eot_id,
+    others are looked up by FIM_TOKENS (or with a leading "▁", as in CodeLlama's vocab).
+    """
+    if getattr(tokenizer, "prefix_id", None) is not None:
+        return tokenizer.prefix_id, tokenizer.suffix_id, tokenizer.middle_id, tokenizer.eot_id
+
+    vocab = tokenizer.get_vocab()
+    ids = [vocab.get(token, vocab.get("▁" + token)) for token in FIM_TOKENS]
+    if None in ids[:3]:
+        raise ValueError(f"Tokenizer has no infilling tokens {FIM_TOKENS[:3]}.")
+    return tuple(ids)
+
+
+def split_infill(prompt: str) -> Optional[Tuple[str, str]]:
+    """
+    (prefix, suffix) of a text infill prompt "<PRE> {prefix} <SUF>{suffix} <MID>", or
+    None if prompt isn't one.
+    """
+    match = _INFILL_PROMPT.fullmatch(prompt)
+    return match.groups() if match is not None else None
+
+
+def encode_suffix(tokenizer: PreTrainedTokenizerBase, suffix: str) -> List[int]:
+    """
+    Token ids of suffix without the dummy "▁" prefix SentencePiece tokenizers (e.g.
+    CodeLlama's) add at the start of a text, as CodeLlama is trained to see the suffix:
+    suffix is tokenized after an anchor whose ids are then dropped. Falls back to plain
+    tokenization if the anchor merges with the suffix.
+    """
+    return _encode_after_anchor(tokenizer, suffix, tokenizer(_SUFFIX_ANCHOR, add_special_tokens=False).input_ids)
+
+
+def _encode_after_anchor(tokenizer: PreTrainedTokenizerBase, text: str, anchor_ids: List[int]) -> List[int]:
+    ids = tokenizer(_SUFFIX_ANCHOR + text, add_special_tokens=False).input_ids
+    if ids[:len(anchor_ids)] == anchor_ids:
+        return ids[len(anchor_ids):]
+    return tokenizer(text, add_special_tokens=False).input_ids
+
+
+def _rule_blocks(text: str, reverse: bool=False) -> Iterator[str]:
+    """
+    Split text after every line with an @@ (end of a rule or region), lazily from the
+    end of text if reverse.
+    """
+    if not reverse:
+        start = 0
+        while start < len(text):
+            i = text.find("@@", start)
+            if i < 0:
+                yield text[start:]
+                return
+            j = text.find("\n", i)
+            end = len(text) if j < 0 else j + 1
+            yield text[start:end]
+            start = end
+        return
+
+    end = len(text)
+    while end > 0:
+        i = text.rfind("@@", 0, end)
+        while i >= 0:
+            j = text.find("\n", i)
+            start = len(text) if j < 0 else j + 1
+            if start < end:
+                break
+            i = text.rfind("@@", 0, i)
+        if i < 0:
+            yield text[:end]
+            return
+        yield text[start:end]
+        end = start
+
+
+def trim_context(
+    tokenizer: PreTrainedTokenizerBase,
+    prefix: str,
+    suffix: str,
+    max_tokens: int,
+    suffix_weight: float=3.0
+) -> Tuple[List[int], List[int]]:
+    """
+    Token ids of the context around the cursor, at most max_tokens in all. Whole rule
+    blocks are added nearest first, where a suffix block counts suffix_weight times its
+    distance from the cursor (in tokens), so the prefix is favored. A side stops at the
+    first block that doesn't fit, keeping the context contiguous. The blocks the cursor
+    is in are always kept, truncated at the token level if needed.
+    """
+    if max_tokens <= 0:
+        return [], []
+
+    # Blocks are counted without the dummy "▁" prefix of SentencePiece tokenizers, which
+    # the prefix gets once, counted with the cursor block
+    anchor_ids = tokenizer(_SUFFIX_ANCHOR, add_special_tokens=False).input_ids
+    def count(block: str, with_prefix: bool=False) -> int:
+        if with_prefix:
+            return len(tokenizer(block, add_special_tokens=False).input_ids)
+        return len(_encode_after_anchor(tokenizer, block, anchor_ids))
+
+    max_chars = max_tokens * _MAX_CHARS_PER_TOKEN
+    sides = []
+    for text, reverse, weight in [(prefix[-max_chars:], True, 1.0), (suffix[:max_chars], False, suffix_weight)]:
+        blocks = _rule_blocks(text, reverse)
+        block = next(blocks, None)
+        # [blocks, kept blocks, kept tokens, distance weight]
+        sides.append([blocks, [block] if block else [], count(block, with_prefix=reverse) if block else 0, weight])
+    n_tokens = sides[0][2] + sides[1][2]
+
+    open_sides = list(sides)
+    while open_sides and n_tokens < max_tokens:
+        side = min(open_sides, key=lambda side: side[2] * side[3])
+        blocks, kept, _, _ = side
+        block = next(blocks, None)
+        size = count(block) if block is not None else 0
+        if block is None or n_tokens + size > max_tokens:
+            open_sides.remove(side)
+            continue
+        kept.append(block)
+        side[2] += size
+        n_tokens += size
+
+    prefix_ids = tokenizer("".join(reversed(sides[0][1])), add_special_tokens=False).input_ids
+    suffix_ids = _encode_after_anchor(tokenizer, "".join(sides[1][1]), anchor_ids)
+    if len(prefix_ids) + len(suffix_ids) > max_tokens:
+        # Only the cursor blocks (or tokens merging across blocks) overflow, give the
+        # suffix its weighted share at least
+        n_suffix = min(len(suffix_ids), max(max_tokens - len(prefix_ids), int(max_tokens / (1 + suffix_weight))))
+        suffix_ids = suffix_ids[:n_suffix]
+        prefix_ids = prefix_ids[max(len(prefix_ids) - (max_tokens - n_suffix), 0):]
+    return prefix_ids, suffix_ids
+
+
+def infill_ids(
+    tokenizer: PreTrainedTokenizerBase,
+    prefix: str,
+    suffix: str,
+    max_tokens: int=2048,
+    suffix_weight: float=3.0
+) -> List[int]:
+    """
+    Input ids of the infill prompt <s> <PRE> prefix <SUF> suffix <MID>, at most
+    max_tokens long, with the context trimmed by trim_context.
+    """
+    prefix_id, suffix_id, middle_id, _ = fim_token_ids(tokenizer)
+    bos = [tokenizer.bos_token_id] if tokenizer.bos_token_id is not None else []
+    prefix_ids, suffix_ids = trim_context(tokenizer, prefix, suffix, max_tokens - len(bos) - 3, suffix_weight)
+    return bos + [prefix_id] + prefix_ids + [suffix_id] + suffix_ids + [middle_id]
@@ -0,0 +1,237 @@
+"""
+Near-duplicate detection with MinHash signatures and LSH banding. Includes:
+ - optimal_bands(threshold, num_perm)
+ - MinHashLSH
+ - near_dedup(texts, threshold, ...)
+
+Texts are tokenized into code tokens (words and single punctuation characters)
+and shingled into token n-grams. MinHash signatures of the shingle sets are
+computed in vectorized NumPy, batch by batch, so only the signatures (num_perm
+uint32 per text) are kept in memory. Signatures are split into bands; texts
+sharing any band are candidates, and candidates whose estimated Jaccard
+similarity reaches the threshold are clustered (union-find). The first text of
+each cluster is kept.
+"""
+import re
+import zlib
+import typing
+from typing import (
+    Optional,
+    Iterable,
+    Iterator,
+    Tuple,
+    List,
+    Dict
+)
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+_MAX_HASH = np.uint32(np.iinfo(np.uint32).max)
+_SHINGLE_PRIME = np.uint64(1099511628211)
+# np.trapz was renamed in numpy 2
+_trapezoid = getattr(np, "trapezoid", None) or np.trapz
+
+
+def optimal_bands(
+    threshold: float,
+    num_perm: int,
+    false_positive_weight: float=0.5,
+    false_negative_weight: float=0.5
+) -> Tuple[int, int]:
+    """
+    Number of bands and rows per band (bands * rows <= num_perm) minimizing the weighted
+    probability mass of false positives (similarity < threshold) and false negatives.
+    """
+    s = np.linspace(0, 1, 1001)
+    below = s < threshold
+    best, best_error = (1, num_perm), float("inf")
+    for bands in range(1, num_perm + 1):
+        rows = num_perm // bands
+        p = 1 - (1 - s ** rows) ** bands
+        false_positives = _trapezoid(p[below], s[below]) if below.any() else 0.0
+        false_negatives = _trapezoid(1 - p[~below], s[~below]) if (~below).any() else 0.0
+        error = false_positive_weight * false_positives + false_negative_weight * false_negatives
+        if error < best_error:
+            best, best_error = (bands, rows), error
+    return best
+
+
+class MinHashLSH:
+    """
+    Find near-duplicate texts.
+
+    Args
+        threshold: Jaccard similarity of shingle sets above which texts are duplicates
+        num_perm: number of hash functions of a signature
+        ngram_size: tokens per shingle
+        bands: number of LSH bands (default: chosen from threshold, see optimal_bands)
+        batch_size: texts hashed together
+        seed: seed of the hash functions
+    """
+    def __init__(
+        self,
+        threshold: float=0.85,
+        num_perm: int=128,
+        ngram_size: int=5,
+        bands: Optional[int]=None,
+        batch_size: int=1000,
+        seed: int=0
+    ):
+        if not 0 < threshold <= 1:
+            raise ValueError(f"threshold must be in (0, 1], got {threshold}")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.ngram_size = ngram_size
+        self.batch_size = batch_size
+        if bands is None:
+            self.bands, self.rows = optimal_bands(threshold, num_perm)
+        else:
+            self.bands, self.rows = bands, num_perm // bands
+
+        # Multiply-add-shift hash functions of 64 bit shingle hashes to 32 bits
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 2 ** 63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self._b = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+
+    def shingles(self, text: str) -> np.ndarray:
+        """
+        Unique 64 bit hashes of the token n-grams of text (one n-gram if text is shorter than ngram_size).
+        """
+        tokens = TOKEN_PATTERN.findall(text)
+        if not tokens:
+            return np.zeros(0, dtype=np.uint64)
+        ids = np.fromiter((zlib.crc32(t.encode("utf-8", errors="surrogatepass")) for t in tokens),
+                          dtype=np.uint64, count=len(tokens))
+        n = min(self.ngram_size, len(ids))
+        n_shingles = len(ids) - n + 1
+        hashes = np.zeros(n_shingles, dtype=np.uint64)
+        with np.errstate(over="ignore"):
+            for k in range(n):
+                hashes = hashes * _SHINGLE_PRIME + ids[k:k + n_shingles]
+        return np.unique(hashes)
+
+    def _signature_batch(self, shingle_sets: List[np.ndarray], max_columns: int=1 << 15) -> np.ndarray:
+        signatures = np.full((len(shingle_sets), self.num_perm), _MAX_HASH, dtype=np.uint32)
+        sizes = np.array([len(s) for s in shingle_sets], dtype=np.int64)
+        docs = np.flatnonzero(sizes)
+        if len(docs) == 0:
+            return signatures
+        x = np.concatenate([shingle_sets[d] for d in docs])
+        starts = np.concatenate([[0], np.cumsum(sizes[docs])[:-1]])
+        ends = starts + sizes[docs]
+
+        # Hash column chunks, reducing each document's columns to their minimum
+        for col_start in range(0, len(x), max_columns):
+            col_end = min(col_start + max_columns, len(x))
+            with np.errstate(over="ignore"):
+                hashed = (self._a[:, None] * x[None, col_start:col_end] + self._b[:, None]) >> np.uint64(32)
+            hashed = hashed.astype(np.uint32)
+            in_chunk = np.flatnonzero((starts < col_end) & (ends > col_start))
+            local_starts = np.maximum(starts[in_chunk], col_start) - col_start
+            mins = np.minimum.reduceat(hashed, local_starts, axis=1).T
+            signatures[docs[in_chunk]] = np.minimum(signatures[docs[in_chunk]], mins)
+        return signatures
+
+    def signatures(self, texts: Iterable[str]) -> np.ndarray:
+        """
+        MinHash signatures of texts, shape (n_texts, num_perm). texts is consumed batch by batch.
+        """
+        batches = []
+        batch = []
+        for text in texts:
+            batch.append(self.shingles(text))
+            if len(batch) == self.batch_size:
+                batches.append(self._signature_batch(batch))
+                batch = []
+        if batch:
+            batches.append(self._signature_batch(batch))
+        if not batches:
+            return np.zeros((0, self.num_perm), dtype=np.uint32)
+        return np.concatenate(batches)
+
+    def clusters(self, signatures: np.ndarray) -> Tuple[np.ndarray, Dict]:
+        """
+        Cluster near-duplicate signatures.
+
+        Returns
+            root (index of the first text of its cluster) of every text, and cluster statistics
+        """
+        n = len(signatures)
+        parent = np.arange(n)
+
+        def find(i: int) -> int:
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        n_candidates = 0
+        n_verified = 0
+        for band in range(self.bands):
+            rows = np.ascontiguousarray(signatures[:, band * self.rows:(band + 1) * self.rows])
+            keys = rows.view(np.dtype((np.void, rows.dtype.itemsize * self.rows))).ravel()
+            # np.unique sorts stably by key, so first_index is each bucket's lowest text index
+            _, first_index, inverse = np.unique(keys, return_index=True, return_inverse=True)
+            representatives = first_index[inverse.ravel()]
+            members = np.flatnonzero(representatives != np.arange(n))
+            if len(members) == 0:
+                continue
+            n_candidates += len(members)
+            similarity = (signatures[members] == signatures[representatives[members]]).mean(axis=1)
+            verified = members[similarity >= self.threshold]
+            n_verified += len(verified)
+            for i in verified:
+                root_i, root_j = find(i), find(representatives[i])
+                if root_i != root_j:
+                    # Keep the earliest text as root
+                    parent[max(root_i, root_j)] = min(root_i, root_j)
+
+        roots = np.array([find(i) for i in range(n)], dtype=np.int64)
+        return roots, self.cluster_stats(roots, n_candidates, n_verified)
+
+    def cluster_stats(self, roots: np.ndarray, n_candidates: int=0, n_verified: int=0) -> Dict:
+        sizes = np.bincount(roots, minlength=len(roots)) if len(roots) else np.zeros(0, dtype=np.int64)
+        cluster_sizes = sizes[sizes > 1]
+        histogram = np.bincount(cluster_sizes) if len(cluster_sizes) else np.zeros(0, dtype=np.int64)
+        return {
+            "texts": int(len(roots)),
+            "duplicates": int((roots != np.arange(len(roots))).sum()),
+            "clusters": int(len(cluster_sizes)),
+            "largest_cluster": int(cluster_sizes.max()) if len(cluster_sizes) else 1,
+            "mean_cluster_size": round(float(cluster_sizes.mean()), 3) if len(cluster_sizes) else 0.0,
+            "cluster_size_histogram": {int(s): int(c) for s, c in enumerate(histogram) if c},
+            "candidate_pairs": int(n_candidates),
+            "verified_pairs": int(n_verified),
+            "bands": self.bands,
+            "rows": self.rows,
+        }
+
+    def keep_mask(self, texts: Iterable[str]) -> Tuple[np.ndarray, Dict]:
+        """
+        Boolean mask of the texts to keep (first text of each near-duplicate cluster), and cluster statistics.
+        """
+        roots, stats = self.clusters(self.signatures(texts))
+        return roots == np.arange(len(roots)), stats
+
+
+def near_dedup(
+    texts: List[str],
+    threshold: float=0.85,
+    num_perm: int=128,
+    ngram_size: int=5,
+    seed: int=0
+) -> Tuple[List[str], Dict]:
+    """
+    Remove near-duplicates from texts, keeping the first text of each cluster, in order.
+
+    Returns
+        kept texts and cluster statistics (see MinHashLSH.cluster_stats)
+    """
+    lsh = MinHashLSH(threshold=threshold, num_perm=num_perm, ngram_size=ngram_size, seed=seed)
+    keep, stats = lsh.keep_mask(texts)
+    logger.info(f"Near-dedup: {stats}")
+    return [text for text, k in zip(texts, keep) if k], stats
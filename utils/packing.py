@@ -0,0 +1,171 @@
+"""
+Sequence packing for causal lm training. Includes:
+ - first_fit_decreasing(lengths, capacity)
+ - pack_features(examples, block_size)
+ - packing_efficiency(seq_lens, block_size)
+ - check_attn_implementation(model)
+ - DataCollatorForPackedSequences
+
+Several short samples are packed into one block_size window. Each packed row keeps
+the lengths of its samples ("seq_lens"), which the collator turns into position ids
+that restart at every sample and a block diagonal causal attention mask, so tokens
+only attend within their own sample. The mask is additive (0 or the dtype minimum),
+which the eager and sdpa attention implementations both apply as is.
+"""
+import typing
+from typing import (
+    Optional,
+    List,
+    Dict,
+    Tuple
+)
+from dataclasses import dataclass
+import logging
+
+import torch
+import transformers
+from packaging import version
+
+logger = logging.getLogger(__name__)
+
+IGNORE_INDEX = -100
+
+# Attention implementations that apply a custom 4D attention mask as given
+MASK_ATTN_IMPLEMENTATIONS = ("eager", "sdpa")
+
+
+def first_fit_decreasing(lengths: List[int], capacity: int) -> List[List[int]]:
+    """
+    Bin pack items by first-fit decreasing.
+
+    Args
+        lengths: item sizes, each at most capacity
+        capacity: bin size
+    Returns
+        List of bins, each a list of item indices
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    bins = []
+    remaining = []
+    for i in order:
+        length = lengths[i]
+        if length > capacity:
+            raise ValueError(f"Item of length {length} does not fit in bin of size {capacity}.")
+        for b, space in enumerate(remaining):
+            if length <= space:
+                bins[b].append(i)
+                remaining[b] -= length
+                break
+        else:
+            bins.append([i])
+            remaining.append(capacity - length)
+    return bins
+
+
+def pack_features(examples: Dict[str, List[List[int]]], block_size: int) -> Dict[str, List[List[int]]]:
+    """
+    Pack a batch of lm features into rows of at most block_size ids. For use with datasets.Dataset.map(batched=True).
+
+    Args
+        examples: batch with "input_ids" and "labels" (see utils.chunking.group_chunks)
+        block_size: max length of packed row
+    Returns
+        Dict with "input_ids", "labels" and "seq_lens" (lengths of the samples in each row)
+    """
+    lengths = [len(ids) for ids in examples["input_ids"]]
+    results = {"input_ids": [], "labels": [], "seq_lens": []}
+    for bin_idxs in first_fit_decreasing(lengths, block_size):
+        input_ids, labels = [], []
+        for i in bin_idxs:
+            sample_labels = list(examples["labels"][i])
+            # Don't predict the start of a sample from the end of the previous one
+            if len(labels) > 0 and len(sample_labels) > 0:
+                sample_labels[0] = IGNORE_INDEX
+            input_ids += examples["input_ids"][i]
+            labels += sample_labels
+        results["input_ids"].append(input_ids)
+        results["labels"].append(labels)
+        results["seq_lens"].append([lengths[i] for i in bin_idxs])
+    return results
+
+
+def packing_efficiency(seq_lens: List[List[int]], block_size: int) -> Tuple[float, float]:
+    """
+    Args
+        seq_lens: sample lengths for each row of a dataset
+        block_size: row size
+    Returns
+        packed, unpacked: real tokens / block_size slots of the packed rows, and of one sample per row.
+    """
+    n_tokens = sum(sum(lens) for lens in seq_lens)
+    n_samples = sum(len(lens) for lens in seq_lens)
+    if n_tokens == 0:
+        return 0.0, 0.0
+    return n_tokens / (len(seq_lens) * block_size), n_tokens / (n_samples * block_size)
+
+
+def check_attn_implementation(model) -> None:
+    """
+    Raise a ValueError if model can't take the 4D attention masks of DataCollatorForPackedSequences,
+    e.g. with flash attention (which ignores them) or transformers versions rejecting them.
+    """
+    if version.parse(transformers.__version__) < version.parse("4.40.0"):
+        raise ValueError(f"Packed sequences need transformers>=4.40 for 4D attention masks, found {transformers.__version__}.")
+    attn_implementation = getattr(model.config, "_attn_implementation", None) or "eager"
+    if attn_implementation not in MASK_ATTN_IMPLEMENTATIONS:
+        raise ValueError(
+            f"Packed sequences need an attention implementation taking 4D masks {MASK_ATTN_IMPLEMENTATIONS}, "
+            f"model uses {attn_implementation!r} (see --attn_implementation)."
+        )
+
+
+@dataclass
+class DataCollatorForPackedSequences:
+    """
+    Collate packed rows (see pack_features) into padded tensors:
+        input_ids, labels: (batch, seq_len)
+        position_ids: (batch, seq_len), restart at 0 for every packed sample
+        attention_mask: (batch, 1, seq_len, seq_len) of dtype, additive: 0 where a query may attend
+                        a key, i.e. causal and within the same sample, the dtype minimum elsewhere.
+                        Requires a model accepting custom 4D masks, see check_attn_implementation.
+    """
+    pad_token_id: int = 0
+    pad_to_multiple_of: Optional[int] = None
+    dtype: torch.dtype = torch.float32
+
+    def __call__(self, features: List[Dict[str, List[int]]]) -> Dict[str, torch.Tensor]:
+        max_len = max(len(f["input_ids"]) for f in features)
+        if self.pad_to_multiple_of is not None:
+            max_len = -(-max_len // self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+        batch_size = len(features)
+        input_ids = torch.full((batch_size, max_len), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((batch_size, max_len), IGNORE_INDEX, dtype=torch.long)
+        position_ids = torch.zeros((batch_size, max_len), dtype=torch.long)
+        # Sample id of each position, -1 for padding
+        segment_ids = torch.full((batch_size, max_len), -1, dtype=torch.long)
+
+        for b, f in enumerate(features):
+            n = len(f["input_ids"])
+            input_ids[b, :n] = torch.tensor(f["input_ids"], dtype=torch.long)
+            labels[b, :n] = torch.tensor(f["labels"], dtype=torch.long)
+            seq_lens = torch.tensor(f["seq_lens"], dtype=torch.long)
+            starts = torch.cumsum(seq_lens, 0) - seq_lens
+            segment_ids[b, :n] = torch.repeat_interleave(torch.arange(len(seq_lens)), seq_lens)
+            position_ids[b, :n] = torch.arange(n) - torch.repeat_interleave(starts, seq_lens)
+
+        causal = torch.tril(torch.ones((max_len, max_len), dtype=torch.bool))
+        same_sample = segment_ids[:, :, None] == segment_ids[:, None, :]
+        attention_mask = same_sample & causal & (segment_ids[:, None, :] >= 0)
+        # Padding queries attend to themselves to avoid fully masked rows
+        attention_mask |= torch.eye(max_len, dtype=torch.bool)
+        # Additive, a bool mask is added as 0/1 by eager attention instead of masking
+        additive_mask = torch.zeros(attention_mask.shape, dtype=self.dtype)
+        additive_mask.masked_fill_(~attention_mask, torch.finfo(self.dtype).min)
+
+        return {
+            "input_ids": input_ids,
+            "labels": labels,
+            "position_ids": position_ids,
+            "attention_mask": additive_mask[:, None, :, :],
+        }
@@ -0,0 +1,193 @@
+"""
+Prefix KV cache for incremental completions, e.g. an editor sending nearly the same
+file prefix on every keystroke. Includes:
+ - PrefixCache
+
+The KV states of prefilled prompts are stored in a radix tree over token ids. Every
+node holds the states of the tokens on its edge, so prompts sharing a prefix share
+its states. A new prompt only prefills the tokens after its longest cached prefix
+(see utils.batching.prefill). The least recently used leaves are evicted once the
+cached states exceed max_bytes.
+"""
+import threading
+import itertools
+import typing
+from typing import (
+    Optional,
+    Tuple,
+    List,
+    Dict
+)
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+KV = List[Tuple[torch.Tensor, torch.Tensor]]
+
+
+class _Node:
+    __slots__ = ["tokens", "kv", "children", "parent", "last_access", "n_bytes"]
+
+    def __init__(self, tokens: List[int], kv: Optional[KV], parent: Optional["_Node"]):
+        self.tokens = tokens
+        self.kv = kv
+        self.children = {}
+        self.parent = parent
+        self.last_access = 0
+        self.n_bytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in kv) if kv else 0
+
+
+def _slice(kv: KV, start: int, end: Optional[int]=None) -> KV:
+    return [(k[:, :, start:end], v[:, :, start:end]) for k, v in kv]
+
+
+class PrefixCache:
+    """
+    Radix tree of KV states keyed on token id prefixes. Thread safe.
+
+    Args
+        max_bytes: memory budget of the stored states
+    """
+    def __init__(self, max_bytes: int=2**30):
+        self.max_bytes = max_bytes
+        self.root = _Node([], None, None)
+        self.n_bytes = 0
+        self.n_nodes = 0
+        self.n_lookups = 0
+        self.n_hits = 0
+        self.n_lookup_tokens = 0
+        self.n_hit_tokens = 0
+        self.n_evicted = 0
+        self._clock = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def lookup(self, input_ids: List[int]) -> Tuple[int, Optional[KV]]:
+        """
+        Length and KV states (shape [1, heads, length, head dim]) of the longest cached
+        prefix of input_ids, leaving at least its last token uncached so that its logits
+        can be computed. Returns (0, None) on a miss.
+        """
+        with self._lock:
+            self.n_lookups += 1
+            self.n_lookup_tokens += len(input_ids)
+            limit = len(input_ids) - 1
+            segments, n = [], 0
+            node = self.root
+            now = next(self._clock)
+            while n < limit:
+                child = node.children.get(input_ids[n])
+                if child is None:
+                    break
+                m = 0
+                max_m = min(len(child.tokens), limit - n)
+                while m < max_m and child.tokens[m] == input_ids[n + m]:
+                    m += 1
+                child.last_access = now
+                segments.append(child.kv if m == len(child.tokens) else _slice(child.kv, 0, m))
+                n += m
+                if m < len(child.tokens):
+                    break
+                node = child
+
+            if n == 0:
+                return 0, None
+            self.n_hits += 1
+            self.n_hit_tokens += n
+            kv = [
+                (torch.cat([s[layer][0] for s in segments], dim=2), torch.cat([s[layer][1] for s in segments], dim=2))
+                for layer in range(len(segments[0]))
+            ]
+            return n, kv
+
+    def insert(self, input_ids: List[int], kv: KV) -> None:
+        """
+        Store the KV states (shape [1, heads, len(input_ids), head dim]) of input_ids.
+        Only the states of tokens not already cached are copied. They aren't stored if they
+        don't fit in max_bytes along with the cached prefix, since they would be evicted
+        right away.
+        """
+        token_bytes = sum(k[:, :, :1].numel() * k.element_size() + v[:, :, :1].numel() * v.element_size() for k, v in kv)
+        with self._lock:
+            node, n = self.root, 0
+            path_bytes = 0
+            now = next(self._clock)
+            while n < len(input_ids):
+                child = node.children.get(input_ids[n])
+                if child is None:
+                    if path_bytes + (len(input_ids) - n) * token_bytes > self.max_bytes:
+                        break
+                    # Copy, so that the cache doesn't keep the whole prompt's states alive
+                    new_kv = [(k.clone(), v.clone()) for k, v in _slice(kv, n)]
+                    child = _Node(list(input_ids[n:]), new_kv, node)
+                    child.last_access = now
+                    node.children[input_ids[n]] = child
+                    self.n_bytes += child.n_bytes
+                    self.n_nodes += 1
+                    break
+
+                m = 0
+                max_m = min(len(child.tokens), len(input_ids) - n)
+                while m < max_m and child.tokens[m] == input_ids[n + m]:
+                    m += 1
+                if m < len(child.tokens):
+                    self._split(child, m)
+                    child = child.parent
+                child.last_access = now
+                path_bytes += child.n_bytes
+                node, n = child, n + m
+            self._evict()
+
+    def _split(self, node: _Node, m: int) -> None:
+        """
+        Split node after its first m tokens, into a parent holding them and node.
+        """
+        parent = _Node(node.tokens[:m], [(k.clone(), v.clone()) for k, v in _slice(node.kv, 0, m)], node.parent)
+        parent.last_access = node.last_access
+        node.parent.children[node.tokens[0]] = parent
+        rest_kv = [(k.clone(), v.clone()) for k, v in _slice(node.kv, m)]
+        self.n_bytes -= node.n_bytes
+        node.tokens, node.kv, node.parent = node.tokens[m:], rest_kv, parent
+        node.n_bytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in rest_kv)
+        parent.children[node.tokens[0]] = node
+        self.n_bytes += parent.n_bytes + node.n_bytes
+        self.n_nodes += 1
+
+    def _evict(self) -> None:
+        """
+        Remove least recently used leaves until the states fit in max_bytes.
+        """
+        if self.n_bytes <= self.max_bytes:
+            return
+        leaves = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            if not node.children and node is not self.root:
+                leaves.append(node)
+        leaves.sort(key=lambda node: node.last_access, reverse=True)
+        while self.n_bytes > self.max_bytes and leaves:
+            node = leaves.pop()
+            parent = node.parent
+            del parent.children[node.tokens[0]]
+            self.n_bytes -= node.n_bytes
+            self.n_nodes -= 1
+            self.n_evicted += 1
+            # A parent left without children becomes a leaf, keep leaves ordered by access
+            if not parent.children and parent is not self.root:
+                i = 0
+                while i < len(leaves) and leaves[i].last_access > parent.last_access:
+                    i += 1
+                leaves.insert(i, parent)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "lookups": self.n_lookups,
+            "hit_rate": self.n_hits / self.n_lookups if self.n_lookups else 0.0,
+            "token_hit_rate": self.n_hit_tokens / self.n_lookup_tokens if self.n_lookup_tokens else 0.0,
+            "bytes": self.n_bytes,
+            "nodes": self.n_nodes,
+            "evicted": self.n_evicted,
+        }
@@ -0,0 +1,65 @@
+"""
+Persistent HTTP response cache for conditional requests. Includes:
+ - ResponseCache
+
+Stores the ETag, body and Link header (for pagination) of responses by url.
+Repeat requests send If-None-Match, and a 304 Not Modified response (which GitHub
+doesn't count against the rate limit) is answered with the stored body.
+"""
+import typing
+from typing import Optional, Tuple, Dict
+import logging
+
+from utils.sqlite_store import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache(SqliteStore):
+    """
+    SQLite table of url -> (ETag, response body, Link header). Safe to share between threads.
+
+    Args
+        path: database file, created if it doesn't exist
+    """
+    TABLE = "responses"
+    COLUMNS = "url TEXT PRIMARY KEY, etag TEXT NOT NULL, body BLOB NOT NULL, link TEXT"
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url: str) -> Optional[Tuple[str, bytes, Optional[str]]]:
+        """
+        (ETag, body, Link header) stored for url, or None.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT etag, body, link FROM responses WHERE url = ?", (url,)).fetchone()
+        return (row[0], bytes(row[1]), row[2]) if row is not None else None
+
+    def put(self, url: str, etag: str, body: bytes, link: Optional[str]=None) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (url, etag, body, link) VALUES (?, ?, ?, ?)", (url, etag, body, link)
+            )
+
+    def record(self, hit: bool) -> None:
+        """
+        Count a request that was answered with 304 (hit), or any other request,
+        conditional or not (miss).
+        """
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total > 0 else 0.0,
+            }
@@ -5,24 +5,233 @@ import math
 import re
 import os
 import typing 
-from typing import Union, List, Tuple, Dict
+from typing import Union, List, Tuple, Dict, Optional, Callable, Iterator
 from tqdm import tqdm
 import chardet
 import logging
 import warnings
 import pickle
+import json
 import base64
+import random
+import threading
+import time
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+from utils.blob_store import BlobStore
+from utils.response_cache import ResponseCache
+from utils.shard_writer import ShardWriter
 
 
 logger = logging.getLogger(__name__)
 
+class RequestScheduler:
+    """
+    Send GET requests while staying under the GitHub API rate limit. Shared by all worker threads.
+     - Tracks the budget of the current window from X-RateLimit-Remaining/Reset, counting in-flight requests
+     - Once the budget falls under pace_below of the limit, spreads the remaining requests evenly until the reset
+     - Waits out rate limited (403/429) responses, for Retry-After seconds or until the reset, and retries them
+     - Retries connection errors and 5xx responses with exponential backoff and full jitter
+
+    Args:
+        session: requests.Session to send requests with
+        max_retries: max number of retries per request
+        backoff_factor: base delay in seconds, attempt n waits up to backoff_factor * 2**n
+        max_backoff: max delay in seconds of a single backoff
+        pace_below: fraction of the limit under which requests are paced
+    """
+    RETRY_STATUSES = {500, 502, 503, 504}
+
+    def __init__(
+        self,
+        session: requests.Session,
+        max_retries: int=5,
+        backoff_factor: float=0.5,
+        max_backoff: float=60.0,
+        pace_below: float=0.1
+    ):
+        self.session = session
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.pace_below = pace_below
+
+        self._lock = threading.Lock()
+        self._limit = None
+        self._remaining = None
+        self._reset = None # Epoch seconds
+        self._blocked_until = 0.0 # Epoch seconds
+        self._next_slot = 0.0 # Epoch seconds
+
+        self.n_requests = 0
+        self.n_retries = 0
+        self.n_rate_limited = 0
+        self.n_errors = 0
+        self.wait_seconds = 0.0
+        self._start = None
+        self._end = None
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Throughput and retry counters. wait_seconds adds up the waits of all threads.
+        """
+        with self._lock:
+            elapsed = (self._end - self._start) if self._start is not None else 0.0
+            return {
+                "requests": self.n_requests,
+                "retries": self.n_retries,
+                "rate_limited": self.n_rate_limited,
+                "errors": self.n_errors,
+                "wait_seconds": round(self.wait_seconds, 3),
+                "elapsed_seconds": round(elapsed, 3),
+                "requests_per_second": round(self.n_requests / elapsed, 2) if elapsed > 0 else 0.0,
+                "rate_limit_remaining": self._remaining,
+            }
+
+    def _acquire(self) -> None:
+        """
+        Block until a request may be sent, then spend one request of the budget.
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                wait = self._blocked_until - now
+                if wait <= 0 and self._remaining is not None and self._reset is not None:
+                    if now >= self._reset:
+                        # New window, the budget is unknown until the next response
+                        self._remaining = None
+                    elif self._remaining <= 0:
+                        wait = self._reset - now
+                    elif self._limit and self._remaining < self.pace_below * self._limit:
+                        wait = self._next_slot - now
+                        if wait <= 0:
+                            self._next_slot = now + (self._reset - now) / self._remaining
+                if wait <= 0:
+                    if self._remaining is not None:
+                        self._remaining -= 1
+                    self.n_requests += 1
+                    if self._start is None:
+                        self._start = time.monotonic()
+                    return
+                self.wait_seconds += wait
+            time.sleep(wait)
+
+    def _update(self, response: requests.Response) -> None:
+        """
+        Update the budget from rate limit headers.
+        """
+        headers = response.headers
+        with self._lock:
+            self._end = time.monotonic()
+            if "X-RateLimit-Remaining" not in headers:
+                return
+            try:
+                remaining = int(headers["X-RateLimit-Remaining"])
+                reset = float(headers.get("X-RateLimit-Reset", 0)) or None
+                limit = int(headers.get("X-RateLimit-Limit", 0)) or None
+            except ValueError:
+                return
+
+            if self._reset is not None and reset is not None and reset < self._reset:
+                return # Late response from a previous window
+            if self._remaining is None or reset != self._reset:
+                self._remaining = remaining
+            else:
+                # Other threads' requests may still be in flight, keep the lower count.
+                # Conditional hits (304) don't count against the limit, refund them.
+                self._remaining = min(self._remaining + (response.status_code == 304), remaining)
+            self._reset = reset
+            self._limit = limit
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** attempt))
+
+    def _rate_limit_delay(
+        self,
+        response: requests.Response,
+        attempt: int
+    ) -> Optional[float]:
+        """
+        Seconds to wait before retrying a rate limited response, or None if response isn't rate limited.
+        """
+        if response.status_code not in (403, 429):
+            return None
+        headers = response.headers
+        retry_after = headers.get("Retry-After")
+        if retry_after is not None:
+            try:
+                return max(float(retry_after), 0.0)
+            except ValueError:
+                pass
+        if headers.get("X-RateLimit-Remaining") == "0" and headers.get("X-RateLimit-Reset"):
+            return max(float(headers["X-RateLimit-Reset"]) - time.time(), 0.0)
+        if response.status_code == 429 or "rate limit" in response.text.lower():
+            # Secondary rate limit without a hint
+            return self._backoff(attempt)
+        return None
+
+    def get(
+        self,
+        url: str,
+        **kwargs
+    ) -> requests.Response:
+        """
+        GET url, retrying rate limited and transient failures.
+        The last response is returned (or the last connection error raised) once retries run out.
+        """
+        for attempt in range(self.max_retries + 1):
+            self._acquire()
+            try:
+                response = self.session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                with self._lock:
+                    self.n_errors += 1
+                if attempt == self.max_retries:
+                    raise e
+                logger.debug(f"{type(e).__name__} for {url}, retrying")
+                delay = self._backoff(attempt)
+            else:
+                self._update(response)
+                rate_limit_delay = self._rate_limit_delay(response, attempt)
+                if rate_limit_delay is None and response.status_code not in self.RETRY_STATUSES:
+                    return response
+                if attempt == self.max_retries:
+                    return response
+
+                if rate_limit_delay is not None:
+                    logger.info(f"Rate limited by {url}, pausing requests for {rate_limit_delay:.1f}s")
+                    with self._lock:
+                        self.n_rate_limited += 1
+                        self.n_retries += 1
+                        # Pause every thread, the limit is shared
+                        self._blocked_until = max(self._blocked_until, time.time() + rate_limit_delay)
+                    continue
+                with self._lock:
+                    self.n_errors += 1
+                logger.debug(f"{response.status_code} response from {url}, retrying")
+                delay = self._backoff(attempt)
+
+            with self._lock:
+                self.n_retries += 1
+                self.wait_seconds += delay
+            time.sleep(delay)
+
+
 class GitHubScraper:
     def __init__(
         self,
         base_url: str="https://api.github.com/",
         auth_username: str=None,
         auth_token: str=None,
-        use_tqdm: bool=True
+        use_tqdm: bool=True,
+        max_workers: int=8,
+        max_retries: int=5,
+        backoff_factor: float=0.5,
+        blob_cache: str=None,
+        response_cache: str=None,
+        per_page: int=100
     ):
         """Initialize GitHubScraper
  
@@ -31,6 +240,14 @@ class GitHubScraper:
             auth_username: username for authentication for github api requests
             auth_token: token for authentication for github api requests
             use_tqdm: whether to display tqdm progress bar (only visible in __call__)
+            max_workers: max number of concurrent requests when fetching file data (1 for serial requests)
+            max_retries: max number of retries of rate limited or failed requests
+            backoff_factor: base delay in seconds of exponential backoff between retries
+            blob_cache: path of a BlobStore database. Blobs found in it aren't fetched again, 
+                        and fetched blobs are added to it, so repeated or interrupted scrapes are incremental
+            response_cache: path of a ResponseCache database. Repo and tree listings are requested 
+                            conditionally (If-None-Match), unchanged listings are read from it
+            per_page: page size of paginated listings (max 100 for the github api)
         """
         self.base_url = base_url
         if auth_username is not None or auth_token is not None:
@@ -38,6 +255,17 @@ class GitHubScraper:
         else:
             self.auth = None
         self.use_tqdm = use_tqdm
+        self.max_workers = max(max_workers, 1)
+        self.per_page = per_page
+
+        # Pooled connections, shared by all requests (and worker threads)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.scheduler = RequestScheduler(self.session, max_retries=max_retries, backoff_factor=backoff_factor)
+        self.blob_store = BlobStore(blob_cache) if blob_cache is not None else None
+        self.response_cache = ResponseCache(response_cache) if response_cache is not None else None
 
     def __call__(
         self,
@@ -48,7 +276,10 @@ class GitHubScraper:
         file_endings: Union[str, List[str]]=None,
         remove_duplicates: bool=True,
         save_dir: str=None,
-        file_name: str=None
+        file_name: str=None,
+        output_dir: str=None,
+        output_format: str="jsonl",
+        shard_size: int=10000
     ) -> List[str]:
         """Alias for self.scrape
         """
@@ -61,7 +292,10 @@ class GitHubScraper:
             file_endings = file_endings,
             remove_duplicates = remove_duplicates,
             save_dir = save_dir,
-            file_name = file_name
+            file_name = file_name,
+            output_dir = output_dir,
+            output_format = output_format,
+            shard_size = shard_size
         )
 
 
@@ -74,58 +308,67 @@ class GitHubScraper:
         file_endings: Union[str, List[str]]=None,
         remove_duplicates: bool=True,
         save_dir: str=None,
-        file_name: str=None
+        file_name: str=None,
+        output_dir: str=None,
+        output_format: str="jsonl",
+        shard_size: int=10000
     ) -> List[str]:
         """
         Get all files from user or list of users
+
+        If output_dir is given, files are streamed to jsonl/parquet shards in output_dir as they 
+        arrive instead of being kept in memory (see utils.shard_writer.ShardWriter), and duplicates 
+        are removed by content hash. Rerunning with the same output_dir resumes, skipping files 
+        already written. In this case, the shard paths are returned (and save_dir is ignored).
         """
 
         if isinstance(users, str):
             users = [users]
 
-        if remove_duplicates:
-            all_data = set()
-        else:
-            all_data = []
-
-        for user in users:
-            repos = self.get_repos(user=user, get_forks=get_forks, 
-                                   urls_only=False)
+        # Enumerate repos of all users, then files of all repos, then fetch all files.
+        # Each stage runs up to self.max_workers requests at a time, in order.
+        user_repos = self._map(
+            lambda user: self.get_repos(user=user, get_forks=get_forks, urls_only=False),
+            users,
+            desc='Retrieving repos'
+        )
 
-            repo_urls = []
+        repo_urls = []
+        for repos in user_repos:
             for repo in repos:
                 repo_url = self.resolve_path_parameters(repo["trees_url"], 
                                                         "sha", 
                                                         repo["default_branch"])
                 repo_urls.append(repo_url)
-            
-            if self.use_tqdm:
-                pbar = tqdm(repo_urls, desc=f'Retrieving files for user {user}')
-            else:
-                logger.info(f'Retrieving files for user {user}')
-                pbar = repo_urls
-            
-            all_file_urls = []
-            for repo_url in pbar:
-                file_urls = self.get_repo_files(repo_url=repo_url, 
-                                           branch_or_commit_hash=None, # Already added.
-                                           hidden_files=hidden_files,
-                                           file_endings=file_endings,
-                                           urls_only=True)
-
-                all_file_urls += file_urls
-            
-            logger.info(f'Retrieving file data for user {user}')
-
-            data = self.get_data(all_file_urls)
-            # data = list(data)
-
-            if remove_duplicates:
-                all_data.update(data)
-            else:
-                all_data += data
 
-        all_data = list(all_data) if remove_duplicates else all_data
+        repo_file_urls = self._map(
+            lambda repo_url: self.get_repo_files(repo_url=repo_url, 
+                                                 branch_or_commit_hash=None, # Already added.
+                                                 hidden_files=hidden_files,
+                                                 file_endings=file_endings,
+                                                 urls_only=True),
+            repo_urls,
+            desc='Retrieving repo files'
+        )
+        all_file_urls = [file_url for file_urls in repo_file_urls for file_url in file_urls]
+        logger.info(f'Retrieving file data for {len(all_file_urls)} files in {len(repo_urls)} repos')
+
+        if output_dir is not None:
+            with ShardWriter(output_dir, output_format=output_format, shard_size=shard_size,
+                             dedup=remove_duplicates, resume_key="url") as writer:
+                self.stream_data(all_file_urls, writer)
+            logger.info(f"Wrote {writer.n_written} files ({writer.n_duplicates} duplicates, "
+                        f"{writer.n_resumed} already written skipped) to {output_dir}")
+            self.log_stats()
+            return writer.shards
+
+        data = self.get_data(all_file_urls)
+        if remove_duplicates:
+            # Keep first occurrences, in order
+            all_data = list(dict.fromkeys(data))
+        else:
+            all_data = data
+        self.log_stats()
 
         if save_dir is not None:
             if file_name is None:
@@ -204,13 +447,87 @@ class GitHubScraper:
         Get user request
         """   
         url = self.join_url(self.base_url, 'users', user)
-        r = requests.get(url, auth=self.auth)
+        r = self.scheduler.get(url, auth=self.auth)
         if r.status_code == 200: 
             logger.debug(f"{r.status_code} response for GET user request from {url}")
         else:
             logger.warning(f"{r.status_code} response from {url}")
         return r
 
+    def _get_json(
+        self,
+        url: str
+    ) -> Tuple[int, object, Optional[str]]:
+        """
+        GET json from url, conditionally if self.response_cache has an ETag for it.
+        A 304 response is answered from the cache, as status 200.
+
+        Returns
+            status code, json body (None unless status is 200) and url of the next page (if any)
+        """
+        cached = self.response_cache.get(url) if self.response_cache is not None else None
+        headers = {"If-None-Match": cached[0]} if cached is not None else None
+        r = self.scheduler.get(url, auth=self.auth, headers=headers)
+
+        if self.response_cache is not None:
+            self.response_cache.record(hit=cached is not None and r.status_code == 304)
+            if cached is not None and r.status_code == 304:
+                _, body, link = cached
+                return 200, json.loads(body), self.next_page_url(link)
+        if r.status_code != 200:
+            return r.status_code, None, None
+        link = r.headers.get("Link")
+        if self.response_cache is not None and r.headers.get("ETag"):
+            self.response_cache.put(url, r.headers["ETag"], r.content, link)
+        return r.status_code, r.json(), self.next_page_url(link)
+
+    def get_json(
+        self,
+        url: str
+    ) -> Tuple[int, object]:
+        """
+        GET json from url (see _get_json).
+
+        Returns
+            status code and json body (None unless status is 200)
+        """
+        status, body, _ = self._get_json(url)
+        return status, body
+
+    def get_json_pages(
+        self,
+        url: str
+    ) -> Tuple[int, list]:
+        """
+        GET a paginated json list from url, following the rel="next" Link headers.
+
+        Returns
+            status code of the first failed page (or 200) and the concatenated items of all pages
+            (empty if a page failed)
+        """
+        items = []
+        while url is not None:
+            status, page, url = self._get_json(url)
+            if status != 200:
+                return status, []
+            items += page
+        return 200, items
+
+    @staticmethod
+    def next_page_url(
+        link: Optional[str]
+    ) -> Optional[str]:
+        """
+        Url of the rel="next" page of a Link header, e.g.
+            <https://api.github.com/user/1/repos?page=2>; rel="next", <https://api.github.com/user/1/repos?page=5>; rel="last"
+        """
+        if not link:
+            return None
+        for part in requests.utils.parse_header_links(link):
+            if part.get("rel") == "next":
+                return part.get("url")
+        return None
+
     def get_repos(
         self,
         user: str,
@@ -224,16 +541,14 @@ class GitHubScraper:
 
         Add additional function to handle multiple users.
         """
-        url = self.join_url(self.base_url, 'users', user, 'repos')
-        r = requests.get(url, auth=self.auth)
-        status = r.status_code
+        url = self.join_url(self.base_url, 'users', user, 'repos') + f"?per_page={self.per_page}"
+        status, all_repos = self.get_json_pages(url)
         if status == 200: 
             logger.debug(f"{status} response for GET public repos request from {url}")
         else:
             logger.warning(f"{status} response from {url}: unable to get repos")
             return []
         
-        all_repos = r.json()
         logger.info(f"Retrieving data for {len(all_repos)} repos from user {user}")
 
         repos = []
@@ -314,15 +629,14 @@ class GitHubScraper:
         if "?recursive" not in url:
             url += "?recursive=1"
 
-        r = requests.get(url, auth=self.auth)
-        status = r.status_code
+        status, tree = self.get_json(url)
         if status == 200: 
             logger.debug(f"{status} response for GET repo contents from {url}")
         else:
             logger.warning(f"{status} response from {url}: unable to get contents")
             return []
 
-        contents = r.json()['tree']
+        contents = tree['tree']
         if file_endings is not None:
             file_endings = self.format_file_endings(file_endings)
 
@@ -337,52 +651,175 @@ class GitHubScraper:
                     files.append(item if not urls_only else item["url"])
         return files
 
-    def get_data(
+    @staticmethod
+    def blob_sha(
+        file_url: str
+    ) -> Optional[str]:
+        """
+        Git blob SHA of a blob url, e.g. https://api.github.com/repos/{user}/{repo}/git/blobs/{sha}
+        """
+        match = re.search(r"/git/blobs/([0-9a-fA-F]{40}|[0-9a-fA-F]{64})/?$", file_url)
+        return match.group(1).lower() if match else None
+
+    def get_file(
         self,
-        file_urls: Union[str, List[str]],
+        file_url: str,
         raise_content_errors: bool=False,
         raise_decode_errors: bool=False
-    ) -> Dict[str, str]:
+    ) -> Optional[str]:
         """
-        Given list of files, Returns text data from files. 
+        Get decoded text of a single blob, or None if it has no content or can't be decoded.
+        Blobs in self.blob_store are read from it instead of being fetched.
 
         Raises
-            KeyError if response contains no "content"
+            KeyError if response contains no "content" and raise_content_errors
         """
-        if isinstance(file_urls, str):
-            file_urls = [file_urls]
+        sha = self.blob_sha(file_url) if self.blob_store is not None else None
+        raw = self.blob_store.get(sha) if sha is not None else None
 
-        if self.use_tqdm:
-            pbar = tqdm(file_urls, desc=f'Retrieving file data')
-        else:
-            logger.info(f'Retrieving file data')
-            pbar = file_urls
-
-        texts = []
-        for file_url in pbar:
-            data = requests.get(file_url, auth=self.auth)
+        if raw is None:
+            data = self.scheduler.get(file_url, auth=self.auth)
             try:
                 content = data.json()["content"]
             except KeyError as e:
                 logger.warning(f"No content detected for file {file_url}")
                 if raise_content_errors:
                     raise e
-                else:
-                    continue
-                
+                return None
+
             try:
-                decoded_text = base64.b64decode(content)
-                texts.append(decoded_text.decode())
-                # texts[file_url] = decoded_text.decode()
+                raw = base64.b64decode(content)
             except Exception as e:
                 warnings.warn(f"Unable to decode content for file at: {file_url}")
                 if raise_decode_errors:
-                    raise e 
+                    raise e
+                return None
+            if sha is not None:
+                self.blob_store.put(sha, raw)
+
+        try:
+            return raw.decode()
+        except Exception as e:
+            warnings.warn(f"Unable to decode content for file at: {file_url}")
+            if raise_decode_errors:
+                raise e
+            return None
+
+    def get_data(
+        self,
+        file_urls: Union[str, List[str]],
+        raise_content_errors: bool=False,
+        raise_decode_errors: bool=False
+    ) -> List[str]:
+        """
+        Given list of files, Returns text data from files. 
+        Files are fetched concurrently (up to self.max_workers at a time), 
+        texts are returned in the order of file_urls.
+
+        Raises
+            KeyError if response contains no "content"
+        """
+        if isinstance(file_urls, str):
+            file_urls = [file_urls]
+
+        def fetch(file_url):
+            return self.get_file(file_url, raise_content_errors=raise_content_errors,
+                                 raise_decode_errors=raise_decode_errors)
+
+        results = self._map(fetch, file_urls, desc='Retrieving file data')
+        texts = [text for text in results if text is not None]
 
         logger.info(f'Decoded data for {len(texts)}/{len(file_urls)} files')
             
         return texts
 
+    def stream_data(
+        self,
+        file_urls: Union[str, List[str]],
+        writer: ShardWriter,
+        raise_content_errors: bool=False,
+        raise_decode_errors: bool=False
+    ) -> int:
+        """
+        Like get_data, but write each text (with its url) to writer as it arrives, in order.
+        Files already in the writer's shards (e.g. from an interrupted run) are skipped, see ShardWriter's resume_key.
+
+        Returns
+            number of texts written
+        """
+        if isinstance(file_urls, str):
+            file_urls = [file_urls]
+
+        def fetch(file_url):
+            return self.get_file(file_url, raise_content_errors=raise_content_errors,
+                                 raise_decode_errors=raise_decode_errors)
+
+        n_written = 0
+        n_texts = 0
+        for file_url, text in zip(file_urls, self._imap(fetch, file_urls, desc='Retrieving file data')):
+            if text is not None:
+                n_texts += 1
+                n_written += writer.write(text, url=file_url)
+
+        logger.info(f'Decoded data for {n_texts}/{len(file_urls)} files, wrote {n_written}')
+        return n_written
+
+    def log_stats(self) -> None:
+        logger.info(f"Request stats: {self.scheduler.stats()}")
+        if self.blob_store is not None:
+            logger.info(f"Blob cache: {self.blob_store.hits} hits, {self.blob_store.misses} misses")
+        if self.response_cache is not None:
+            logger.info(f"Response cache: {self.response_cache.stats()}")
+
+    def _imap(
+        self,
+        fn: Callable,
+        items: List,
+        desc: str=None
+    ) -> Iterator:
+        """
+        Lazily yield fn(item) for item in items, running up to self.max_workers calls concurrently.
+        Results are in the order of items, and the first error raised by fn is re-raised.
+        At most 2 * self.max_workers calls are in flight, so a stalled call holds back a bounded
+        number of results.
+        """
+        if self.use_tqdm:
+            pbar = lambda results: tqdm(results, total=len(items), desc=desc)
+        else:
+            logger.info(desc)
+            pbar = lambda results: results
+
+        if self.max_workers == 1 or len(items) <= 1:
+            yield from pbar(map(fn, items))
+            return
+        def results(executor):
+            # Yields in submission order and re-raises a task's error when it is reached
+            in_flight = collections.deque()
+            try:
+                for item in items:
+                    in_flight.append(executor.submit(fn, item))
+                    if len(in_flight) >= 2 * self.max_workers:
+                        yield in_flight.popleft().result()
+                while in_flight:
+                    yield in_flight.popleft().result()
+            finally:
+                for future in in_flight:
+                    future.cancel()
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(items))) as executor:
+            yield from pbar(results(executor))
+
+    def _map(
+        self,
+        fn: Callable,
+        items: List,
+        desc: str=None
+    ) -> List:
+        """
+        [fn(item) for item in items], see _imap.
+        """
+        return list(self._imap(fn, items, desc=desc))
+
     def save_data(
         self,
         data: Union[str, list[str], dict],
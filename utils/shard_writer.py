@@ -0,0 +1,284 @@
+"""
+Stream text records to JSONL or Parquet shards on disk. Includes:
+ - content_digest(text)
+ - ShardWriter
+ - shard_paths(path)
+ - read_shards(path)
+
+A directory of shards loads directly with datasets.load_dataset(<dir>) (or
+load_dataset("json"/"parquet", data_files=...)) and with scripts/clean_data.py.
+
+Records are deduplicated on the fly by a 128-bit digest of their text, so only
+digests are kept in memory. A ShardWriter opened on an existing directory resumes:
+it reads the records already written (their resume_key field, e.g. the url, or text
+digest), skips them when they are written again and starts a new shard.
+"""
+import os
+import re
+import json
+import hashlib
+import threading
+import typing
+from typing import (
+    Optional,
+    Iterator,
+    List,
+    Dict
+)
+import logging
+
+logger = logging.getLogger(__name__)
+
+SHARD_FORMATS = ["jsonl", "parquet"]
+_SHARD_PATTERN = re.compile(r"^shard-(\d{5})\.(jsonl|parquet)$")
+
+
+def content_digest(text: str) -> bytes:
+    """
+    128-bit digest of text used for deduplication.
+    """
+    return hashlib.blake2b(text.encode("utf-8", errors="surrogatepass"), digest_size=16).digest()
+
+
+def shard_paths(path: str) -> List[str]:
+    """
+    Sorted shard files of a shard directory, or [path] if path is a single shard file.
+    """
+    if not os.path.isdir(path):
+        return [path]
+    return [
+        os.path.join(path, name) for name in sorted(os.listdir(path))
+        if _SHARD_PATTERN.match(name)
+    ]
+
+
+def read_shards(path: str, columns: Optional[List[str]]=None) -> Iterator[Dict]:
+    """
+    Iterate over the records of a shard directory or a single .jsonl/.parquet file.
+    """
+    for shard in shard_paths(path):
+        if shard.endswith(".parquet"):
+            import pyarrow.parquet as pq
+            parquet_file = pq.ParquetFile(shard)
+            for batch in parquet_file.iter_batches(columns=columns):
+                yield from batch.to_pylist()
+        else:
+            with open(shard, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        yield record if columns is None else {k: record.get(k) for k in columns}
+
+
+class ShardWriter:
+    """
+    Append records ({"text": ..., **metadata}) to numbered shards in output_dir.
+    Thread safe.
+
+    Jsonl shards are flushed to disk every flush_every records, so at most that many
+    records are lost in a crash. Parquet shards are written one row group per flush_every
+    records to shard-xxxxx.parquet.tmp, which is renamed once the shard is complete. A
+    .tmp shard has no footer and can't be read back, so a crash loses the whole incomplete
+    parquet shard (up to shard_size records), which a resumed run writes again.
+
+    Parquet shards take the schema given, or else the one inferred from their first
+    records, with all-null fields typed as strings. When later records bring new fields
+    (or types that only fit a wider schema), the shard is closed and the next one starts
+    with the widened schema.
+
+    Args
+        output_dir: directory to write shard-xxxxx.jsonl/.parquet files to
+        output_format: "jsonl" or "parquet"
+        shard_size: max number of records per shard
+        flush_every: number of records between flushes
+        dedup: whether to skip records with the same text as a previous record
+        resume_key: metadata field identifying a record (e.g. "url"), to skip records of
+            existing shards when resuming. By default, records are identified by their text
+        schema: optional pyarrow schema of parquet shards, records can't have other fields
+    """
+    def __init__(
+        self,
+        output_dir: str,
+        output_format: str="jsonl",
+        shard_size: int=10000,
+        flush_every: int=100,
+        dedup: bool=True,
+        resume_key: Optional[str]=None,
+        schema=None
+    ):
+        if output_format not in SHARD_FORMATS:
+            raise ValueError(f"output_format must be one of {SHARD_FORMATS}, got {output_format}")
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.output_format = output_format
+        self.shard_size = shard_size
+        self.flush_every = flush_every
+        self.dedup = dedup
+        self.resume_key = resume_key
+        self.schema = schema
+        self._fixed_schema = schema is not None
+
+        self.n_written = 0
+        self.n_duplicates = 0
+        self.n_resumed = 0
+        self.shards = []
+        self._digests = set()
+        # Keys (or text digests) of the records of existing shards
+        self._resumed = set()
+        self._lock = threading.Lock()
+        self._file = None
+        self._buffer = []
+        self._shard_count = 0
+        self._next_index = self._resume()
+
+    def _resume(self) -> int:
+        """
+        Collect the keys and digests of existing shards, repair a jsonl shard cut off
+        mid-line and remove incomplete parquet shards. Returns the index of the next shard.
+        """
+        next_index = 0
+        for name in sorted(os.listdir(self.output_dir)):
+            path = os.path.join(self.output_dir, name)
+            if name.endswith(".parquet.tmp"):
+                logger.warning(f"Removing incomplete shard {path}")
+                os.remove(path)
+                continue
+            match = _SHARD_PATTERN.match(name)
+            if match is None:
+                continue
+            next_index = max(next_index, int(match.group(1)) + 1)
+            if match.group(2) == "jsonl":
+                self._repair_jsonl(path)
+            columns = ["text"] if self.resume_key is None else ["text", self.resume_key]
+            for record in read_shards(path, columns=columns):
+                digest = content_digest(record["text"])
+                if self.dedup:
+                    self._digests.add(digest)
+                # With dedup and no key, the digests already identify written records
+                if self.resume_key is not None:
+                    self._resumed.add(record[self.resume_key])
+                elif not self.dedup:
+                    self._resumed.add(digest)
+            self.shards.append(path)
+
+        if self.shards:
+            logger.info(f"Resuming after {len(self.shards)} shards with {max(len(self._digests), len(self._resumed))} "
+                        f"records in {self.output_dir}")
+        return next_index
+
+    @staticmethod
+    def _repair_jsonl(path: str) -> None:
+        with open(path, "rb+") as f:
+            data = f.read()
+            end = len(data)
+            if end == 0 or data.endswith(b"\n"):
+                return
+            # Drop the partial last line of a crashed run
+            end = data.rfind(b"\n") + 1
+            f.truncate(end)
+        logger.warning(f"Truncated partial record at the end of {path}")
+
+    def __enter__(self) -> "ShardWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def write(self, text: str, **metadata) -> bool:
+        """
+        Append a record. Returns False if it was skipped as a duplicate or as written by
+        a previous run.
+        """
+        with self._lock:
+            if self._resumed:
+                key = metadata.get(self.resume_key) if self.resume_key is not None else content_digest(text)
+                if key in self._resumed:
+                    self.n_resumed += 1
+                    return False
+            if self.dedup:
+                digest = content_digest(text)
+                if digest in self._digests:
+                    self.n_duplicates += 1
+                    return False
+                self._digests.add(digest)
+
+            if self._file is None and not self._buffer:
+                self._open_shard()
+            record = {"text": text, **metadata}
+            if self.output_format == "jsonl":
+                self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            else:
+                self._buffer.append(record)
+
+            self.n_written += 1
+            self._shard_count += 1
+            if self._shard_count % self.flush_every == 0:
+                self._flush()
+            if self._shard_count >= self.shard_size:
+                self._close_shard()
+            return True
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._close_shard()
+
+    def _shard_path(self) -> str:
+        return os.path.join(self.output_dir, f"shard-{self._next_index:05d}.{self.output_format}")
+
+    def _open_shard(self) -> None:
+        self._shard_count = 0
+        if self.output_format == "jsonl":
+            self._file = open(self._shard_path(), "w", encoding="utf-8")
+
+    def _flush(self) -> None:
+        if self.output_format == "jsonl":
+            if self._file is not None:
+                self._file.flush()
+            return
+        if not self._buffer:
+            return
+
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if self._fixed_schema:
+            unknown = set().union(*self._buffer) - set(self.schema.names)
+            if unknown:
+                raise ValueError(f"Fields {sorted(unknown)} are not in the shard schema {self.schema.names}.")
+        else:
+            inferred = pa.Table.from_pylist(self._buffer).schema
+            # A field that is None in every record so far is most likely a string
+            inferred = pa.schema([f.with_type(pa.string()) if pa.types.is_null(f.type) else f for f in inferred])
+            try:
+                schema = inferred if self.schema is None else pa.unify_schemas([self.schema, inferred], promote_options="permissive")
+            except (pa.ArrowTypeError, pa.ArrowInvalid) as e:
+                raise ValueError(f"Records don't fit the shard schema {self.schema}, pass a schema: {e}") from e
+            if self._file is not None and not schema.equals(self.schema):
+                logger.info(f"Starting a new shard for the schema {schema}")
+                self._finish_shard()
+                self._shard_count = len(self._buffer)
+            self.schema = schema
+
+        table = pa.Table.from_pylist(self._buffer, schema=self.schema)
+        if self._file is None:
+            self._file = pq.ParquetWriter(self._shard_path() + ".tmp", self.schema)
+        self._file.write_table(table)
+        self._buffer = []
+
+    def _close_shard(self) -> None:
+        self._flush()
+        self._finish_shard()
+
+    def _finish_shard(self) -> None:
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        path = self._shard_path()
+        if self.output_format == "parquet":
+            os.replace(path + ".tmp", path)
+        self.shards.append(path)
+        self._next_index += 1
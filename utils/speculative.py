@@ -0,0 +1,157 @@
+"""
+Speculative (assisted) greedy decoding: a cheap drafter proposes the next tokens and the
+model verifies them all in one forward pass, keeping the longest prefix it agrees with
+plus its own next token. Completions are the same as plain greedy decoding, in fewer
+sequential forward passes of the model. Includes:
+ - NgramDrafter
+ - ModelDrafter
+ - SpeculativeDecoder
+
+Drafters are duck typed: draft(token_ids, n) -> up to n token ids following token_ids.
+NgramDrafter looks the last tokens up in the context (prompt lookup, code repeats its
+identifiers and rule patterns a lot) and in an optional corpus, e.g. tokenized NLP++
+passes. ModelDrafter runs a small causal lm with the same vocabulary.
+"""
+import typing
+from typing import (
+    Optional,
+    Tuple,
+    List,
+    Dict
+)
+import logging
+
+import torch
+
+from utils.batching import crop_cache
+
+logger = logging.getLogger(__name__)
+
+
+class NgramDrafter:
+    """
+    Draft the tokens that followed the latest earlier occurrence of the last n tokens,
+    trying n from ngram_size down to min_ngram_size, first in the context, then in corpus.
+
+    Args
+        ngram_size: longest n-gram looked up
+        min_ngram_size: shortest n-gram looked up
+        corpus: optional token id sequences to draft from, e.g. the tokenized training set
+    """
+    def __init__(self, ngram_size: int=3, min_ngram_size: int=2, corpus: Optional[List[List[int]]]=None):
+        self.ngram_size = ngram_size
+        self.min_ngram_size = min_ngram_size
+        self.corpus = [list(ids) for ids in corpus or []]
+        # n-gram -> (sequence, end of its last occurrence), for every n
+        self.index: Dict[Tuple[int, ...], Tuple[int, int]] = {}
+        for seq, ids in enumerate(self.corpus):
+            for end in range(1, len(ids)):
+                for n in range(min_ngram_size, min(ngram_size, end) + 1):
+                    self.index[tuple(ids[end - n:end])] = (seq, end)
+
+    def draft(self, token_ids: List[int], n: int) -> List[int]:
+        if n <= 0:
+            return []
+        for size in range(min(self.ngram_size, len(token_ids) - 1), self.min_ngram_size - 1, -1):
+            ngram = token_ids[-size:]
+            # Latest earlier occurrence with a continuation, scanning back from the end. A
+            # continuation running into the end repeats, as the context would on a match
+            for end in range(len(token_ids) - 1, size - 1, -1):
+                if token_ids[end - size:end] == ngram:
+                    period = len(token_ids) - end
+                    return [token_ids[end + i % period] for i in range(n)]
+            if tuple(ngram) in self.index:
+                seq, end = self.index[tuple(ngram)]
+                return self.corpus[seq][end:end + n]
+        return []
+
+
+class ModelDrafter:
+    """
+    Draft greedily with a small causal lm sharing the model's tokenizer. Its KV cache is
+    kept between calls and cut back to the prefix it shares with the next context.
+    Not thread safe, see SpeculativeDecoder.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.device = next(model.parameters()).device
+        self.ids = []
+        self.cache = None
+
+    @torch.no_grad()
+    def draft(self, token_ids: List[int], n: int) -> List[int]:
+        if n <= 0:
+            return []
+        common = 0
+        limit = min(len(self.ids), len(token_ids) - 1)
+        while common < limit and self.ids[common] == token_ids[common]:
+            common += 1
+        cache = crop_cache(self.cache, common) if self.cache is not None and common > 0 else None
+
+        drafted = []
+        input_ids = token_ids[common if cache is not None else 0:]
+        for _ in range(n):
+            out = self.model(input_ids=torch.tensor([input_ids], device=self.device), past_key_values=cache, use_cache=True)
+            cache = out.past_key_values
+            drafted.append(int(torch.argmax(out.logits[0, -1])))
+            input_ids = drafted[-1:]
+        # The last drafted token isn't in the cache yet
+        self.ids, self.cache = token_ids + drafted[:-1], cache
+        return drafted
+
+
+class SpeculativeDecoder:
+    """
+    Decode greedy requests num_draft_tokens + 1 tokens per model forward pass at best.
+
+    Args
+        model: causal lm, in eval mode
+        drafter: NgramDrafter, ModelDrafter or any object with draft(token_ids, n)
+        num_draft_tokens: tokens drafted per step
+    """
+    def __init__(self, model, drafter, num_draft_tokens: int=4):
+        self.model = model
+        self.drafter = drafter
+        self.num_draft_tokens = num_draft_tokens
+        self.device = next(model.parameters()).device
+        self.n_steps = 0
+        self.n_drafted = 0
+        self.n_accepted = 0
+        self.n_decoded = 0
+
+    @torch.no_grad()
+    def step(self, request, cache) -> Tuple[bool, object]:
+        """
+        Decode tokens of a prefilled greedy request (see utils.completion.GenerationRequest)
+        with one forward pass over its last token and a draft. Returns whether the request
+        is finished and its cache.
+        """
+        token_ids = request.input_ids + request.token_ids
+        n_draft = min(self.num_draft_tokens, request.max_new_tokens - len(request.token_ids) - 1)
+        draft = self.drafter.draft(token_ids, n_draft)[:max(n_draft, 0)]
+        out = self.model(
+            input_ids=torch.tensor([[request.last_token] + draft], device=self.device),
+            past_key_values=cache,
+            use_cache=True
+        )
+
+        # The model's token after each accepted draft token is exact, the first that
+        # differs from the draft replaces it
+        n_accepted = 0
+        for i in range(len(draft) + 1):
+            finished = request.push(out.logits[0, i])
+            if finished or i == len(draft) or request.last_token != draft[i]:
+                break
+            n_accepted += 1
+        self.n_steps += 1
+        self.n_drafted += len(draft)
+        self.n_accepted += n_accepted
+        self.n_decoded += i + 1
+        return finished, crop_cache(out.past_key_values, len(token_ids) + n_accepted)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "steps": self.n_steps,
+            "acceptance_rate": self.n_accepted / self.n_drafted if self.n_drafted else 0.0,
+            "tokens_per_step": self.n_decoded / self.n_steps if self.n_steps else 0.0,
+        }
@@ -0,0 +1,52 @@
+"""
+Base class for the thread safe, on-disk SQLite tables used by the scraper. Includes:
+ - SqliteStore
+
+Subclasses (utils.blob_store.BlobStore, utils.response_cache.ResponseCache) set TABLE
+and COLUMNS and run their own queries on self._conn, holding self._lock.
+"""
+import os
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SqliteStore:
+    """
+    SQLite table TABLE with COLUMNS (the column definitions of CREATE TABLE), in
+    autocommit and WAL mode, so each write is durable once it returns and reads don't
+    block on it. Safe to share between threads.
+
+    Args
+        path: database file, created if it doesn't exist
+    """
+    TABLE: str = None
+    COLUMNS: str = None
+
+    def __init__(self, path: str):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {self.TABLE} ({self.COLUMNS})")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {self.TABLE}").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,298 @@
+"""
+Bounded-memory streaming preprocessing for causal lm training. Includes:
+ - StreamingLMDataset
+ - StreamingTrainer
+
+StreamingLMDataset runs read -> clean -> tokenize -> chunk -> group -> pack as a
+chain of generators over a (streaming) dataset of texts. Only a few tokenizer
+batches and one packing buffer are held in memory at once, and a background
+thread prefetches a bounded number of samples ahead of the training loop.
+Each rank (and dataloader worker) reads its own deterministic slice of the
+source, so ranks never duplicate I/O. Slices can hold different numbers of
+samples, so StreamingTrainer cuts every rank's evaluation to the same number of
+batches, otherwise ranks would wait on each other's metric gathers forever.
+"""
+import queue
+import threading
+import itertools
+import typing
+from typing import (
+    Optional,
+    Callable,
+    Tuple,
+    Iterable,
+    Iterator,
+    List,
+    Dict
+)
+import logging
+
+import torch
+import datasets
+from datasets.distributed import split_dataset_by_node
+from torch.utils.data import DataLoader, IterableDataset as TorchIterableDataset, get_worker_info
+from transformers import Trainer
+
+from utils.chunking import split_batch_into_chunks, group_chunks, special_token_affixes
+from utils.packing import pack_features
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+def _batched(iterable: Iterable, n: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, n))
+        if not batch:
+            return
+        yield batch
+
+
+def prefetch(iterable: Iterable, size: int) -> Iterator:
+    """
+    Iterate over iterable in a background thread, keeping at most size items ready.
+    Exceptions raised by the producer are re-raised in the consumer.
+    """
+    if size <= 0:
+        yield from iterable
+        return
+
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        # Give up once the consumer is gone, instead of blocking on a full queue forever
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(_END)
+        except BaseException as e:
+            put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+class StreamingLMDataset(TorchIterableDataset):
+    """
+    Stream lm features from a dataset of texts.
+
+    Args
+        dataset: datasets.IterableDataset (or any iterable) of dicts with a text column
+        tokenizer: tokenizer to tokenize texts with
+        block_size: max length of a feature
+        text_column_name: name of text column
+        clean_fn: optional function applied to each text before tokenization, e.g. scripts.clean_data.clean_sample
+        chunk_sep_ids: ids to prefer splitting long sequences on (see utils.chunking)
+        min_seq_len: chunks with min_seq_len ids or fewer are discarded
+        pack: whether to pack features into block_size windows (see utils.packing)
+        pack_buffer_size: number of features packed together
+        tokenize_batch_size: number of texts tokenized together
+        prefetch_size: number of features prepared ahead in a background thread (0 to disable)
+        rank, world_size: this process's slice of the source, e.g. TrainingArguments process_index and world_size
+        max_samples: stop after this many features in all, split evenly across ranks and dataloader workers
+    """
+    def __init__(
+        self,
+        dataset: Iterable[Dict],
+        tokenizer,
+        block_size: int,
+        text_column_name: str="text",
+        clean_fn: Optional[Callable[[str], str]]=None,
+        chunk_sep_ids: Optional[List[int]]=None,
+        min_seq_len: int=0,
+        pack: bool=False,
+        pack_buffer_size: int=1000,
+        tokenize_batch_size: int=64,
+        prefetch_size: int=256,
+        rank: int=0,
+        world_size: int=1,
+        max_samples: Optional[int]=None
+    ):
+        self.dataset = dataset
+        self.tokenizer = tokenizer
+        self.block_size = block_size
+        self.text_column_name = text_column_name
+        self.clean_fn = clean_fn
+        self.chunk_sep_ids = chunk_sep_ids
+        self.min_seq_len = min_seq_len
+        self.pack = pack
+        self.pack_buffer_size = pack_buffer_size
+        self.tokenize_batch_size = tokenize_batch_size
+        self.prefetch_size = prefetch_size
+        self.rank = rank
+        self.world_size = world_size
+        self.max_samples = max_samples
+        self.prefix_ids, self.suffix_ids = special_token_affixes(tokenizer)
+        self.epoch = 0
+
+    def take(self, n: int) -> "StreamingLMDataset":
+        """
+        Copy of this dataset that stops after n features in all (see max_samples).
+        """
+        taken = object.__new__(StreamingLMDataset)
+        taken.__dict__.update(self.__dict__)
+        taken.max_samples = n if self.max_samples is None else min(n, self.max_samples)
+        return taken
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+        if hasattr(self.dataset, "set_epoch"):
+            self.dataset.set_epoch(epoch)
+
+    def _slice(self) -> Tuple[int, int]:
+        """
+        Index of this rank's and dataloader worker's slice, and number of slices.
+        """
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        return self.rank * num_workers + worker_id, self.world_size * num_workers
+
+    def _read(self) -> Iterator[str]:
+        """
+        Texts of this rank's (and dataloader worker's) slice of the source.
+        """
+        slice_id, n_slices = self._slice()
+
+        if isinstance(self.dataset, datasets.IterableDataset):
+            # Assigns whole shards to ranks when possible, so each rank only opens its own files.
+            # Dataloader workers are split by datasets itself.
+            source = split_dataset_by_node(
+                self.dataset, rank=self.rank, world_size=self.world_size
+            )
+        else:
+            source = itertools.islice(self.dataset, slice_id, None, n_slices)
+
+        for example in source:
+            yield example[self.text_column_name]
+
+    def _features(self) -> Iterator[Dict[str, List[int]]]:
+        texts = self._read()
+        if self.clean_fn is not None:
+            texts = (t for t in map(self.clean_fn, texts) if t != "")
+
+        for text_batch in _batched(texts, self.tokenize_batch_size):
+            ids = self.tokenizer(text_batch)["input_ids"]
+            chunks = split_batch_into_chunks(ids, chunk_size=self.block_size, split_id=self.chunk_sep_ids)
+            features = group_chunks(chunks, self.block_size, min_seq_len=self.min_seq_len,
+                                    prefix_ids=self.prefix_ids, suffix_ids=self.suffix_ids)
+            for i in range(len(features["input_ids"])):
+                yield {k: v[i] for k, v in features.items()}
+
+    def _packed(self, features: Iterator[Dict[str, List[int]]]) -> Iterator[Dict[str, List[int]]]:
+        for buffer in _batched(features, self.pack_buffer_size):
+            packed = pack_features({k: [f[k] for f in buffer] for k in ["input_ids", "labels"]}, self.block_size)
+            for i in range(len(packed["input_ids"])):
+                yield {k: v[i] for k, v in packed.items()}
+
+    def __iter__(self) -> Iterator[Dict[str, List[int]]]:
+        features = self._features()
+        if self.pack:
+            features = self._packed(features)
+        if self.max_samples is not None:
+            slice_id, n_slices = self._slice()
+            n_samples = self.max_samples // n_slices + (slice_id < self.max_samples % n_slices)
+            features = itertools.islice(features, n_samples)
+        return prefetch(features, self.prefetch_size)
+
+
+class _EvenBatches:
+    """
+    Batches of dataloader, as many on every rank. On the first pass, all ranks check before each batch
+    that they all have one, stop together at the first rank that runs out, and record the number of
+    batches in counts (keyed by dataset id). Later passes take that many batches without the checks,
+    and raise a RuntimeError if the dataloader yields fewer, since other ranks would then wait for this one.
+    """
+    def __init__(self, dataloader: DataLoader, accelerator, counts: Dict[int, int]):
+        self.dataloader = dataloader
+        self.dataset = dataloader.dataset
+        self.batch_size = dataloader.batch_size
+        self.accelerator = accelerator
+        self.counts = counts
+
+    def __iter__(self) -> Iterator:
+        n_batches = self.counts.get(id(self.dataset))
+        n = 0
+        if n_batches is not None:
+            for batch in itertools.islice(self.dataloader, n_batches):
+                n += 1
+                yield batch
+            if n < n_batches:
+                raise RuntimeError(f"Eval dataloader yielded {n} batches, expected {n_batches} like the other ranks.")
+            return
+
+        batches = iter(self.dataloader)
+        while True:
+            batch = next(batches, None)
+            has_batch = self.accelerator.gather(torch.tensor([batch is not None], device=self.accelerator.device)).tolist()
+            if not all(has_batch):
+                break
+            n += 1
+            yield batch
+        if n == 0:
+            raise ValueError(f"Some ranks have no eval batches (ranks with a batch: {has_batch}), "
+                             "use a larger validation split or fewer processes.")
+        if any(has_batch):
+            logger.warning(f"Eval batches differ across ranks, evaluating the first {n} batches of every rank.")
+        self.counts[id(self.dataset)] = n
+
+
+class StreamingTrainer(Trainer):
+    """
+    Trainer that feeds StreamingLMDatasets, which already shard themselves across ranks, to plain
+    DataLoaders. Otherwise accelerate would dispatch batches from rank 0 or re-shard each rank's slice.
+    With several ranks, evaluation runs the smallest number of batches of any rank on every rank.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Eval batches every rank runs, by eval dataset id, see _EvenBatches
+        self._eval_batch_counts = {}
+
+    def get_train_dataloader(self) -> DataLoader:
+        if not isinstance(self.train_dataset, StreamingLMDataset):
+            return super().get_train_dataloader()
+        return DataLoader(
+            self.train_dataset,
+            batch_size=self._train_batch_size,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+
+    def get_eval_dataloader(self, eval_dataset=None) -> DataLoader:
+        eval_dataset = eval_dataset if eval_dataset is not None else self.eval_dataset
+        if not isinstance(eval_dataset, StreamingLMDataset):
+            return super().get_eval_dataloader(eval_dataset)
+        dataloader = DataLoader(
+            eval_dataset,
+            batch_size=self.args.eval_batch_size,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+        if self.args.world_size > 1:
+            dataloader = _EvenBatches(dataloader, self.accelerator, self._eval_batch_counts)
+        return dataloader